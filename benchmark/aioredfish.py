@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+
+# aioredfish.py - An asyncio Redfish client, for comparison in fleet benchmarks
+# Part of the Parallel Virtual Cluster (PVC) system
+#
+#    Copyright (C) 2018-2021 Joshua M. Boniface <joshua@boniface.me>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# This client is only used by bench-aioredfish, to compare fleet operations from one
+# event loop with the synchronous RedfishSession the daemon uses; it is not part of
+# the daemon, which does not depend on aiohttp.
+
+import aiohttp
+import asyncio
+import json
+import re
+
+import pvcbootstrapd.lib.retry as retry
+
+from time import monotonic
+from celery.utils.log import get_task_logger
+
+
+logger = get_task_logger(__name__)
+
+
+# Task and (Dell) job states of operations still in progress on the BMC
+active_task_states = ["New", "Starting", "Running", "Pending", "Stopping", "Cancelling"]
+active_job_states = ["New", "Scheduling", "Starting", "Running", "Downloading"]
+
+
+#
+# Helper Classes
+#
+class AsyncRedfishSession:
+    """
+    An asyncio Redfish session, with the same verbs and semantics as RedfishSession
+
+    Use as an async context manager, which logs in and out:
+
+        async with AsyncRedfishSession(host, username, password) as session:
+            system_detail = await session.get(system_root)
+
+    Many sessions can share one aiohttp ClientSession ('http'), so that operations
+    across hundreds of BMCs run concurrently from a single event loop.
+    """
+
+    # Default (connect, read) timeouts for requests to the BMC, as for RedfishSession
+    default_timeout = (10, 60)
+
+    # Default maximum number of concurrent requests to a single BMC
+    default_max_fanout = 4
+
+    def __init__(
+        self, host, username, password, timeout=None, max_fanout=None, http=None
+    ):
+        self.host = host
+        self.username = username
+        self.password = password
+        connect_timeout, read_timeout = (
+            timeout if timeout is not None else self.default_timeout
+        )
+        self.timeout = aiohttp.ClientTimeout(
+            sock_connect=connect_timeout, sock_read=read_timeout
+        )
+        self.max_fanout = (
+            max_fanout if max_fanout is not None else self.default_max_fanout
+        )
+        self.fanout = asyncio.Semaphore(max(self.max_fanout, 1))
+
+        # Use the given shared HTTP client, or our own
+        self.http = http
+        self.own_http = http is None
+
+        self.token = None
+        self.headers = None
+        self.logout_uri = None
+
+    async def __aenter__(self):
+        if not await self.login():
+            await self.close()
+            raise ConnectionError(f"Failed to log in to Redfish at {self.host}")
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.logout()
+        await self.close()
+
+    async def close(self):
+        if self.own_http and self.http is not None:
+            await self.http.close()
+            self.http = None
+
+    async def login(self, max_tries=60):
+        """
+        Log in to the BMC, retrying failed connections with jittered backoff (so that
+        a fleet of BMCs is not retried in lockstep); returns whether it succeeded
+        """
+        if self.http is None:
+            self.http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    ssl=False, limit_per_host=max(self.max_fanout, 1)
+                )
+            )
+
+        login_payload = {"UserName": self.username, "Password": self.password}
+        login_uri = f"{self.host}/redfish/v1/Sessions"
+        login_headers = {"content-type": "application/json"}
+
+        policy = retry.RetryPolicy(max_attempts=max_tries, base_delay=1, max_delay=16)
+        for tries in range(1, max_tries + 1):
+            logger.debug(f"Trying to log in to Redfish at {self.host} ({tries})...")
+            try:
+                async with self.http.post(
+                    login_uri,
+                    data=json.dumps(login_payload),
+                    headers=login_headers,
+                    ssl=False,
+                    timeout=aiohttp.ClientTimeout(total=5),
+                ) as response:
+                    if response.status not in [200, 201]:
+                        self.log_failure(
+                            "Login", login_uri, response.status, await response.text()
+                        )
+                        return False
+                    self.token = response.headers.get("X-Auth-Token")
+                    logout_uri = response.headers.get("Location")
+                    break
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                await asyncio.sleep(policy.delay(tries))
+        else:
+            logger.error(f"Failed to log in to Redfish at {self.host}")
+            return False
+
+        logger.info(f"Logged in to Redfish at {self.host} successfully")
+        self.headers = {"content-type": "application/json", "x-auth-token": self.token}
+        if logout_uri is not None and re.match(r"^/", logout_uri):
+            self.logout_uri = f"{self.host}{logout_uri}"
+        else:
+            self.logout_uri = logout_uri
+        return True
+
+    async def logout(self):
+        """
+        Log out of the BMC, if logged in
+        """
+        if self.token is None or self.logout_uri is None:
+            return
+
+        try:
+            async with self.http.delete(
+                self.logout_uri,
+                headers=self.headers,
+                ssl=False,
+                timeout=aiohttp.ClientTimeout(total=15),
+            ) as response:
+                if response.status not in [200, 201, 204]:
+                    self.log_failure(
+                        "Logout",
+                        self.logout_uri,
+                        response.status,
+                        await response.text(),
+                    )
+                    return
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Failed to log out of Redfish at {self.host}: {e}")
+            return
+        finally:
+            self.token = None
+        logger.info(f"Logged out of Redfish at {self.host} successfully")
+
+    def log_failure(self, method, url, status, text):
+        """
+        Log the details of a failed request from its Redfish error body, if any
+        """
+        try:
+            rinfo = json.loads(text)["error"]["@Message.ExtendedInfo"][0]
+        except Exception:
+            rinfo = dict()
+        if rinfo.get("Message") is not None:
+            message = f"{rinfo['Message']} {rinfo.get('Resolution', '')}"
+            severity = rinfo.get("Severity", "Error")
+            message_id = rinfo.get("MessageId", "N/A")
+        else:
+            message = text
+            severity = "Error"
+            message_id = "N/A"
+        logger.warn(f"! Error: {method} request to {url} failed")
+        logger.warn(f"! HTTP Code: {status}   Severity: {severity}   ID: {message_id}")
+        logger.warn(f"! Details: {message}")
+
+    async def request(self, method, uri, data=None):
+        """
+        Perform a request, with at most 'max_fanout' in flight to this BMC
+
+        Returns the HTTP status, response headers and decoded JSON body (or None).
+        """
+        url = uri if re.match(r"^https?://", uri) else f"{self.host}{uri}"
+        payload = json.dumps(data) if data is not None else None
+
+        logger.debug(f"{method} {url} payload: {payload}")
+
+        async with self.fanout:
+            async with self.http.request(
+                method,
+                url,
+                data=payload,
+                headers=self.headers,
+                ssl=False,
+                timeout=self.timeout,
+            ) as response:
+                text = await response.text()
+                logger.debug(f"Response: {response.status}")
+                try:
+                    body = json.loads(text) if text else None
+                except ValueError:
+                    body = None
+                if response.status >= 400:
+                    self.log_failure(method, url, response.status, text)
+                return response.status, response.headers, body
+
+    async def get(self, uri):
+        status, _, body = await self.request("GET", uri)
+        if status not in [200]:
+            return None
+        return body
+
+    async def delete(self, uri):
+        status, _, body = await self.request("DELETE", uri)
+        if status not in [200, 202, 204]:
+            return None
+        return body if body is not None else {"response": "ok"}
+
+    async def post(self, uri, data):
+        status, _, body = await self.request("POST", uri, data)
+        if status in [201, 202, 204]:
+            return {"response": "ok"}
+        if status not in [200]:
+            return None
+        return body if body is not None else {"response": "ok"}
+
+    async def put(self, uri, data):
+        status, _, body = await self.request("PUT", uri, data)
+        if status in [201, 202, 204]:
+            return {"response": "ok"}
+        if status not in [200]:
+            return None
+        return body if body is not None else {"response": "ok"}
+
+    async def patch(self, uri, data):
+        status, _, body = await self.request("PATCH", uri, data)
+        if status in [201, 202, 204]:
+            return {"response": "ok"}
+        if status not in [200]:
+            return None
+        return body if body is not None else {"response": "ok"}
+
+    async def request_async(self, method, uri, data, timeout=600, progress=None):
+        """
+        Perform a POST or PATCH which may start an asynchronous operation on the BMC,
+        and wait for it to complete by following its task monitor with exponential
+        backoff, as RedfishSession.request_async()
+
+        Returns the final response body (or an empty dict if there is none) once the
+        operation completed successfully, or None if it failed or timed out.
+        """
+        status, headers, body = await self.request(method, uri, data)
+        if status not in [200, 201, 202, 204]:
+            return None
+
+        task_monitor = headers.get("Location")
+        if status != 202 or task_monitor is None:
+            # The operation completed synchronously
+            return body if body is not None else dict()
+
+        logger.info(f"Following {method} task monitor {task_monitor}")
+
+        start = monotonic()
+        delay = 1
+        last_status = None
+        while monotonic() - start < timeout:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+            status, _, task_detail = await self.request("GET", task_monitor)
+            if status == 404:
+                # Some BMCs remove the task monitor as soon as the task completes
+                return dict()
+            if status not in [200, 201, 202, 204]:
+                return None
+            if task_detail is None:
+                task_detail = dict()
+
+            # Tasks report a TaskState, Dell jobs a JobState; final responses neither
+            task_state = task_detail.get("TaskState", task_detail.get("JobState"))
+            task_percent = task_detail.get("PercentComplete", 0)
+            if (task_state, task_percent) != last_status:
+                logger.info(f"Task {task_monitor}: {task_state} ({task_percent}%)")
+                if progress is not None:
+                    progress(task_state, task_percent)
+                last_status = (task_state, task_percent)
+
+            if status == 202 or task_state in active_task_states + active_job_states:
+                continue
+            if task_state in ["Exception", "Killed", "Cancelled", "Failed"]:
+                messages = task_detail.get("Messages")
+                logger.warn(f"Task {task_monitor} failed: {messages}")
+                return None
+            if task_state in ["CompletedWithErrors"]:
+                messages = task_detail.get("Messages")
+                logger.warn(f"Task {task_monitor} had errors: {messages}")
+            return task_detail
+
+        logger.warn(f"Timed out after {timeout}s waiting for task {task_monitor}")
+        return None
+
+    async def post_async(self, uri, data, timeout=600, progress=None):
+        return await self.request_async(
+            "POST", uri, data, timeout=timeout, progress=progress
+        )
+
+    async def patch_async(self, uri, data, timeout=600, progress=None):
+        return await self.request_async(
+            "PATCH", uri, data, timeout=timeout, progress=progress
+        )
+
+    async def get_member(self, member):
+        """
+        Get the details of a collection member or link, unless already expanded
+        """
+        if len(set(member.keys()) - {"@odata.id"}) > 0:
+            return member
+        return await self.get(member["@odata.id"])
+
+    async def get_members(self, members):
+        """
+        Get the details of several collection members or links concurrently (limited
+        by 'max_fanout'); results keep the given order
+        """
+        return await asyncio.gather(*[self.get_member(member) for member in members])
+
+
+#
+# Fleet functions
+#
+def create_fleet_client(limit=0, limit_per_host=4):
+    """
+    Create an aiohttp ClientSession to share between the sessions of a fleet, with at
+    most 'limit' connections overall (0 is unlimited) and 'limit_per_host' per BMC
+    """
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            ssl=False, limit=limit, limit_per_host=limit_per_host
+        )
+    )
+
+
+async def run_fleet(bmcs, operation, concurrency=100, timeout=None, max_fanout=None):
+    """
+    Run an operation across a fleet of BMCs concurrently from this event loop
+
+    'bmcs' is a list of (host, username, password) tuples, and 'operation' a coroutine
+    function taking an AsyncRedfishSession. At most 'concurrency' BMCs are logged in
+    to at once. Returns a dictionary of hosts to operation results, or to the
+    exception raised for that host.
+    """
+    limiter = asyncio.Semaphore(concurrency)
+    per_host = max_fanout if max_fanout is not None else 4
+
+    async with create_fleet_client(limit_per_host=per_host) as http:
+
+        async def run_one(host, username, password):
+            async with limiter:
+                try:
+                    async with AsyncRedfishSession(
+                        host,
+                        username,
+                        password,
+                        timeout=timeout,
+                        max_fanout=max_fanout,
+                        http=http,
+                    ) as session:
+                        return await operation(session)
+                except Exception as e:
+                    logger.warn(f"Fleet operation failed on {host}: {e}")
+                    return e
+
+        results = await asyncio.gather(*[run_one(*bmc) for bmc in bmcs])
+
+    return {bmc[0]: result for bmc, result in zip(bmcs, results)}
@@ -0,0 +1,1020 @@
+#!/usr/bin/env python3
+
+# mockredfish.py - A mock Redfish service simulating many BMCs, for benchmarks
+# Part of the Parallel Virtual Cluster (PVC) system
+#
+#    Copyright (C) 2018-2021 Joshua M. Boniface <joshua@boniface.me>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import argparse
+import asyncio
+import copy
+import datetime
+import json
+import os
+import random
+import re
+import ssl
+import tempfile
+
+from aiohttp import ClientSession, web
+from time import monotonic
+
+
+# Vendor profiles of the simulated BMCs:
+#   generic: a standard Redfish service (modelled on HPE iLO) without $expand support,
+#            with the host MAC address in HostCorrelation and no Storage
+#   dell: an iDRAC, with $expand/$select/$filter support, Dell jobs, a PERC controller
+#         with four drives, BIOS and Manager Attributes, and Server Configuration
+#         Profile imports
+PROFILES = ["generic", "dell"]
+
+# The first host NIC MAC address of a BMC; the BMC index fills the last two octets
+HOST_MAC_BASE = "aa:bb:cc:00:{:02x}:{:02x}"
+
+# Size of the simulated drives (480GB)
+DRIVE_SIZE = 480103981056
+
+
+class MockBMC:
+    """
+    A simulated BMC, holding a Redfish resource tree and answering on its own port
+
+    Behaviour can be tuned to model real (slow, flaky) BMCs:
+      latency: seconds to delay every response, plus up to 'jitter' seconds more
+      failure_rate: the fraction of requests answered with 503 Service Unavailable
+      failure_methods: the HTTP methods failures are injected into
+      fail_paths: a regex of paths always answered with 500 Internal Server Error
+      power_delay: seconds a power state change takes to converge
+      graceful_shutdown: whether the host acts on GracefulShutdown requests
+      task_duration: seconds an asynchronous task (e.g. volume creation) runs for
+      task_history: the number of completed tasks (or Dell jobs) the BMC keeps from
+        earlier operations
+      session_timeout: seconds of inactivity after which a session expires
+
+    Subscribers (see EventService) are sent StatusChange events on power state changes
+    and ResourceUpdated events on task and job completion.
+    """
+
+    def __init__(
+        self,
+        index,
+        profile="generic",
+        latency=0.0,
+        jitter=0.0,
+        failure_rate=0.0,
+        failure_methods=("GET",),
+        fail_paths=None,
+        power_delay=0.0,
+        graceful_shutdown=True,
+        task_duration=1.0,
+        task_history=0,
+        session_timeout=None,
+        seed=None,
+    ):
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown BMC profile {profile}")
+        self.index = index
+        self.profile = profile
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.failure_methods = failure_methods
+        self.fail_paths = re.compile(fail_paths) if fail_paths else None
+        self.power_delay = power_delay
+        self.graceful_shutdown = graceful_shutdown
+        self.task_duration = task_duration
+        self.task_history = task_history
+        self.session_timeout = session_timeout
+        self.random = random.Random(seed if seed is not None else index)
+
+        self.sessions = dict()
+        self.session_used = dict()
+        self.session_count = 0
+        self.resources = dict()
+        self.tasks = dict()
+        self.task_count = 0
+        self.subscription_count = 0
+        # Events sent to subscribers, delivered successfully, and failed to deliver
+        self.event_count = 0
+        self.events_delivered = 0
+        self.event_failures = 0
+        self.event_deliveries = set()
+        self.settings_patches = 0
+        self.scp_imports = 0
+        self.noop_resets = 0
+        self.requests = 0
+        self.failures = 0
+        # Requests being answered at once, and the most seen so far
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+        self.host_macaddr = HOST_MAC_BASE.format(index // 256, index % 256)
+        self.build()
+
+    #
+    # Resource tree
+    #
+    def add(self, uri, resource):
+        resource["@odata.id"] = uri
+        resource.setdefault("Id", uri.split("/")[-1])
+        self.resources[uri] = resource
+        return resource
+
+    def add_collection(self, uri, members):
+        return self.add(uri, {"Members": [{"@odata.id": member} for member in members]})
+
+    def build(self):
+        if self.profile == "dell":
+            vendor = "Dell"
+            manager_id = "iDRAC.Embedded.1"
+            system_id = "System.Embedded.1"
+            nic_id = "NIC.Embedded.1-1-1"
+            protocol_features = {
+                "ExpandQuery": {
+                    "ExpandAll": True,
+                    "NoLinks": True,
+                    "Levels": True,
+                    "MaxLevels": 2,
+                    "Links": True,
+                },
+                "SelectQuery": True,
+                "FilterQuery": True,
+            }
+        else:
+            vendor = "Hpe"
+            manager_id = "1"
+            system_id = "1"
+            nic_id = "1"
+            protocol_features = {}
+
+        manager_root = f"/redfish/v1/Managers/{manager_id}"
+        system_root = f"/redfish/v1/Systems/{system_id}"
+        self.manager_root = manager_root
+        self.system_root = system_root
+
+        self.add(
+            "/redfish/v1",
+            {
+                "Name": "Root Service",
+                "RedfishVersion": "1.6.0",
+                "Oem": {vendor: {}},
+                "ProtocolFeaturesSupported": protocol_features,
+                "Managers": {"@odata.id": "/redfish/v1/Managers"},
+                "Systems": {"@odata.id": "/redfish/v1/Systems"},
+                "SessionService": {"@odata.id": "/redfish/v1/SessionService"},
+                "EventService": {"@odata.id": "/redfish/v1/EventService"},
+                "TaskService": {"@odata.id": "/redfish/v1/TaskService"},
+            },
+        )
+
+        # Manager
+        self.add_collection("/redfish/v1/Managers", [manager_root])
+        self.add(
+            manager_root,
+            {"Name": "Manager", "Status": {"State": "Enabled", "Health": "OK"}},
+        )
+        if self.profile == "dell":
+            self.add_collection(f"{manager_root}/Jobs", [])
+            self.add(
+                f"{manager_root}/Attributes",
+                {
+                    "Attributes": {
+                        "IPMILan.1.Enable": "Disabled",
+                        "NTPConfigGroup.1.NTP1": "",
+                        "Time.1.Timezone": "UTC",
+                    }
+                },
+            )
+
+        # Tasks and events
+        self.add(
+            "/redfish/v1/TaskService",
+            {"Tasks": {"@odata.id": "/redfish/v1/TaskService/Tasks"}},
+        )
+        self.add_collection("/redfish/v1/TaskService/Tasks", [])
+        # Completed tasks (or Dell jobs) left over from earlier operations
+        for _ in range(self.task_history):
+            self.task_count += 1
+            if self.profile == "dell":
+                collection_root = f"{manager_root}/Jobs"
+                task_root = (
+                    f"{collection_root}/JID_{self.index:04d}{self.task_count:08d}"
+                )
+                self.add(task_root, {"Name": "Job", "JobState": "Completed"})
+            else:
+                collection_root = "/redfish/v1/TaskService/Tasks"
+                task_root = f"{collection_root}/{self.task_count}"
+                self.add(task_root, {"Name": "Task", "TaskState": "Completed"})
+            self.resources[collection_root]["Members"].append({"@odata.id": task_root})
+        self.add(
+            "/redfish/v1/EventService",
+            {
+                "ServiceEnabled": True,
+                "EventTypesForSubscription": [
+                    "StatusChange",
+                    "ResourceUpdated",
+                    "Alert",
+                ],
+                "Subscriptions": {
+                    "@odata.id": "/redfish/v1/EventService/Subscriptions"
+                },
+            },
+        )
+        self.add_collection("/redfish/v1/EventService/Subscriptions", [])
+
+        # System
+        self.add_collection("/redfish/v1/Systems", [system_root])
+        boot_targets = ["None", "Pxe", "Hdd", "Cd", "BiosSetup", "UefiTarget"]
+        system = self.add(
+            system_root,
+            {
+                "Name": "System",
+                "Model": "ProLiant DL360 Gen9",
+                "SKU": "755258-B21",
+                "SerialNumber": f"SN{self.index:08d}",
+                "PowerState": "On",
+                "IndicatorLED": "Off",
+                "Status": {"State": "Enabled", "Health": "OK"},
+                "Boot": {
+                    "BootSourceOverrideEnabled": "Disabled",
+                    "BootSourceOverrideTarget": "None",
+                },
+                "Bios": {"@odata.id": f"{system_root}/Bios"},
+                "EthernetInterfaces": {
+                    "@odata.id": f"{system_root}/EthernetInterfaces"
+                },
+                "Actions": {
+                    "#ComputerSystem.Reset": {
+                        "target": f"{system_root}/Actions/ComputerSystem.Reset",
+                        "ResetType@Redfish.AllowableValues": [
+                            "On",
+                            "ForceOff",
+                            "GracefulShutdown",
+                            "ForceRestart",
+                        ],
+                    }
+                },
+            },
+        )
+        if self.profile == "dell":
+            # The iDRAC SKU is the (per-system) service tag
+            system["Model"] = "PowerEdge R640"
+            system["SKU"] = f"MOCK{self.index:03d}"
+            system["Boot"][
+                "BootSourceOverrideTarget@Redfish.AllowableValues"
+            ] = boot_targets
+            system["Storage"] = {"@odata.id": f"{system_root}/Storage"}
+        else:
+            system["Boot"]["BootSourceOverrideSupported"] = boot_targets
+            system["HostCorrelation"] = {"HostMACAddress": [self.host_macaddr]}
+
+        self.add_collection(
+            f"{system_root}/EthernetInterfaces",
+            [f"{system_root}/EthernetInterfaces/{nic_id}"],
+        )
+        self.add(
+            f"{system_root}/EthernetInterfaces/{nic_id}",
+            {"MACAddress": self.host_macaddr.upper()},
+        )
+
+        # BIOS
+        self.add(
+            f"{system_root}/Bios",
+            {
+                "Attributes": {
+                    "BootMode": "Bios",
+                    "SysProfile": "PerfPerWattOptimizedDapc",
+                    "ProcVirtualization": "Disabled",
+                },
+                "@Redfish.Settings": {
+                    "SettingsObject": {"@odata.id": f"{system_root}/Bios/Settings"},
+                    "SupportedApplyTimes": ["Immediate", "OnReset"],
+                },
+            },
+        )
+        self.add(f"{system_root}/Bios/Settings", {"Attributes": {}})
+
+        # Storage
+        if self.profile == "dell":
+            self.build_storage(system_root)
+
+    def build_storage(self, system_root):
+        controller_id = "RAID.Integrated.1-1"
+        storage_root = f"{system_root}/Storage"
+        controller_root = f"{storage_root}/{controller_id}"
+
+        self.add_collection(storage_root, [controller_root])
+        drives = list()
+        volumes = list()
+        for bay in range(4):
+            drive_id = f"Disk.Bay.{bay}:Enclosure.Internal.0-1:{controller_id}"
+            drive_root = f"{storage_root}/Drives/{drive_id}"
+            # Non-RAID drives are presented as a volume with the drive's own ID
+            volume_root = f"{controller_root}/Volumes/{drive_id}"
+            self.add(
+                drive_root,
+                {
+                    "Name": f"Solid State Disk 0:1:{bay}",
+                    "Model": "MZ7KH480HAHQ0D3",
+                    "CapacityBytes": DRIVE_SIZE,
+                    "MediaType": "SSD",
+                    "Links": {"Volumes": [{"@odata.id": volume_root}]},
+                },
+            )
+            self.add(
+                volume_root,
+                {
+                    "Name": drive_id,
+                    "VolumeType": "RawDevice",
+                    "CapacityBytes": DRIVE_SIZE,
+                    "Links": {"Drives": [{"@odata.id": drive_root}]},
+                },
+            )
+            drives.append({"@odata.id": drive_root})
+            volumes.append(volume_root)
+
+        self.add(
+            controller_root,
+            {
+                "Name": "PERC H730P Mini",
+                "Drives": drives,
+                "Volumes": {"@odata.id": f"{controller_root}/Volumes"},
+                "Status": {"State": "Enabled", "Health": "OK"},
+            },
+        )
+        self.add_collection(f"{controller_root}/Volumes", volumes)
+
+    #
+    # Queries
+    #
+    def expand(self, resource, levels, select=None):
+        """
+        Expand the members of a collection (and their subordinate resources, up to
+        'levels' deep), as for a "$expand=.($levels=n)" query
+        """
+        resource = copy.deepcopy(resource)
+        if "Members" not in resource:
+            return resource
+
+        members = list()
+        for member in resource["Members"]:
+            member_detail = copy.deepcopy(
+                self.resources.get(member["@odata.id"], member)
+            )
+            if levels > 1:
+                for key, value in member_detail.items():
+                    if key in ["Links", "Actions"] or not isinstance(value, list):
+                        continue
+                    member_detail[key] = [
+                        copy.deepcopy(self.resources.get(link["@odata.id"], link))
+                        for link in value
+                    ]
+            if select is not None:
+                member_detail = {
+                    key: value
+                    for key, value in member_detail.items()
+                    if key in select or key.startswith("@odata")
+                }
+            members.append(member_detail)
+        resource["Members"] = members
+        return resource
+
+    def query(self, request, resource):
+        """
+        Apply any $expand, $select and $filter query to a resource; returns None if the
+        query is not supported by this BMC
+        """
+        features = self.resources["/redfish/v1"]["ProtocolFeaturesSupported"]
+        expand = request.query.get("$expand")
+        select = request.query.get("$select")
+        filter_by = request.query.get("$filter")
+        if expand is None and select is None and filter_by is None:
+            return resource
+        if expand is not None and not features.get("ExpandQuery"):
+            return None
+        if "$levels" in (expand or "") and not features["ExpandQuery"].get("Levels"):
+            return None
+        if select is not None and not features.get("SelectQuery"):
+            return None
+        if filter_by is not None:
+            if not features.get("FilterQuery"):
+                return None
+            resource = self.filter(resource, filter_by)
+            if resource is None:
+                return None
+            if expand is None and select is None:
+                return resource
+
+        levels = 1
+        if expand is not None:
+            match = re.search(r"\$levels=(\d+)", expand)
+            if match:
+                levels = int(match.group(1))
+        return self.expand(
+            resource, levels, select.split(",") if select is not None else None
+        )
+
+    def filter(self, resource, filter_by):
+        """
+        Filter the members of a collection, as for a "$filter=A eq 'x' or B eq 'y'"
+        query; returns None for any other (unsupported) filter expression
+        """
+        terms = list()
+        for term in filter_by.split(" or "):
+            match = re.fullmatch(r"\s*(\w+) eq '([^']*)'\s*", term)
+            if match is None:
+                return None
+            terms.append((match.group(1), match.group(2)))
+
+        resource = copy.deepcopy(resource)
+        if "Members" not in resource:
+            return resource
+        resource["Members"] = [
+            member
+            for member in resource["Members"]
+            if any(
+                self.resources.get(member["@odata.id"], member).get(key) == value
+                for key, value in terms
+            )
+        ]
+        return resource
+
+    #
+    # Asynchronous tasks
+    #
+    def start_task(self, name, on_complete):
+        """
+        Start a task completing after 'task_duration'; returns its monitor URI
+        """
+        self.task_count += 1
+        if self.profile == "dell":
+            collection_root = f"{self.manager_root}/Jobs"
+            task_root = f"{collection_root}/JID_{self.index:04d}{self.task_count:08d}"
+        else:
+            collection_root = "/redfish/v1/TaskService/Tasks"
+            task_root = f"{collection_root}/{self.task_count}"
+
+        self.tasks[task_root] = {
+            "started": asyncio.get_running_loop().time(),
+            "on_complete": on_complete,
+            "completed": False,
+        }
+        self.add(task_root, {"Name": name})
+        self.resources[collection_root]["Members"].append({"@odata.id": task_root})
+        self.update_task(task_root)
+        # Complete the task on time even if nobody polls it, to send its event
+        asyncio.get_running_loop().call_later(
+            self.task_duration + 0.01, self.update_task, task_root
+        )
+        return task_root
+
+    def update_task(self, task_root):
+        """
+        Update the state of a task, completing it once its time is up
+        """
+        task = self.tasks[task_root]
+        elapsed = asyncio.get_running_loop().time() - task["started"]
+        done = elapsed >= self.task_duration
+        if done and not task["completed"]:
+            task["completed"] = True
+            task["on_complete"]()
+            self.send_event(
+                "ResourceUpdated", "TaskEvent.1.0.TaskCompletedOK", task_root
+            )
+
+        percent = 100 if done else int(100 * elapsed / self.task_duration)
+        state = "Completed" if done else "Running"
+        if self.profile == "dell":
+            self.resources[task_root]["JobState"] = state
+        else:
+            self.resources[task_root]["TaskState"] = state
+        self.resources[task_root]["PercentComplete"] = percent
+        return done
+
+    #
+    # Events
+    #
+    def send_event(self, event_type, message_id, origin):
+        """
+        Send an event to each subscription accepting its type, in the background
+        """
+        collection = self.resources["/redfish/v1/EventService/Subscriptions"]
+        for member in collection["Members"]:
+            subscription = self.resources[member["@odata.id"]]
+            event_types = subscription.get("EventTypes")
+            if event_types and event_type not in event_types:
+                continue
+            self.event_count += 1
+            event = {
+                "@odata.type": "#Event.v1_4_0.Event",
+                "Id": str(self.event_count),
+                "Name": "Event Array",
+                "Context": subscription.get("Context"),
+                "Events": [
+                    {
+                        "EventType": event_type,
+                        "EventId": str(self.event_count),
+                        "EventTimestamp": datetime.datetime.now(
+                            datetime.timezone.utc
+                        ).isoformat(),
+                        "MessageId": message_id,
+                        "OriginOfCondition": {"@odata.id": origin},
+                    }
+                ],
+            }
+            delivery = asyncio.get_running_loop().create_task(
+                self.deliver_event(subscription["Destination"], event)
+            )
+            self.event_deliveries.add(delivery)
+            delivery.add_done_callback(self.event_deliveries.discard)
+
+    async def deliver_event(self, destination, event):
+        try:
+            async with ClientSession() as client:
+                async with client.post(destination, json=event) as response:
+                    if response.status == 200:
+                        self.events_delivered += 1
+                    else:
+                        self.event_failures += 1
+        except Exception:
+            self.event_failures += 1
+
+    #
+    # Actions
+    #
+    def reset(self, reset_type):
+        system = self.resources[self.system_root]
+        if reset_type in ["On", "ForceRestart"]:
+            target_state = "On"
+        elif reset_type in ["ForceOff", "GracefulShutdown"]:
+            target_state = "Off"
+        else:
+            return False
+
+        if system["PowerState"] == target_state and reset_type != "ForceRestart":
+            self.noop_resets += 1
+        if reset_type == "GracefulShutdown" and not self.graceful_shutdown:
+            return True
+
+        def converge():
+            system["PowerState"] = target_state
+            self.send_event(
+                "StatusChange",
+                f"ResourceEvent.1.0.ResourcePowered{target_state}",
+                self.system_root,
+            )
+
+        if self.power_delay > 0:
+            asyncio.get_running_loop().call_later(self.power_delay, converge)
+        else:
+            converge()
+        return True
+
+    def add_volume(self, volumes_root, volume_id, name, drives):
+        volume_root = f"{volumes_root}/{volume_id}"
+        self.add(
+            volume_root,
+            {
+                "Name": name,
+                "VolumeType": "Mirrored",
+                "CapacityBytes": min(
+                    self.resources[drive]["CapacityBytes"] for drive in drives
+                ),
+                "Links": {"Drives": [{"@odata.id": drive} for drive in drives]},
+            },
+        )
+        self.resources[volumes_root]["Members"].append({"@odata.id": volume_root})
+        for drive in drives:
+            self.resources[drive]["Links"]["Volumes"] = [{"@odata.id": volume_root}]
+
+    def create_volume(self, volumes_root, data):
+        drives = [drive.get("@odata.id") for drive in data.get("Drives", [])]
+        if len(drives) < 1 or any(drive not in self.resources for drive in drives):
+            return None
+        volume_index = len(self.resources[volumes_root]["Members"])
+        volume_id = f"Disk.Virtual.{volume_index}:RAID.Integrated.1-1"
+
+        def complete():
+            self.add_volume(
+                volumes_root, volume_id, data.get("Name", "Virtual Disk"), drives
+            )
+
+        return self.start_task("Create Volume", complete)
+
+    def import_configuration(self, data):
+        """
+        Import a Server Configuration Profile (BIOS and iDRAC attributes, and RAID
+        virtual disk creation) via a job; returns the job URI, or None if invalid
+        """
+        try:
+            components = json.loads(data["ImportBuffer"])["SystemConfiguration"][
+                "Components"
+            ]
+        except (KeyError, TypeError, ValueError):
+            return None
+        self.scp_imports += 1
+
+        def attributes(component):
+            return {
+                attribute["Name"]: attribute["Value"]
+                for attribute in component.get("Attributes", [])
+            }
+
+        def complete():
+            for component in components:
+                if component["FQDD"] == "BIOS.Setup.1-1":
+                    merge(
+                        self.resources[f"{self.system_root}/Bios"],
+                        {"Attributes": attributes(component)},
+                    )
+                elif component["FQDD"] == "iDRAC.Embedded.1":
+                    merge(
+                        self.resources[f"{self.manager_root}/Attributes"],
+                        {
+                            "Attributes": {
+                                name.replace("#", "."): value
+                                for name, value in attributes(component).items()
+                            }
+                        },
+                    )
+                elif component["FQDD"].startswith("RAID."):
+                    storage_root = f"{self.system_root}/Storage"
+                    volumes_root = f"{storage_root}/{component['FQDD']}/Volumes"
+                    for disk in component.get("Components", []):
+                        drives = [
+                            f"{storage_root}/Drives/{attribute['Value']}"
+                            for attribute in disk.get("Attributes", [])
+                            if attribute["Name"] == "IncludedPhysicalDiskID"
+                        ]
+                        self.add_volume(
+                            volumes_root,
+                            disk["FQDD"],
+                            attributes(disk).get("Name", "Virtual Disk"),
+                            drives,
+                        )
+
+        return self.start_task("Import Configuration", complete)
+
+    def apply_settings(self, settings_root, data):
+        """
+        Apply pending settings to their resource, via a job on Dell BMCs; returns the
+        job URI, if any. Settings are pending until the job completes (there are no
+        host resets to wait for, so any apply time is treated as immediate).
+        """
+        self.settings_patches += 1
+        target_root = settings_root.rsplit("/", 1)[0]
+        attributes = data.get("Attributes", {})
+        merge(self.resources[settings_root], {"Attributes": attributes})
+
+        def complete():
+            merge(self.resources[target_root], {"Attributes": attributes})
+            self.resources[settings_root]["Attributes"] = dict()
+
+        if self.profile == "dell":
+            return self.start_task("Configure: BIOS.Setup.1-1", complete)
+        complete()
+        return None
+
+    #
+    # Request handling
+    #
+    def authorized(self, request):
+        token = request.headers.get("X-Auth-Token")
+        if token not in self.sessions:
+            return False
+        if (
+            self.session_timeout is not None
+            and monotonic() - self.session_used[token] > self.session_timeout
+        ):
+            del self.sessions[token]
+            return False
+        self.session_used[token] = monotonic()
+        return True
+
+    async def handle(self, request):
+        self.requests += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            return await self.respond(request)
+        finally:
+            self.in_flight -= 1
+
+    async def respond(self, request):
+        path = request.path.rstrip("/")
+        method = request.method
+
+        # Injected failures
+        if self.fail_paths is not None and self.fail_paths.search(path):
+            self.failures += 1
+            return error_response(500, "Base.1.8.InternalError")
+        if method in self.failure_methods and self.random.random() < self.failure_rate:
+            self.failures += 1
+            return error_response(503, "Base.1.8.ServiceTemporarilyUnavailable")
+
+        try:
+            data = await request.json() if request.can_read_body else dict()
+        except ValueError:
+            return error_response(400, "Base.1.8.MalformedJSON")
+
+        # Sessions
+        if path in ["/redfish/v1/Sessions", "/redfish/v1/SessionService/Sessions"]:
+            if method != "POST":
+                return error_response(405, "Base.1.8.OperationNotAllowed")
+            if not data.get("UserName") or not data.get("Password"):
+                return error_response(401, "Base.1.8.NoValidSession")
+            self.session_count += 1
+            token = f"token-{self.index}-{self.session_count}"
+            session_uri = f"/redfish/v1/SessionService/Sessions/{self.session_count}"
+            self.sessions[token] = session_uri
+            self.session_used[token] = monotonic()
+            return web.json_response(
+                {"@odata.id": session_uri},
+                status=201,
+                headers={"X-Auth-Token": token, "Location": session_uri},
+            )
+        if path.startswith("/redfish/v1/SessionService/Sessions/"):
+            if not self.authorized(request):
+                return error_response(401, "Base.1.8.NoValidSession")
+            for token, session_uri in list(self.sessions.items()):
+                if session_uri == path and method == "DELETE":
+                    del self.sessions[token]
+                    return web.json_response(success_message())
+                if session_uri == path and method == "GET":
+                    return web.json_response(
+                        {"@odata.id": session_uri, "UserName": "root"}
+                    )
+            return error_response(404, "Base.1.8.ResourceMissingAtURI")
+
+        if path != "/redfish/v1" and not self.authorized(request):
+            return error_response(401, "Base.1.8.NoValidSession")
+
+        # Actions and collection POSTs
+        if method == "POST":
+            if path.endswith("/Actions/ComputerSystem.Reset"):
+                if not self.reset(data.get("ResetType")):
+                    return error_response(400, "Base.1.8.ActionParameterNotSupported")
+                return web.Response(status=204)
+            if (
+                path.endswith("/Actions/Oem/EID_674_Manager.ImportSystemConfiguration")
+                and self.profile == "dell"
+            ):
+                task_root = self.import_configuration(data)
+                if task_root is None:
+                    return error_response(400, "Base.1.8.ActionParameterMissing")
+                return web.json_response(
+                    success_message(), status=202, headers={"Location": task_root}
+                )
+            if path.endswith("/Volumes") and path in self.resources:
+                task_root = self.create_volume(path, data)
+                if task_root is None:
+                    return error_response(400, "Base.1.8.PropertyValueNotInList")
+                return web.json_response(
+                    success_message(), status=202, headers={"Location": task_root}
+                )
+            if path == "/redfish/v1/EventService/Subscriptions":
+                self.subscription_count += 1
+                subscription_root = f"{path}/{self.subscription_count}"
+                self.add(subscription_root, dict(data))
+                self.resources[path]["Members"].append({"@odata.id": subscription_root})
+                return web.json_response(
+                    success_message(),
+                    status=201,
+                    headers={"Location": subscription_root},
+                )
+            return error_response(405, "Base.1.8.OperationNotAllowed")
+
+        # Resources
+        if path not in self.resources:
+            return error_response(404, "Base.1.8.ResourceMissingAtURI")
+
+        if method == "GET":
+            if path in self.tasks:
+                done = self.update_task(path)
+                if self.profile != "dell" and not done:
+                    # Task monitors answer 202 Accepted while the task is running
+                    return web.json_response(self.resources[path], status=202)
+            resource = self.query(request, self.resources[path])
+            if resource is None:
+                return error_response(400, "Base.1.8.QueryNotSupported")
+            return web.json_response(resource)
+
+        if method == "PATCH":
+            if path.endswith("/Settings"):
+                task_root = self.apply_settings(path, data)
+                if task_root is not None:
+                    return web.json_response(
+                        success_message(), status=202, headers={"Location": task_root}
+                    )
+            else:
+                merge(self.resources[path], data)
+            return web.json_response(success_message())
+
+        if method == "DELETE" and path.startswith(
+            "/redfish/v1/EventService/Subscriptions/"
+        ):
+            del self.resources[path]
+            collection = self.resources["/redfish/v1/EventService/Subscriptions"]
+            collection["Members"] = [
+                member
+                for member in collection["Members"]
+                if member["@odata.id"] != path
+            ]
+            return web.json_response(success_message())
+
+        return error_response(405, "Base.1.8.OperationNotAllowed")
+
+
+def success_message():
+    """
+    Return a successful operation message body, as iDRAC and iLO answer with
+    """
+    return {
+        "@Message.ExtendedInfo": [
+            {
+                "MessageId": "Base.1.8.Success",
+                "Message": "Successfully Completed Request",
+                "Severity": "OK",
+                "Resolution": "None",
+            }
+        ]
+    }
+
+
+def error_response(status, message_id):
+    """
+    Return a Redfish error response
+    """
+    return web.json_response(
+        {
+            "error": {
+                "code": message_id,
+                "message": "A mock error occurred",
+                "@Message.ExtendedInfo": [
+                    {
+                        "MessageId": message_id,
+                        "Message": f"The request failed with {message_id}.",
+                        "Severity": "Critical",
+                        "Resolution": "Retry the request.",
+                    }
+                ],
+            }
+        },
+        status=status,
+    )
+
+
+def merge(target, data):
+    """
+    Merge a PATCH body into a resource
+    """
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge(target[key], value)
+        else:
+            target[key] = value
+
+
+def create_ssl_context(address):
+    """
+    Create a server SSL context with a throwaway self-signed certificate, as BMCs use
+    """
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, address)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cert_file = os.path.join(tmpdir, "cert.pem")
+        key_file = os.path.join(tmpdir, "key.pem")
+        with open(cert_file, "wb") as fh:
+            fh.write(certificate.public_bytes(serialization.Encoding.PEM))
+        with open(key_file, "wb") as fh:
+            fh.write(
+                key.private_bytes(
+                    serialization.Encoding.PEM,
+                    serialization.PrivateFormat.TraditionalOpenSSL,
+                    serialization.NoEncryption(),
+                )
+            )
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(cert_file, key_file)
+    return ssl_context
+
+
+async def start_bmcs(
+    count, address="127.0.0.1", base_port=20000, tls=False, profile="generic", **options
+):
+    """
+    Start 'count' mock BMCs on consecutive ports; returns their runners and hosts
+
+    Further options are passed to each MockBMC; the MockBMC instances are available
+    as runner.app["bmc"].
+    """
+    ssl_context = create_ssl_context(address) if tls else None
+    scheme = "https" if tls else "http"
+
+    runners = list()
+    hosts = list()
+    for index in range(count):
+        app = web.Application()
+        app["bmc"] = MockBMC(index, profile=profile, **options)
+        app.router.add_route("*", "/{path:.*}", app["bmc"].handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, address, base_port + index, ssl_context=ssl_context)
+        await site.start()
+        runners.append(runner)
+        hosts.append(f"{scheme}://{address}:{base_port + index}")
+    return runners, hosts
+
+
+async def stop_bmcs(runners):
+    for runner in runners:
+        await runner.cleanup()
+
+
+async def serve(args):
+    runners, hosts = await start_bmcs(
+        args.count,
+        args.address,
+        args.base_port,
+        tls=args.tls,
+        profile=args.profile,
+        latency=args.latency,
+        jitter=args.jitter,
+        failure_rate=args.failure_rate,
+        fail_paths=args.fail_paths,
+        power_delay=args.power_delay,
+        task_duration=args.task_duration,
+        task_history=args.task_history,
+        session_timeout=args.session_timeout,
+    )
+    print(f"Serving {args.count} mock {args.profile} BMCs at {hosts[0]} to {hosts[-1]}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stop_bmcs(runners)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve mock Redfish BMCs")
+    parser.add_argument("--count", type=int, default=1, help="Number of BMCs")
+    parser.add_argument("--address", default="127.0.0.1", help="Listen address")
+    parser.add_argument("--base-port", type=int, default=20000, help="First port")
+    parser.add_argument("--tls", action="store_true", help="Serve HTTPS")
+    parser.add_argument("--profile", default="generic", choices=PROFILES)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Response delay in seconds"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="Extra random delay in seconds"
+    )
+    parser.add_argument(
+        "--failure-rate", type=float, default=0.0, help="Fraction of GETs to fail"
+    )
+    parser.add_argument("--fail-paths", default=None, help="Regex of paths to fail")
+    parser.add_argument(
+        "--power-delay", type=float, default=0.0, help="Power change delay in seconds"
+    )
+    parser.add_argument(
+        "--task-duration", type=float, default=1.0, help="Task duration in seconds"
+    )
+    parser.add_argument(
+        "--task-history", type=int, default=0, help="Completed tasks kept per BMC"
+    )
+    parser.add_argument(
+        "--session-timeout", type=float, default=None, help="Session idle expiry"
+    )
+    asyncio.run(serve(parser.parse_args()))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+# pvcbootstrapd-fleet.py - Fleet-wide BMC operations client for pvcbootstrapd
+# Part of the Parallel Virtual Cluster (PVC) system
+#
+#    Copyright (C) 2018-2021 Joshua M. Boniface <joshua@boniface.me>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Runs a power, indicator LED or boot override operation on the BMCs of a whole
+# cluster or of a list of nodes through the pvcbootstrapd API, and polls its
+# progress until every node has completed, e.g.:
+#
+#   pvcbootstrapd-fleet.py --cluster cluster1 power GracefulShutdown
+#   pvcbootstrapd-fleet.py --macaddr ff:ff:ff:01:23:45 indicator on
+#   pvcbootstrapd-fleet.py --cluster cluster1 --concurrency 4 boot Pxe
+
+import argparse
+
+from json import dumps
+from os import environ
+from sys import exit
+from time import sleep
+from requests import get, post
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fleet-wide BMC operation")
+    parser.add_argument(
+        "--api-uri",
+        default=environ.get("API_URI", "http://127.0.0.1:9999"),
+        help="The pvcbootstrapd API URI (default: $API_URI or http://127.0.0.1:9999)",
+    )
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--cluster", help="Run on all nodes of this cluster")
+    target.add_argument(
+        "--macaddr",
+        action="append",
+        dest="macaddrs",
+        help="Run on the node with this BMC MAC address (may be repeated)",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, help="Maximum number of BMCs to operate on at once"
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=2,
+        help="Seconds between polls of the operation progress (default: 2)",
+    )
+    parser.add_argument("operation", choices=["power", "indicator", "boot"])
+    parser.add_argument(
+        "value", help="Power state or ResetType, indicator state, or boot target"
+    )
+    args = parser.parse_args()
+
+    api_data = {"operation": args.operation, "value": args.value}
+    if args.cluster is not None:
+        api_data["cluster"] = args.cluster
+    else:
+        api_data["macaddrs"] = args.macaddrs
+    if args.concurrency is not None:
+        api_data["concurrency"] = args.concurrency
+
+    response = post(
+        f"{args.api_uri}/fleet",
+        headers={"ContentType": "application/json"},
+        data=dumps(api_data),
+    )
+    if response.status_code != 202:
+        print(f"Failed to start fleet operation: {response.json()['message']}")
+        exit(1)
+    fleet_id = response.json()["id"]
+    print(f"Started fleet operation {fleet_id}")
+
+    # Print each node result as it completes, then the summary
+    printed = set()
+    while True:
+        response = get(f"{args.api_uri}/fleet/{fleet_id}")
+        if response.status_code != 200:
+            print(f"Failed to get fleet operation: {response.json()['message']}")
+            exit(1)
+        progress = response.json()
+        for bmc_macaddr, result in progress["results"].items():
+            if bmc_macaddr in printed:
+                continue
+            printed.add(bmc_macaddr)
+            message = f" ({result['message']})" if result["message"] else ""
+            print(
+                f"{result['node'] or result['bmc_macaddr']}: "
+                f"{result['result']}{message}"
+            )
+        if progress["state"] == "completed":
+            break
+        sleep(args.interval)
+
+    summary = ", ".join(
+        f"{count} {result}" for result, count in progress["summary"].items()
+    )
+    print(f"Completed fleet operation on {progress['total']} nodes: {summary}")
+
+    exit(1 if progress["summary"].get("failed", 0) > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -21,16 +21,35 @@
 
 CELERY_BIN="$( which celery )"
 
-# This absolute hackery is needed because Celery got the bright idea to change how their
-# app arguments work in a non-backwards-compatible way with Celery 5.
-case "$( cat /etc/debian_version )" in
-    10.*)
-        CELERY_ARGS="worker --app pvcbootstrapd.flaskapi.celery --concurrency 99 --pool gevent --loglevel DEBUG"
-    ;;
-    *)
-        CELERY_ARGS="--app pvcbootstrapd.flaskapi.celery worker --concurrency 99 --pool gevent --loglevel DEBUG"
-    ;;
-esac
+# Start one Celery worker per workload queue (checkin, redfish, ansible, hooks, fleet), each with
+# the pool type and concurrency from the "queue" -> "workers" configuration
+WORKER_PIDS=()
+while read -r _ QUEUE POOL CONCURRENCY; do
+    # This absolute hackery is needed because Celery got the bright idea to change how their
+    # app arguments work in a non-backwards-compatible way with Celery 5.
+    case "$( cat /etc/debian_version )" in
+        10.*)
+            CELERY_ARGS="worker --app pvcbootstrapd.flaskapi.celery --queues ${QUEUE} --hostname ${QUEUE}@%h --concurrency ${CONCURRENCY} --pool ${POOL} --loglevel DEBUG"
+        ;;
+        *)
+            CELERY_ARGS="--app pvcbootstrapd.flaskapi.celery worker --queues ${QUEUE} --hostname ${QUEUE}@%h --concurrency ${CONCURRENCY} --pool ${POOL} --loglevel DEBUG"
+        ;;
+    esac
 
-${CELERY_BIN} ${CELERY_ARGS}
-exit $?
+    ${CELERY_BIN} ${CELERY_ARGS} &
+    WORKER_PIDS+=( $! )
+done < <( python3 -c 'import pvcbootstrapd.Daemon as d; d.print_queue_workers()' | grep '^worker ' )
+
+if [[ ${#WORKER_PIDS[@]} -eq 0 ]]; then
+    echo "ERROR: No worker queues defined."
+    exit 1
+fi
+
+trap 'kill ${WORKER_PIDS[@]} 2>/dev/null' TERM INT
+
+# Exit (and let systemd restart us) as soon as any one worker exits
+wait -n
+ret=$?
+kill ${WORKER_PIDS[@]} 2>/dev/null
+wait
+exit $ret
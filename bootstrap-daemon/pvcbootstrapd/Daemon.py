@@ -39,6 +39,20 @@ version = "0.1"
 # API version
 API_VERSION = 1.0
 
+# Worker queues per workload class, with their default Celery pool type and concurrency
+#   checkin: short DNSMasq and host checkin handlers
+#   redfish: long-running Redfish node initializations, mostly waiting on I/O
+#   ansible: Ansible bootstrap runs, which are CPU- and subprocess-heavy
+#   hooks: post-bootstrap hook runs
+#   fleet: fleet-wide BMC operations, which must not wait behind Redfish initializations
+queue_workers = {
+    "checkin": {"pool": "gevent", "concurrency": 16},
+    "redfish": {"pool": "gevent", "concurrency": 99},
+    "ansible": {"pool": "prefork", "concurrency": 2},
+    "hooks": {"pool": "prefork", "concurrency": 4},
+    "fleet": {"pool": "gevent", "concurrency": 4},
+}
+
 
 ##########################################################
 # Exceptions
@@ -154,6 +168,15 @@ def read_config():
                 f"Missing second-level key '{key}' under 'queue'"
             )
 
+    # Get the optional queue workers configuration
+    o_queue_workers = o_queue.get("workers", dict())
+    for queue, queue_defaults in queue_workers.items():
+        o_queue_worker = o_queue_workers.get(queue, dict())
+        for key in ["pool", "concurrency"]:
+            config[f"queue_workers_{queue}_{key}"] = o_queue_worker.get(
+                key, queue_defaults[key]
+            )
+
     # Get the DHCP configuration
     for key in [
         "address",
@@ -214,6 +237,78 @@ def read_config():
                 f"Missing third-level key '{key}' under 'ansible/cspec_files'"
             )
 
+    # Get the optional Redfish configuration
+    o_redfish = o_base.get("redfish", dict())
+    config["redfish_max_fanout"] = int(o_redfish.get("max_fanout", 4))
+    config["redfish_session_idle_timeout"] = int(
+        o_redfish.get("session_idle_timeout", 300)
+    )
+    o_redfish_ready_timeouts = o_redfish.get("ready_timeouts", dict())
+    for key, default in {
+        "service": 300,
+        "status": 300,
+        "power": 120,
+        "tasks": 600,
+        "shutdown": 900,
+    }.items():
+        config[f"redfish_ready_timeout_{key}"] = int(
+            o_redfish_ready_timeouts.get(key, default)
+        )
+    o_redfish_detect = o_redfish.get("detect", dict())
+    config["redfish_detect_timeout"] = int(o_redfish_detect.get("timeout", 300))
+    config["redfish_detect_cache_ttl"] = int(o_redfish_detect.get("cache_ttl", 86400))
+    o_redfish_retry = o_redfish.get("retry", dict())
+    for name, defaults in {
+        "request": {"attempts": 4, "base_delay": 0.5, "max_delay": 30, "deadline": 60},
+        "login": {"attempts": 60, "base_delay": 1, "max_delay": 16, "deadline": 600},
+    }.items():
+        o_redfish_retry_policy = o_redfish_retry.get(name, dict())
+        config[f"redfish_retry_{name}_attempts"] = int(
+            o_redfish_retry_policy.get("attempts", defaults["attempts"])
+        )
+        for key in ["base_delay", "max_delay", "deadline"]:
+            config[f"redfish_retry_{name}_{key}"] = float(
+                o_redfish_retry_policy.get(key, defaults[key])
+            )
+    o_redfish_circuit_breaker = o_redfish.get("circuit_breaker", dict())
+    config["redfish_circuit_breaker_threshold"] = int(
+        o_redfish_circuit_breaker.get("threshold", 5)
+    )
+    config["redfish_circuit_breaker_reset_timeout"] = int(
+        o_redfish_circuit_breaker.get("reset_timeout", 60)
+    )
+    o_redfish_dell_scp = o_redfish.get("dell_scp", dict())
+    config["redfish_dell_scp_enabled"] = bool(o_redfish_dell_scp.get("enabled", False))
+    config["redfish_dell_scp_timeout"] = int(o_redfish_dell_scp.get("timeout", 1800))
+    o_redfish_fleet = o_redfish.get("fleet", dict())
+    config["redfish_fleet_concurrency"] = int(o_redfish_fleet.get("concurrency", 16))
+    o_redfish_instrumentation = o_redfish.get("instrumentation", dict())
+    config["redfish_instrumentation_metrics"] = bool(
+        o_redfish_instrumentation.get("metrics", True)
+    )
+    config["redfish_trace_path"] = o_redfish_instrumentation.get("trace_path")
+    o_redfish_events = o_redfish.get("events", dict())
+    config["redfish_events_enabled"] = bool(o_redfish_events.get("enabled", True))
+    config["redfish_events_destination"] = o_redfish_events.get(
+        "destination",
+        f"http://{config['api_address']}:{config['api_port']}/checkin/redfish",
+    )
+
+    # Get the optional scheduler configuration; limits of 0 are unlimited
+    o_scheduler = o_base.get("scheduler", dict())
+    for slot in ["redfish_sessions", "pxe_boots", "installers"]:
+        o_scheduler_slot = o_scheduler.get(slot, dict())
+        for key in ["cluster", "total"]:
+            config[f"scheduler_{slot}_{key}"] = int(o_scheduler_slot.get(key, 0))
+    config["scheduler_power_on_interval"] = float(
+        o_scheduler.get("power_on_interval", 0)
+    )
+    config["scheduler_slot_timeout"] = int(o_scheduler.get("slot_timeout", 7200))
+
+    # Get the optional hooks configuration
+    o_hooks = o_base.get("hooks", dict())
+    config["hooks_parallelism"] = int(o_hooks.get("parallelism", 1))
+
     # Get the Notifications configuration
     for key in ["enabled", "uri", "action", "icons", "body", "completed_triggerword"]:
         try:
@@ -229,6 +324,16 @@ def read_config():
 config = read_config()
 
 
+def print_queue_workers():
+    """
+    Print the worker queue definitions for the pvcbootstrapd-worker.sh startup stub
+    """
+    for queue in queue_workers:
+        pool = config[f"queue_workers_{queue}_pool"]
+        concurrency = config[f"queue_workers_{queue}_concurrency"]
+        print(f"worker {queue} {pool} {concurrency}")
+
+
 ##########################################################
 # Entrypoint
 ##########################################################
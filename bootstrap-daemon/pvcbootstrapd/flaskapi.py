@@ -25,9 +25,15 @@ import json
 from pvcbootstrapd.Daemon import config
 
 import pvcbootstrapd.lib.lib as lib
+import pvcbootstrapd.lib.db as db
+import pvcbootstrapd.lib.events as events
+import pvcbootstrapd.lib.fleet as fleet
+import pvcbootstrapd.lib.metrics as metrics
+import pvcbootstrapd.lib.redfish as redfish
 
 from flask_restful import Resource, Api
 from celery import Celery
+from celery.signals import worker_process_shutdown, worker_shutdown
 from celery.utils.log import get_task_logger
 
 
@@ -47,10 +53,34 @@ app.config[
 celery = Celery(app.name, broker=app.config["CELERY_BROKER_URL"])
 celery.conf.update(app.config)
 
+# Route each workload class to its own queue (see queue_workers in Daemon.py), so that
+# long-running Redfish, Ansible and hook tasks cannot starve the short checkin handlers
+celery.conf.task_routes = {
+    "pvcbootstrapd.flaskapi.dnsmasq_checkin": {"queue": "checkin"},
+    "pvcbootstrapd.flaskapi.host_checkin": {"queue": "checkin"},
+    "pvcbootstrapd.flaskapi.redfish_init": {"queue": "redfish"},
+    "pvcbootstrapd.flaskapi.run_bootstrap": {"queue": "ansible"},
+    "pvcbootstrapd.flaskapi.run_hooks": {"queue": "hooks"},
+    "pvcbootstrapd.flaskapi.fleet_operation": {"queue": "fleet"},
+}
+# Tasks may run for hours, so do not let a worker reserve more than it is running
+celery.conf.worker_prefetch_multiplier = 1
+
 
 #
 # Celery functions
 #
+@worker_shutdown.connect
+@worker_process_shutdown.connect
+def close_redfish_sessions(**kwargs):
+    """
+    Log out of any pooled Redfish sessions, and write any batched metrics, when the
+    worker stops
+    """
+    redfish.close_session_pool()
+    metrics.flush_batch(config)
+
+
 @celery.task(bind=True)
 def dnsmasq_checkin(self, data):
     lib.dnsmasq_checkin(config, data)
@@ -61,6 +91,26 @@ def host_checkin(self, data):
     lib.host_checkin(config, data)
 
 
+@celery.task(bind=True)
+def redfish_init(self, data):
+    lib.redfish_init(config, data)
+
+
+@celery.task(bind=True)
+def run_bootstrap(self, cluster_name):
+    lib.run_bootstrap(config, cluster_name)
+
+
+@celery.task(bind=True)
+def run_hooks(self, cluster_name):
+    lib.run_hooks(config, cluster_name)
+
+
+@celery.task(bind=True)
+def fleet_operation(self, fleet_id, concurrency):
+    lib.fleet_operation(config, fleet_id, concurrency)
+
+
 #
 # API routes
 #
@@ -239,3 +289,296 @@ class API_Checkin_Host(Resource):
 
 
 api.add_resource(API_Checkin_Host, "/checkin/host")
+
+
+class API_Checkin_Redfish(Resource):
+    def post(self):
+        """
+        Register a checkin (event) from a Redfish BMC event subscription
+        ---
+        tags:
+          - checkin
+        consumes:
+          - application/json
+        parameters:
+          - in: body
+            name: redfish_event
+            description: A Redfish Event from a BMC event subscription.
+            schema:
+              type: object
+              required:
+                - Context
+              properties:
+                Context:
+                  type: string
+                  description: The subscription context; the MAC address of the BMC.
+                  example: "ff:ff:ff:01:23:45"
+                Events:
+                  type: array
+                  description: The event records.
+                  items:
+                    type: object
+                    properties:
+                      EventType:
+                        type: string
+                        description: The type of the event.
+                        example: "StatusChange"
+                      MessageId:
+                        type: string
+                        description: The message registry ID of the event.
+                        example: "iDRAC.2.5.SYS1003"
+                      OriginOfCondition:
+                        type: object
+                        description: A link to the resource which changed.
+        responses:
+          200:
+            description: OK
+            schema:
+              type: object
+              id: Message
+          400:
+            description: Bad request
+            schema:
+              type: object
+              id: Message
+        """
+        try:
+            data = json.loads(flask.request.data)
+            bmc_macaddr = data["Context"]
+        except Exception as e:
+            logger.warning(f"Invalid Redfish event data: {e}")
+            return {"message": "invalid Redfish event"}, 400
+        logger.info(f"Handling Redfish event from BMC {bmc_macaddr}")
+
+        # Pass the event directly to the node's Redfish initialization via its events
+        events.publish_bmc_event(config, bmc_macaddr, data)
+        return {"message": "received event from Redfish"}, 200
+
+
+api.add_resource(API_Checkin_Redfish, "/checkin/redfish")
+
+
+class API_Metrics(Resource):
+    def get(self):
+        """
+        Return the metrics recorded by the pvcbootstrapd workers
+        ---
+        tags:
+          - metrics
+        responses:
+          200:
+            description: OK
+            schema:
+              type: object
+              description: A dictionary of metric names to lists of label sets
+              additionalProperties:
+                type: array
+                items:
+                  type: object
+                  properties:
+                    labels:
+                      type: object
+                      description: The labels of this series (e.g. call site)
+                    count:
+                      type: integer
+                      description: The number of observations
+                    sum:
+                      type: number
+                      description: The sum of all observed values
+        """
+        return metrics.get_metrics(config), 200
+
+
+api.add_resource(API_Metrics, "/metrics")
+
+
+class API_Fleet(Resource):
+    def post(self):
+        """
+        Start a fleet-wide BMC operation on the nodes of a cluster or a list of BMCs
+        ---
+        tags:
+          - fleet
+        consumes:
+          - application/json
+        parameters:
+          - in: body
+            name: fleet_operation
+            description: The operation to run, and the nodes to run it on.
+            schema:
+              type: object
+              required:
+                - operation
+                - value
+              properties:
+                operation:
+                  type: string
+                  description: The operation to run.
+                  enum:
+                    - power
+                    - indicator
+                    - boot
+                  example: "power"
+                value:
+                  type: string
+                  description: The power state or ResetType, indicator state, or boot override target.
+                  example: "GracefulShutdown"
+                cluster:
+                  type: string
+                  description: The cluster to run the operation on; either this or macaddrs is required.
+                  example: "cluster1"
+                macaddrs:
+                  type: array
+                  description: The BMC MAC addresses of the nodes to run the operation on.
+                  items:
+                    type: string
+                    example: "ff:ff:ff:01:23:45"
+                concurrency:
+                  type: integer
+                  description: The maximum number of BMCs to operate on at once (capped by the configuration).
+                  example: 8
+        responses:
+          202:
+            description: Accepted
+            schema:
+              type: object
+              id: FleetOperationStarted
+              properties:
+                message:
+                  type: string
+                  description: A text message describing the result
+                id:
+                  type: string
+                  description: The ID of the fleet operation, to get its progress
+                  example: "7f6f3c9a-2b1e-4d53-9a5e-1c2b3d4e5f60"
+          400:
+            description: Bad request
+            schema:
+              type: object
+              id: Message
+          404:
+            description: Not found
+            schema:
+              type: object
+              id: Message
+        """
+        try:
+            data = json.loads(flask.request.data)
+            operation = data["operation"]
+            value = data["value"]
+        except Exception as e:
+            logger.warning(f"Invalid fleet operation data: {e}")
+            return {"message": "invalid fleet operation"}, 400
+
+        if operation not in fleet.OPERATIONS:
+            return {"message": f"unknown operation '{operation}'"}, 400
+        if (
+            fleet.OPERATIONS[operation] is not None
+            and value not in fleet.OPERATIONS[operation]
+        ):
+            return {"message": f"invalid value '{value}' for {operation}"}, 400
+
+        cluster = data.get("cluster")
+        macaddrs = data.get("macaddrs")
+        if (cluster is None) == (macaddrs is None):
+            return {"message": "exactly one of cluster or macaddrs is required"}, 400
+        if macaddrs is not None and not isinstance(macaddrs, list):
+            return {"message": "macaddrs must be a list"}, 400
+        if cluster is not None and db.get_cluster(config, name=cluster) is None:
+            return {"message": f"cluster '{cluster}' not found"}, 404
+
+        concurrency = config["redfish_fleet_concurrency"]
+        try:
+            concurrency = min(int(data.get("concurrency", concurrency)), concurrency)
+        except ValueError:
+            return {"message": "concurrency must be an integer"}, 400
+
+        progress = fleet.create_fleet_operation(
+            config, operation, value, cluster=cluster, macaddrs=macaddrs
+        )
+        logger.info(f"Starting fleet operation {progress['id']}: {operation}={value}")
+
+        task = fleet_operation.delay(progress["id"], concurrency)
+        logger.debug(task)
+        return {"message": "started fleet operation", "id": progress["id"]}, 202
+
+
+api.add_resource(API_Fleet, "/fleet")
+
+
+class API_Fleet_Element(Resource):
+    def get(self, fleet_id):
+        """
+        Return the progress and per-node results of a fleet-wide BMC operation
+        ---
+        tags:
+          - fleet
+        parameters:
+          - in: path
+            name: fleet_id
+            type: string
+            required: true
+            description: The ID of the fleet operation.
+        responses:
+          200:
+            description: OK
+            schema:
+              type: object
+              id: FleetOperation
+              properties:
+                id:
+                  type: string
+                  description: The ID of the fleet operation
+                operation:
+                  type: string
+                  description: The operation
+                value:
+                  type: string
+                  description: The operation value
+                state:
+                  type: string
+                  description: The state of the operation (pending, running, completed)
+                total:
+                  type: integer
+                  description: The number of target nodes, once running
+                completed:
+                  type: integer
+                  description: The number of target nodes completed
+                summary:
+                  type: object
+                  description: The number of nodes per result, once completed
+                results:
+                  type: object
+                  description: The result of each completed node, by BMC MAC address
+                  additionalProperties:
+                    type: object
+                    properties:
+                      bmc_macaddr:
+                        type: string
+                        description: The BMC MAC address of the node
+                      node:
+                        type: string
+                        description: The FQDN of the node
+                      result:
+                        type: string
+                        description: The result (changed, unchanged, failed)
+                      message:
+                        type: string
+                        description: The reason for a failure
+                      duration:
+                        type: number
+                        description: The time taken on the node in seconds
+          404:
+            description: Not found
+            schema:
+              type: object
+              id: Message
+        """
+        progress = fleet.get_fleet_progress(config, fleet_id)
+        if progress is None:
+            return {"message": f"fleet operation '{fleet_id}' not found"}, 404
+
+        return progress, 200
+
+
+api.add_resource(API_Fleet_Element, "/fleet/<fleet_id>")
@@ -21,6 +21,7 @@
 
 import pvcbootstrapd.lib.notifications as notifications
 import pvcbootstrapd.lib.git as git
+import pvcbootstrapd.lib.offload as offload
 
 import ansible_runner
 import tempfile
@@ -60,7 +61,10 @@ def run_bootstrap(config, cspec, cluster, nodes):
     # Run the Ansible playbooks
     with tempfile.TemporaryDirectory(prefix="pvc-ansible-bootstrap_") as pdir:
         try:
-            r = ansible_runner.run(
+            r = offload.run(
+                config,
+                "ansible.run",
+                ansible_runner.run,
                 private_data_dir=f"{pdir}",
                 inventory=inventory,
                 limit=f"{cluster.name}",
@@ -48,3 +48,38 @@ class Node:
     bmc_iapddr: str
     host_macaddr: str
     host_ipaddr: str
+
+
+@dataclass
+class NodeDiscovery:
+    """
+    The Redfish discovery of a Node, cached for later initialization attempts
+    """
+
+    id: int
+    node: str
+    phase: str
+    fingerprint: str
+    vendor: str
+    serial: str
+    manager_root: str
+    system_root: str
+    ethernet_root: str
+    bios_root: str
+    storage_root: str
+    host_macaddr: str
+    system_drive_target: str
+
+
+@dataclass
+class HardwareProfile:
+    """
+    The Redfish hardware profile of a server model, shared by all nodes of the model
+    """
+
+    id: int
+    vendor: str
+    model: str
+    topology: str
+    drive_layouts: dict
+    boot_targets: list
@@ -20,13 +20,22 @@
 ###############################################################################
 
 import os
+import json
 import sqlite3
 import contextlib
 
 import pvcbootstrapd.lib.notifications as notifications
+import pvcbootstrapd.lib.events as events
+import pvcbootstrapd.lib.offload as offload
 
-from pvcbootstrapd.lib.dataclasses import Cluster, Node
+from pvcbootstrapd.lib.dataclasses import (
+    Cluster,
+    Node,
+    NodeDiscovery,
+    HardwareProfile,
+)
 
+from time import sleep, monotonic
 from celery.utils.log import get_task_logger
 
 
@@ -46,6 +55,21 @@ def dbconn(db_path):
     conn.close()
 
 
+def dbquery(config, site, query, args=()):
+    """
+    Run a single query and return any resulting rows
+
+    SQLite calls block, so the query runs offloaded from the gevent hub.
+    """
+
+    def run_query():
+        with dbconn(config["database_path"]) as cur:
+            cur.execute(query, args)
+            return cur.fetchall()
+
+    return offload.run(config, site, run_query)
+
+
 def init_database(config):
     db_path = config["database_path"]
     if not os.path.isfile(db_path):
@@ -78,6 +102,39 @@ def init_database(config):
 
         notifications.send_webhook(config, "success", "First run: successfully initialized database")
 
+    # Tables added since; created in existing databases too
+    with dbconn(db_path) as cur:
+        # Table caching the Redfish discovery of nodes
+        # FK: node -> nodes.id
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS node_discovery
+                       (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        node INTEGER UNIQUE NOT NULL,
+                        phase TEXT NOT NULL,
+                        fingerprint TEXT NOT NULL,
+                        vendor TEXT NOT NULL,
+                        serial TEXT NOT NULL,
+                        manager_root TEXT NOT NULL,
+                        system_root TEXT NOT NULL,
+                        ethernet_root TEXT,
+                        bios_root TEXT,
+                        storage_root TEXT,
+                        host_macaddr TEXT NOT NULL,
+                        system_drive_target TEXT,
+                        CONSTRAINT node_col FOREIGN KEY (node) REFERENCES nodes(id) ON DELETE CASCADE )"""
+        )
+        # Table caching the Redfish hardware profiles of server models
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS hardware_profiles
+                       (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        vendor TEXT NOT NULL,
+                        model TEXT NOT NULL,
+                        topology TEXT NOT NULL,
+                        drive_layouts TEXT NOT NULL,
+                        boot_targets TEXT,
+                        UNIQUE (vendor, model, topology) )"""
+        )
+
 
 #
 # Cluster functions
@@ -92,9 +149,12 @@ def get_cluster(config, cid=None, name=None):
         findfield = "name"
         datafield = name
 
-    with dbconn(config["database_path"]) as cur:
-        cur.execute(f"""SELECT * FROM clusters WHERE {findfield} = ?""", (datafield,))
-        rows = cur.fetchall()
+    rows = dbquery(
+        config,
+        "db.get_cluster",
+        f"""SELECT * FROM clusters WHERE {findfield} = ?""",
+        (datafield,),
+    )
 
     if len(rows) > 0:
         row = rows[0]
@@ -105,14 +165,15 @@ def get_cluster(config, cid=None, name=None):
 
 
 def add_cluster(config, cspec, name, state):
-    with dbconn(config["database_path"]) as cur:
-        cur.execute(
-            """INSERT INTO clusters
-                        (name, state)
-                        VALUES
-                        (?, ?)""",
-            (name, state),
-        )
+    dbquery(
+        config,
+        "db.add_cluster",
+        """INSERT INTO clusters
+                    (name, state)
+                    VALUES
+                    (?, ?)""",
+        (name, state),
+    )
 
     logger.info(f"New cluster {name} added, populating bootstrap nodes from cspec")
     for bmcmac in cspec["clusters"][name]["cspec_yaml"]["bootstrap"]:
@@ -136,13 +197,14 @@ def add_cluster(config, cspec, name, state):
 
 
 def update_cluster_state(config, name, state):
-    with dbconn(config["database_path"]) as cur:
-        cur.execute(
-            """UPDATE clusters
-                        SET state = ?
-                        WHERE name = ?""",
-            (state, name),
-        )
+    dbquery(
+        config,
+        "db.update_cluster_state",
+        """UPDATE clusters
+                    SET state = ?
+                    WHERE name = ?""",
+        (state, name),
+    )
 
     return get_cluster(config, name=name)
 
@@ -165,12 +227,12 @@ def get_node(config, cluster_name, nid=None, name=None, bmc_macaddr=None):
         findfield = "name"
         datafield = name
 
-    with dbconn(config["database_path"]) as cur:
-        cur.execute(
-            f"""SELECT * FROM nodes WHERE {findfield} = ? AND cluster = ?""",
-            (datafield, cluster.id),
-        )
-        rows = cur.fetchall()
+    rows = dbquery(
+        config,
+        "db.get_node",
+        f"""SELECT * FROM nodes WHERE {findfield} = ? AND cluster = ?""",
+        (datafield, cluster.id),
+    )
 
     if len(rows) > 0:
         row = rows[0]
@@ -185,9 +247,12 @@ def get_node(config, cluster_name, nid=None, name=None, bmc_macaddr=None):
 def get_nodes_in_cluster(config, cluster_name):
     cluster = get_cluster(config, name=cluster_name)
 
-    with dbconn(config["database_path"]) as cur:
-        cur.execute("""SELECT * FROM nodes WHERE cluster = ?""", (cluster.id,))
-        rows = cur.fetchall()
+    rows = dbquery(
+        config,
+        "db.get_nodes_in_cluster",
+        """SELECT * FROM nodes WHERE cluster = ?""",
+        (cluster.id,),
+    )
 
     node_list = list()
     for row in rows:
@@ -221,23 +286,24 @@ def add_node(
 ):
     cluster = get_cluster(config, name=cluster_name)
 
-    with dbconn(config["database_path"]) as cur:
-        cur.execute(
-            """INSERT INTO nodes
-                        (cluster, state, name, nodeid, bmc_macaddr, bmc_ipaddr, host_macaddr, host_ipaddr)
-                        VALUES
-                        (?, ?, ?, ?, ?, ?, ?, ?)""",
-            (
-                cluster.id,
-                state,
-                name,
-                nodeid,
-                bmc_macaddr,
-                bmc_ipaddr,
-                host_macaddr,
-                host_ipaddr,
-            ),
-        )
+    dbquery(
+        config,
+        "db.add_node",
+        """INSERT INTO nodes
+                    (cluster, state, name, nodeid, bmc_macaddr, bmc_ipaddr, host_macaddr, host_ipaddr)
+                    VALUES
+                    (?, ?, ?, ?, ?, ?, ?, ?)""",
+        (
+            cluster.id,
+            state,
+            name,
+            nodeid,
+            bmc_macaddr,
+            bmc_ipaddr,
+            host_macaddr,
+            host_ipaddr,
+        ),
+    )
 
     return get_node(config, cluster_name, name=name)
 
@@ -245,28 +311,186 @@ def add_node(
 def update_node_state(config, cluster_name, name, state):
     cluster = get_cluster(config, name=cluster_name)
 
-    with dbconn(config["database_path"]) as cur:
-        cur.execute(
-            """UPDATE nodes
-                        SET state = ?
-                        WHERE name = ? AND cluster = ?""",
-            (state, name, cluster.id),
-        )
+    dbquery(
+        config,
+        "db.update_node_state",
+        """UPDATE nodes
+                    SET state = ?
+                    WHERE name = ? AND cluster = ?""",
+        (state, name, cluster.id),
+    )
+
+    events.publish_node_state(config, cluster_name, name, state)
 
     return get_node(config, cluster_name, name=name)
 
 
+def wait_node_state(config, cluster_name, name, state, keepalive=None, interval=60):
+    """
+    Wait for a node to reach the given state
+
+    State changes are received from update_node_state via Redis pub/sub; the database
+    is only re-read when a change is announced, or every 'interval' seconds as a
+    fallback. If provided, 'keepalive' is called at most once per 'interval'.
+    """
+    pubsub = events.subscribe_node_state(config, cluster_name, name)
+    try:
+        # Read the state only after subscribing so no change can be missed
+        node = get_node(config, cluster_name, name=name)
+        last_keepalive = monotonic()
+        while node.state != state:
+            if pubsub is not None:
+                try:
+                    pubsub.get_message(timeout=interval)
+                except Exception as e:
+                    logger.warn(f"Lost state subscription for node {name}: {e}")
+                    pubsub = None
+            else:
+                sleep(interval)
+
+            if keepalive is not None and monotonic() - last_keepalive >= interval:
+                keepalive()
+                last_keepalive = monotonic()
+
+            node = get_node(config, cluster_name, name=name)
+    finally:
+        if pubsub is not None:
+            pubsub.close()
+
+    return node
+
+
 def update_node_addresses(
     config, cluster_name, name, bmc_macaddr, bmc_ipaddr, host_macaddr, host_ipaddr
 ):
     cluster = get_cluster(config, name=cluster_name)
 
-    with dbconn(config["database_path"]) as cur:
-        cur.execute(
-            """UPDATE nodes
-                        SET bmc_macaddr = ?, bmc_ipaddr = ?, host_macaddr = ?, host_ipaddr = ?
-                        WHERE name = ? AND cluster = ?""",
-            (bmc_macaddr, bmc_ipaddr, host_macaddr, host_ipaddr, name, cluster.id),
-        )
+    dbquery(
+        config,
+        "db.update_node_addresses",
+        """UPDATE nodes
+                    SET bmc_macaddr = ?, bmc_ipaddr = ?, host_macaddr = ?, host_ipaddr = ?
+                    WHERE name = ? AND cluster = ?""",
+        (bmc_macaddr, bmc_ipaddr, host_macaddr, host_ipaddr, name, cluster.id),
+    )
 
     return get_node(config, cluster_name, name=name)
+
+
+#
+# Node discovery functions
+#
+def get_node_discovery(config, cluster_name, name):
+    node = get_node(config, cluster_name, name=name)
+    if node is None:
+        return None
+
+    rows = dbquery(
+        config,
+        "db.get_node_discovery",
+        """SELECT * FROM node_discovery WHERE node = ?""",
+        (node.id,),
+    )
+
+    if len(rows) > 0:
+        row = rows[0]
+    else:
+        return None
+
+    return NodeDiscovery(row[0], node.name, *row[2:])
+
+
+def set_node_discovery(config, cluster_name, name, discovery):
+    """
+    Store the discovery of a node, replacing any previous one
+    """
+    node = get_node(config, cluster_name, name=name)
+
+    dbquery(
+        config,
+        "db.set_node_discovery",
+        """INSERT OR REPLACE INTO node_discovery
+                    (node, phase, fingerprint, vendor, serial, manager_root, system_root, ethernet_root, bios_root, storage_root, host_macaddr, system_drive_target)
+                    VALUES
+                    (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (
+            node.id,
+            discovery.phase,
+            discovery.fingerprint,
+            discovery.vendor,
+            discovery.serial,
+            discovery.manager_root,
+            discovery.system_root,
+            discovery.ethernet_root,
+            discovery.bios_root,
+            discovery.storage_root,
+            discovery.host_macaddr,
+            discovery.system_drive_target,
+        ),
+    )
+
+    return get_node_discovery(config, cluster_name, name)
+
+
+def delete_node_discovery(config, cluster_name, name):
+    node = get_node(config, cluster_name, name=name)
+
+    dbquery(
+        config,
+        "db.delete_node_discovery",
+        """DELETE FROM node_discovery WHERE node = ?""",
+        (node.id,),
+    )
+
+
+#
+# Hardware profile functions
+#
+def get_hardware_profile(config, vendor, model, topology):
+    rows = dbquery(
+        config,
+        "db.get_hardware_profile",
+        """SELECT id, vendor, model, topology, drive_layouts, boot_targets
+                    FROM hardware_profiles
+                    WHERE vendor = ? AND model = ? AND topology = ?""",
+        (vendor, model, topology),
+    )
+
+    if len(rows) > 0:
+        row = rows[0]
+    else:
+        return None
+
+    return HardwareProfile(
+        row[0],
+        row[1],
+        row[2],
+        row[3],
+        json.loads(row[4]),
+        json.loads(row[5]) if row[5] is not None else None,
+    )
+
+
+def set_hardware_profile(config, profile):
+    """
+    Store a hardware profile, replacing any previous one for the same model
+    """
+    dbquery(
+        config,
+        "db.set_hardware_profile",
+        """INSERT OR REPLACE INTO hardware_profiles
+                    (vendor, model, topology, drive_layouts, boot_targets)
+                    VALUES
+                    (?, ?, ?, ?, ?)""",
+        (
+            profile.vendor,
+            profile.model,
+            profile.topology,
+            json.dumps(profile.drive_layouts),
+            json.dumps(profile.boot_targets)
+            if profile.boot_targets is not None
+            else None,
+        ),
+    )
+
+    return get_hardware_profile(config, profile.vendor, profile.model, profile.topology)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# events.py - PVC Cluster Auto-bootstrap event (Redis pub/sub) libraries
+# Part of the Parallel Virtual Cluster (PVC) system
+#
+#    Copyright (C) 2018-2021 Joshua M. Boniface <joshua@boniface.me>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import json
+import redis
+
+from celery.utils.log import get_task_logger
+
+
+logger = get_task_logger(__name__)
+
+
+# Redis clients, one per queue URI, so that each worker process reuses a single
+# connection pool instead of reconnecting for every event
+redis_clients = dict()
+
+
+def get_redis(config):
+    """
+    Get a (cached) Redis client for the configured queue instance
+    """
+    redis_uri = (
+        f"redis://{config['queue_address']}:{config['queue_port']}{config['queue_path']}"
+    )
+    if redis_uri not in redis_clients:
+        redis_clients[redis_uri] = redis.Redis.from_url(redis_uri)
+    return redis_clients[redis_uri]
+
+
+#
+# Node state events
+#
+def node_state_channel(cluster_name, name):
+    """
+    Return the pub/sub channel name for state changes of a node
+    """
+    return f"pvcbootstrapd:node-state:{cluster_name}:{name}"
+
+
+def publish_node_state(config, cluster_name, name, state):
+    """
+    Publish a node state change to any subscribed waiters
+
+    Failures are logged and ignored; waiters fall back to polling the database.
+    """
+    message = json.dumps({"cluster": cluster_name, "node": name, "state": state})
+    try:
+        get_redis(config).publish(node_state_channel(cluster_name, name), message)
+    except Exception as e:
+        logger.warn(f"Failed to publish state '{state}' for node {name}: {e}")
+
+
+def subscribe_node_state(config, cluster_name, name):
+    """
+    Subscribe to state changes of a node; returns a PubSub instance, or None on failure
+    """
+    try:
+        pubsub = get_redis(config).pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(node_state_channel(cluster_name, name))
+    except Exception as e:
+        logger.warn(f"Failed to subscribe to state changes for node {name}: {e}")
+        return None
+    return pubsub
+
+
+#
+# BMC (Redfish EventService) events
+#
+def bmc_event_channel(bmc_macaddr):
+    """
+    Return the pub/sub channel name for Redfish events from a BMC
+    """
+    return f"pvcbootstrapd:bmc-events:{bmc_macaddr}"
+
+
+def publish_bmc_event(config, bmc_macaddr, event):
+    """
+    Publish a Redfish event received from a BMC to any subscribed waiters
+
+    Failures are logged and ignored; waiters fall back to polling the BMC.
+    """
+    try:
+        get_redis(config).publish(bmc_event_channel(bmc_macaddr), json.dumps(event))
+    except Exception as e:
+        logger.warn(f"Failed to publish Redfish event from BMC {bmc_macaddr}: {e}")
+
+
+def subscribe_bmc_events(config, bmc_macaddr):
+    """
+    Subscribe to Redfish events from a BMC; returns a PubSub instance, or None on error
+    """
+    try:
+        pubsub = get_redis(config).pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(bmc_event_channel(bmc_macaddr))
+    except Exception as e:
+        logger.warn(f"Failed to subscribe to events from BMC {bmc_macaddr}: {e}")
+        return None
+    return pubsub
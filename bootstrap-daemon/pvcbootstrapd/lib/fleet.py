@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+# fleet.py - PVC Cluster Auto-bootstrap fleet-wide BMC operations
+# Part of the Parallel Virtual Cluster (PVC) system
+#
+#    Copyright (C) 2018-2021 Joshua M. Boniface <joshua@boniface.me>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import json
+import threading
+import uuid
+
+import pvcbootstrapd.lib.db as db
+import pvcbootstrapd.lib.events as events
+import pvcbootstrapd.lib.metrics as metrics
+import pvcbootstrapd.lib.redfish as redfish
+
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from celery.utils.log import get_task_logger
+
+
+logger = get_task_logger(__name__)
+
+
+# Fleet operations and their progress are stored in Redis so that the API can report
+# on operations run by any worker; they expire a day after their last update
+FLEET_PREFIX = "pvcbootstrapd:fleet:"
+FLEET_TTL = 86400
+
+# The operations which may be run across a fleet, and the values they accept (None for
+# any value, which the BMC validates itself)
+OPERATIONS = {
+    "power": [
+        "on",
+        "off",
+        "On",
+        "ForceOn",
+        "ForceOff",
+        "GracefulShutdown",
+        "ForceRestart",
+        "GracefulRestart",
+        "PowerCycle",
+    ],
+    "indicator": ["on", "off"],
+    "boot": None,
+}
+
+
+#
+# Progress functions
+#
+def fleet_key(fleet_id):
+    return f"{FLEET_PREFIX}{fleet_id}"
+
+
+def get_fleet_progress(config, fleet_id):
+    """
+    Get the progress of a fleet operation; returns None if it is unknown or expired
+    """
+    progress = events.get_redis(config).get(fleet_key(fleet_id))
+    if progress is None:
+        return None
+    return json.loads(progress)
+
+
+def set_fleet_progress(config, progress):
+    events.get_redis(config).set(
+        fleet_key(progress["id"]), json.dumps(progress), ex=FLEET_TTL
+    )
+
+
+def create_fleet_operation(config, operation, value, cluster=None, macaddrs=None):
+    """
+    Record a new (pending) fleet operation, to be run by run_fleet_operation
+    """
+    progress = {
+        "id": str(uuid.uuid4()),
+        "operation": operation,
+        "value": value,
+        "cluster": cluster,
+        "macaddrs": macaddrs,
+        "state": "pending",
+        "total": None,
+        "completed": 0,
+        "results": dict(),
+    }
+    set_fleet_progress(config, progress)
+    return progress
+
+
+#
+# Target functions
+#
+def get_fleet_targets(config, cspec, cluster=None, macaddrs=None):
+    """
+    Get the nodes targeted by a fleet operation, by cluster or by BMC MAC address
+
+    Returns a list of (bmc_macaddr, cspec_node, node) tuples, where cspec_node or node
+    is None if the node is not in the bootstrap map or has not checked in yet.
+    """
+    if macaddrs is None:
+        macaddrs = [
+            bmc_macaddr
+            for bmc_macaddr, cspec_node in cspec["bootstrap"].items()
+            if cspec_node["node"]["cluster"] == cluster
+        ]
+
+    targets = list()
+    for bmc_macaddr in macaddrs:
+        cspec_node = cspec["bootstrap"].get(bmc_macaddr)
+        node = None
+        if cspec_node is not None:
+            node_cluster = cspec_node["node"]["cluster"]
+            if db.get_cluster(config, name=node_cluster) is not None:
+                node = db.get_node(config, node_cluster, bmc_macaddr=bmc_macaddr)
+        targets.append((bmc_macaddr, cspec_node, node))
+    return targets
+
+
+#
+# Operation functions
+#
+def get_system(config, session, cspec_node):
+    """
+    Get the Redfish vendor and system root of a node, from its cached discovery if any
+    """
+    discovery = db.get_node_discovery(
+        config, cspec_node["node"]["cluster"], cspec_node["node"]["hostname"]
+    )
+    if discovery is not None:
+        return discovery.vendor, discovery.system_root
+
+    redfish_base_detail = session.get("/redfish/v1")
+    redfish_vendor = list(redfish_base_detail["Oem"].keys())[0]
+    systems_base_root = redfish_base_detail["Systems"]["@odata.id"].rstrip("/")
+    systems_base_detail = session.get(systems_base_root)
+    system_root = systems_base_detail["Members"][0]["@odata.id"].rstrip("/")
+    return redfish_vendor, system_root
+
+
+def run_node_operation(config, session, cspec_node, operation, value):
+    """
+    Run one fleet operation on a node; returns "changed", "unchanged" or "failed"
+    """
+    redfish_vendor, system_root = get_system(config, session, cspec_node)
+    session.vendor = redfish_vendor
+
+    if operation == "power":
+        result = redfish.set_power_state(session, system_root, redfish_vendor, value)
+        if result is None:
+            return "unchanged"
+    elif operation == "indicator":
+        result = redfish.set_indicator_state(
+            session, system_root, redfish_vendor, value
+        )
+        if result is None:
+            return "unchanged"
+    elif operation == "boot":
+        result = redfish.set_boot_override(session, system_root, redfish_vendor, value)
+
+    return "changed" if result else "failed"
+
+
+def run_fleet_target(config, operation, value, bmc_macaddr, cspec_node, node):
+    """
+    Run a fleet operation on one target node, and return its result entry
+    """
+    result = {
+        "bmc_macaddr": bmc_macaddr,
+        "node": None,
+        "result": "failed",
+        "message": None,
+        "duration": 0,
+    }
+    if cspec_node is None:
+        result["message"] = "not in the bootstrap map"
+        return result
+    result["node"] = cspec_node["node"]["fqdn"]
+    if node is None or not node.bmc_iapddr:
+        result["message"] = "no known BMC address; the node has not checked in"
+        return result
+
+    start = monotonic()
+    bmc_host = f"https://{node.bmc_iapddr}"
+    try:
+        with redfish.get_session_pool(config).session(
+            bmc_host,
+            cspec_node["bmc"]["username"],
+            cspec_node["bmc"]["password"],
+            max_fanout=config["redfish_max_fanout"],
+        ) as session:
+            if session is None:
+                result["message"] = f"failed to log in to Redfish at {bmc_host}"
+            else:
+                result["result"] = run_node_operation(
+                    config, session, cspec_node, operation, value
+                )
+                if result["result"] == "failed":
+                    result["message"] = f"the BMC did not accept {operation} {value}"
+    except Exception as e:
+        logger.warn(f"Fleet operation {operation} failed on {bmc_host}: {e}")
+        result["message"] = str(e)
+    result["duration"] = round(monotonic() - start, 3)
+    return result
+
+
+def run_fleet_operation(config, cspec, fleet_id, concurrency):
+    """
+    Run a recorded fleet operation across its target nodes, at most 'concurrency' at
+    once, recording the result of each node in its progress as it completes, for
+    clients to poll
+    """
+    progress = get_fleet_progress(config, fleet_id)
+    if progress is None:
+        logger.error(f"Fleet operation {fleet_id} is unknown or expired")
+        return
+
+    operation = progress["operation"]
+    value = progress["value"]
+    targets = get_fleet_targets(
+        config, cspec, cluster=progress["cluster"], macaddrs=progress["macaddrs"]
+    )
+    logger.info(
+        f"Running fleet operation {operation}={value} on {len(targets)} nodes, "
+        f"{concurrency} at once"
+    )
+
+    progress["state"] = "running"
+    progress["total"] = len(targets)
+    set_fleet_progress(config, progress)
+
+    lock = threading.Lock()
+
+    def run_target(target):
+        result = run_fleet_target(config, operation, value, *target)
+        metrics.increment(
+            config,
+            "redfish_fleet_operations_total",
+            operation=operation,
+            result=result["result"],
+        )
+        with lock:
+            progress["results"][result["bmc_macaddr"]] = result
+            progress["completed"] += 1
+            set_fleet_progress(config, progress)
+
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        # Consume the results so that any unexpected exception is raised here
+        list(executor.map(run_target, targets))
+
+    summary = dict()
+    for result in progress["results"].values():
+        summary[result["result"]] = summary.get(result["result"], 0) + 1
+    progress["state"] = "completed"
+    progress["summary"] = summary
+    set_fleet_progress(config, progress)
+    logger.info(f"Completed fleet operation {operation}={value}: {summary}")
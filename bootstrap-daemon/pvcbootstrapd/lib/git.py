@@ -25,6 +25,7 @@ import yaml
 from filelock import FileLock
 
 import pvcbootstrapd.lib.notifications as notifications
+import pvcbootstrapd.lib.offload as offload
 
 from celery.utils.log import get_task_logger
 
@@ -57,6 +58,7 @@ def init_repository(config):
         print(f"Error: {e}")
 
 
+@offload.blocking("git.pull_repository")
 def pull_repository(config):
     """
     Pull (with rebase) the Ansible git repository
@@ -77,6 +79,7 @@ def pull_repository(config):
     logger.info("Completed repository synchonization")
 
 
+@offload.blocking("git.commit_repository")
 def commit_repository(config, message="Generic commit"):
     """
     Commit uncommitted changes to the Ansible git repository
@@ -106,6 +109,7 @@ def commit_repository(config, message="Generic commit"):
             notifications.send_webhook(config, "failure", "Failed to commit to Git repository")
 
 
+@offload.blocking("git.push_repository")
 def push_repository(config):
     """
     Push changes to the default remote
@@ -125,6 +129,7 @@ def push_repository(config):
             notifications.send_webhook(config, "failure", "Failed to push Git repository")
 
 
+@offload.blocking("git.load_cspec_yaml")
 def load_cspec_yaml(config):
     """
     Load the bootstrap group_vars for all known clusters
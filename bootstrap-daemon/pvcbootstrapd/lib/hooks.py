@@ -21,23 +21,138 @@
 
 import pvcbootstrapd.lib.notifications as notifications
 import pvcbootstrapd.lib.db as db
+import pvcbootstrapd.lib.offload as offload
+import pvcbootstrapd.lib.metrics as metrics
 
 import json
 import tempfile
 import paramiko
 import contextlib
 import requests
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from re import match
-from time import sleep
+from time import monotonic, sleep
 from celery.utils.log import get_task_logger
 
 
 logger = get_task_logger(__name__)
 
 
+class SSHConnectionPool:
+    """
+    A pool of SSH connections to the nodes, keyed by node address, which lasts for one
+    hook run (see run_hooks) and is passed to each hook function of the run
+
+    Each node has one connected client, shared by all hooks and threads which use the
+    node; paramiko multiplexes their command channels and SFTP sessions over its one
+    transport, so a node is only connected to and authenticated with once per run:
+
+        with connection_pool.connection(node_address) as c:
+            stdin, stdout, stderr = c.exec_command(command)
+
+    Connections are checked before each use, and connected again if they were closed.
+    The time spent connecting is recorded as the "hooks_ssh_connect_seconds" metric.
+    """
+
+    def __init__(self, config, keepalive=30):
+        self.config = config
+        self.keepalive = keepalive
+        self.clients = dict()
+        self.locks = dict()
+        self.lock = threading.Lock()
+        self.connects = 0
+        self.connect_seconds = 0
+        self.leases = 0
+
+    @contextlib.contextmanager
+    def connection(self, node_address):
+        yield self.acquire(node_address)
+
+    def acquire(self, node_address):
+        """
+        Get the connected client of a node, connecting to it if required
+        """
+        with self.lock:
+            node_lock = self.locks.setdefault(node_address, threading.Lock())
+            self.leases += 1
+
+        # Only one thread (re)connects to a node, and the others then share its client
+        with node_lock:
+            ssh_client = self.clients.get(node_address)
+            if ssh_client is not None:
+                if self.check(ssh_client):
+                    metrics.increment(
+                        self.config, "hooks_ssh_connections_total", result="reused"
+                    )
+                    return ssh_client
+                logger.info(f"SSH connection to {node_address} was lost; reconnecting")
+                ssh_client.close()
+                result = "reconnected"
+            else:
+                result = "connected"
+
+            ssh_client = self.connect(node_address)
+            self.clients[node_address] = ssh_client
+            metrics.increment(self.config, "hooks_ssh_connections_total", result=result)
+            return ssh_client
+
+    def connect(self, node_address):
+        start = monotonic()
+        ssh_client = paramiko.SSHClient()
+        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh_client.connect(
+            hostname=node_address,
+            username=self.config["deploy_username"],
+            key_filename=self.config["ansible_key_file"],
+        )
+        # Keep the connection open through the long waits between some hooks
+        ssh_client.get_transport().set_keepalive(self.keepalive)
+        elapsed = monotonic() - start
+
+        with self.lock:
+            self.connects += 1
+            self.connect_seconds += elapsed
+        metrics.observe(self.config, "hooks_ssh_connect_seconds", elapsed)
+        logger.debug(f"Connected to {node_address} over SSH in {elapsed:.3f}s")
+        return ssh_client
+
+    def check(self, ssh_client):
+        """
+        Check that a client is still connected, by sending a keepalive on its transport
+        """
+        transport = ssh_client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return transport.is_active()
+
+    def close(self):
+        """
+        Close all connections, and log how many were made for how many uses
+        """
+        with self.lock:
+            clients = list(self.clients.values())
+            self.clients = dict()
+        for ssh_client in clients:
+            ssh_client.close()
+        logger.info(
+            f"Made {self.connects} SSH connections in {self.connect_seconds:.3f}s "
+            f"for {self.leases} uses"
+        )
+
+
 @contextlib.contextmanager
-def run_paramiko(config, node_address):
+def run_paramiko(config, node_address, connection_pool=None):
+    if connection_pool is not None:
+        with connection_pool.connection(node_address) as ssh_client:
+            yield ssh_client
+        return
+
     ssh_client = paramiko.SSHClient()
     ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     ssh_client.connect(
@@ -49,11 +164,46 @@ def run_paramiko(config, node_address):
     ssh_client.close()
 
 
-def run_hook_osddb(config, targets, args):
+def run_targets(targets, run_node, parallelism=1):
+    """
+    Run a hook on each target node with run_node(node), which returns the node's exit
+    status, on at most 'parallelism' nodes at once
+
+    Returns the highest exit status of all nodes (an exception counts as 1), so that
+    the hook fails if it failed on any node; failed nodes are logged.
+    """
+    if len(targets) < 1:
+        return 0
+
+    def run_target(node):
+        try:
+            return run_node(node)
+        except Exception as e:
+            logger.warning(f"Hook failed on node {node.name}: {e}")
+            return 1
+
+    max_workers = max(min(parallelism, len(targets)), 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        statuses = list(executor.map(run_target, targets))
+
+    failed = [
+        f"{node.name} ({status})"
+        for node, status in zip(targets, statuses)
+        if status != 0
+    ]
+    if len(failed) > 0:
+        logger.warning(
+            f"Hook failed on {len(failed)} of {len(targets)} nodes: {', '.join(failed)}"
+        )
+    return max(statuses)
+
+
+def run_hook_osddb(config, targets, args, parallelism=1, connection_pool=None):
     """
     Add an OSD DB defined by args['disk']
     """
-    for node in targets:
+
+    def run_node(node):
         node_name = node.name
         node_address = node.host_ipaddr
 
@@ -65,18 +215,21 @@ def run_hook_osddb(config, targets, args):
         # complexities of determining a valid API listen address, etc.
         pvc_cmd_string = f"pvc storage osd create-db-vg --yes {node_name} {device}"
 
-        with run_paramiko(config, node_address) as c:
+        with run_paramiko(config, node_address, connection_pool) as c:
             stdin, stdout, stderr = c.exec_command(pvc_cmd_string)
-            logger.debug(stdout.readlines())
-            logger.debug(stderr.readlines())
+            logger.debug(f"{node_name}: {stdout.readlines()}")
+            logger.debug(f"{node_name}: {stderr.readlines()}")
         return stdout.channel.recv_exit_status()
 
+    return run_targets(targets, run_node, parallelism)
 
-def run_hook_osd(config, targets, args):
+
+def run_hook_osd(config, targets, args, parallelism=1, connection_pool=None):
     """
     Add an OSD defined by args['disk'] with weight args['weight']
     """
-    for node in targets:
+
+    def run_node(node):
         node_name = node.name
         node_address = node.host_ipaddr
 
@@ -96,14 +249,16 @@ def run_hook_osd(config, targets, args):
         if ext_db_flag:
             pvc_cmd_string = f"{pvc_cmd_string} --ext-db --ext-db-ratio {ext_db_ratio}"
 
-        with run_paramiko(config, node_address) as c:
+        with run_paramiko(config, node_address, connection_pool) as c:
             stdin, stdout, stderr = c.exec_command(pvc_cmd_string)
-            logger.debug(stdout.readlines())
-            logger.debug(stderr.readlines())
+            logger.debug(f"{node_name}: {stdout.readlines()}")
+            logger.debug(f"{node_name}: {stderr.readlines()}")
         return stdout.channel.recv_exit_status()
 
+    return run_targets(targets, run_node, parallelism)
+
 
-def run_hook_pool(config, targets, args):
+def run_hook_pool(config, targets, args, parallelism=1, connection_pool=None):
     """
     Add an pool defined by args['name'] on device tier args['tier']
     """
@@ -124,7 +279,7 @@ def run_hook_pool(config, targets, args):
         # complexities of determining a valid API listen address, etc.
         pvc_cmd_string = f"pvc storage pool add {name} {pgs} --replcfg {replcfg}"
 
-        with run_paramiko(config, node_address) as c:
+        with run_paramiko(config, node_address, connection_pool) as c:
             stdin, stdout, stderr = c.exec_command(pvc_cmd_string)
             logger.debug(stdout.readlines())
             logger.debug(stderr.readlines())
@@ -133,7 +288,7 @@ def run_hook_pool(config, targets, args):
         return stdout.channel.recv_exit_status()
 
 
-def run_hook_network(config, targets, args):
+def run_hook_network(config, targets, args, parallelism=1, connection_pool=None):
     """
     Add an network defined by args (many)
     """
@@ -188,7 +343,7 @@ def run_hook_network(config, targets, args):
 
         logger.info(f"Creating network on node {node_name} VNI {vni} type {nettype}")
 
-        with run_paramiko(config, node_address) as c:
+        with run_paramiko(config, node_address, connection_pool) as c:
             stdin, stdout, stderr = c.exec_command(pvc_cmd_string)
             logger.debug(stdout.readlines())
             logger.debug(stderr.readlines())
@@ -197,11 +352,12 @@ def run_hook_network(config, targets, args):
         return stdout.channel.recv_exit_status()
 
 
-def run_hook_copy(config, targets, args):
+def run_hook_copy(config, targets, args, parallelism=1, connection_pool=None):
     """
     Copy a file from the local machine to the target(s)
     """
-    for node in targets:
+
+    def run_node(node):
         node_name = node.name
         node_address = node.host_ipaddr
 
@@ -211,7 +367,7 @@ def run_hook_copy(config, targets, args):
 
         logger.info(f"Copying file {source} to node {node_name}:{destination}")
 
-        with run_paramiko(config, node_address) as c:
+        with run_paramiko(config, node_address, connection_pool) as c:
             for sfile, dfile, dmode in zip(source, destination, mode):
                 if not match(r"^/", sfile):
                     sfile = f"{config['ansible_path']}/{sfile}"
@@ -219,16 +375,17 @@ def run_hook_copy(config, targets, args):
                 tc.put(sfile, dfile)
                 tc.chmod(dfile, int(dmode, 8))
                 tc.close()
+        return 0
 
-    return 0
+    return run_targets(targets, run_node, parallelism)
 
 
-def run_hook_script(config, targets, args):
+def run_hook_script(config, targets, args, parallelism=1, connection_pool=None):
     """
     Run a script on the targets
     """
-    return_status = 0
-    for node in targets:
+
+    def run_node(node):
         node_name = node.name
         node_address = node.host_ipaddr
 
@@ -240,7 +397,7 @@ def run_hook_script(config, targets, args):
 
         logger.info(f"Running script on node {node_name}")
 
-        with run_paramiko(config, node_address) as c:
+        with run_paramiko(config, node_address, connection_pool) as c:
             if script is not None:
                 remote_path = "/tmp/pvcbootstrapd.hook"
                 with tempfile.NamedTemporaryFile(mode="w") as tf:
@@ -253,12 +410,12 @@ def run_hook_script(config, targets, args):
                     tc.chmod(remote_path, 0o755)
                     tc.close()
             elif source == "local":
+                if path is None:
+                    return 0
                 if not match(r"^/", path):
                     path = config["ansible_path"] + "/" + path
 
                 remote_path = "/tmp/pvcbootstrapd.hook"
-                if path is None:
-                    continue
 
                 tc = c.open_sftp()
                 tc.put(path, remote_path)
@@ -276,15 +433,14 @@ def run_hook_script(config, targets, args):
                 remote_command = f"sudo {remote_command}"
 
             stdin, stdout, stderr = c.exec_command(remote_command)
-            logger.debug(stdout.readlines())
-            logger.debug(stderr.readlines())
-            if stdout.channel.recv_exit_status() != 0:
-                return_status = stdout.channel.recv_exit_status()
+            logger.debug(f"{node_name}: {stdout.readlines()}")
+            logger.debug(f"{node_name}: {stderr.readlines()}")
+            return stdout.channel.recv_exit_status()
 
-    return return_status
+    return run_targets(targets, run_node, parallelism)
 
 
-def run_hook_webhook(config, targets, args):
+def run_hook_webhook(config, targets, args, parallelism=1, connection_pool=None):
     """
     Send an HTTP requests (no targets)
     """
@@ -335,35 +491,62 @@ def run_hooks(config, cspec, cluster, nodes):
 
     cluster_nodes = db.get_nodes_in_cluster(config, cluster.name)
 
-    for hook in cluster_hooks:
-        hook_target = hook.get("target", "all")
-        hook_name = hook.get("name")
-        logger.info(f"Running hook on {hook_target}: {hook_name}")
-
-        if "all" in hook_target:
-            target_nodes = cluster_nodes
-        else:
-            target_nodes = [node for node in cluster_nodes if node.name in hook_target]
+    # Hooks share one SSH connection to each node for the whole run; the pool is passed
+    # to each hook, since concurrent hook runs each have their own
+    connection_pool = SSHConnectionPool(config)
 
-        hook_type = hook.get("type")
-        hook_args = hook.get("args")
+    try:
+        for hook in cluster_hooks:
+            hook_target = hook.get("target", "all")
+            hook_name = hook.get("name")
+            logger.info(f"Running hook on {hook_target}: {hook_name}")
 
-        if hook_type is None or hook_args is None:
-            logger.warning("Invalid hook: missing required configuration")
-            continue
-
-        # Run the hook function
-        try:
-            notifications.send_webhook(config, "begin", f"Cluster {cluster.name}: Running hook task '{hook_name}'")
-            retcode = hook_functions[hook_type](config, target_nodes, hook_args)
-            if retcode > 0:
-                raise Exception(f"Hook returned with code {retcode}")
-            notifications.send_webhook(config, "success", f"Cluster {cluster.name}: Completed hook task '{hook_name}'")
-        except Exception as e:
-            logger.warning(f"Error running hook: {e}")
-            notifications.send_webhook(config, "failure", f"Cluster {cluster.name}: Failed hook task '{hook_name}' with error '{e}'")
-
-        # Wait 5s between hooks
-        sleep(5)
+            if "all" in hook_target:
+                target_nodes = cluster_nodes
+            else:
+                target_nodes = [
+                    node for node in cluster_nodes if node.name in hook_target
+                ]
+
+            hook_type = hook.get("type")
+            hook_args = hook.get("args")
+
+            if hook_type is None or hook_args is None:
+                logger.warning("Invalid hook: missing required configuration")
+                continue
+
+            # Run the hook function
+            try:
+                notifications.send_webhook(config, "begin", f"Cluster {cluster.name}: Running hook task '{hook_name}'")
+                try:
+                    hook_parallelism = int(hook.get("parallelism", config["hooks_parallelism"]))
+                except (TypeError, ValueError):
+                    hook_parallelism = 0
+                if hook_parallelism < 1:
+                    raise Exception(f"Invalid parallelism '{hook.get('parallelism')}'; must be a positive integer")
+                # Hooks block on SSH sessions, SFTP transfers and HTTP requests, so
+                # run the whole hook offloaded from the gevent hub; it runs on up to
+                # hook_parallelism target nodes at once
+                retcode = offload.run(
+                    config,
+                    f"hooks.{hook_type}",
+                    hook_functions[hook_type],
+                    config,
+                    target_nodes,
+                    hook_args,
+                    parallelism=hook_parallelism,
+                    connection_pool=connection_pool,
+                )
+                if retcode > 0:
+                    raise Exception(f"Hook returned with code {retcode}")
+                notifications.send_webhook(config, "success", f"Cluster {cluster.name}: Completed hook task '{hook_name}'")
+            except Exception as e:
+                logger.warning(f"Error running hook: {e}")
+                notifications.send_webhook(config, "failure", f"Cluster {cluster.name}: Failed hook task '{hook_name}' with error '{e}'")
+
+            # Wait 5s between hooks
+            sleep(5)
+    finally:
+        connection_pool.close()
 
     notifications.send_webhook(config, "success", f"Cluster {cluster.name}: Completed post-setup hook tasks")
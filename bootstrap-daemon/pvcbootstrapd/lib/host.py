@@ -20,6 +20,7 @@
 ###############################################################################
 
 import pvcbootstrapd.lib.db as db
+import pvcbootstrapd.lib.scheduler as scheduler
 
 from celery.utils.log import get_task_logger
 
@@ -53,6 +54,9 @@ def installer_init(config, cspec, data):
     node = db.get_node(config, cspec_cluster, name=cspec_hostname)
     logger.debug(node)
 
+    # The installer has booted, so its PXE boot slot is free again
+    scheduler.release_slot(config, "pxe_boots", cspec_cluster, bmc_macaddr)
+
 
 def installer_complete(config, cspec, data):
     bmc_macaddr = data["bmc_macaddr"]
@@ -63,6 +67,10 @@ def installer_complete(config, cspec, data):
     node = db.get_node(config, cspec_cluster, name=cspec_hostname)
     logger.debug(node)
 
+    # The installer has completed, so release its slots
+    scheduler.release_slot(config, "pxe_boots", cspec_cluster, bmc_macaddr)
+    scheduler.release_slot(config, "installers", cspec_cluster, bmc_macaddr)
+
 
 def set_boot_state(config, cspec, data, state):
     bmc_macaddr = data["bmc_macaddr"]
@@ -26,14 +26,24 @@ import pvcbootstrapd.lib.redfish as redfish
 import pvcbootstrapd.lib.host as host
 import pvcbootstrapd.lib.ansible as ansible
 import pvcbootstrapd.lib.hooks as hooks
+import pvcbootstrapd.lib.scheduler as scheduler
+import pvcbootstrapd.lib.fleet as fleet
 
 from time import sleep
+from celery import current_app
 from celery.utils.log import get_task_logger
 
 
 logger = get_task_logger(__name__)
 
 
+def dispatch_task(name, *args):
+    """
+    Dispatch a follow-up Celery task by name; it is routed to its own workload queue
+    """
+    current_app.send_task(f"pvcbootstrapd.flaskapi.{name}", args=args)
+
+
 #
 # Worker Functions - Checkins (Celery root tasks)
 #
@@ -81,7 +91,7 @@ def dnsmasq_checkin(config, data):
 
         logger.info(f"Is device '{data['macaddr']}' Redfish capable? {is_redfish}")
         if is_redfish:
-            redfish.redfish_init(config, cspec, data)
+            dispatch_task("redfish_init", data)
 
         return
 
@@ -131,9 +141,9 @@ def host_checkin(config, data):
         # Continue once all nodes are in the booted-initial state
         logger.info(f"Ready: {len(ready_nodes)}  All: {len(all_nodes)}")
         if len(ready_nodes) >= len(all_nodes):
-            cluster = db.update_cluster_state(config, cspec_cluster, "ansible-running")
+            db.update_cluster_state(config, cspec_cluster, "ansible-running")
 
-            ansible.run_bootstrap(config, cspec, cluster, ready_nodes)
+            dispatch_task("run_bootstrap", cspec_cluster)
 
     elif data["action"] in ["system-boot_configured"]:
         # Node has been booted after Ansible run and can begin hook runs
@@ -150,13 +160,62 @@ def host_checkin(config, data):
         # Continue once all nodes are in the booted-configured state
         logger.info(f"Ready: {len(ready_nodes)}  All: {len(all_nodes)}")
         if len(ready_nodes) >= len(all_nodes):
-            cluster = db.update_cluster_state(config, cspec_cluster, "hooks-running")
+            db.update_cluster_state(config, cspec_cluster, "hooks-running")
+
+            dispatch_task("run_hooks", cspec_cluster)
+
+
+#
+# Worker Functions - Long-running stages (Celery tasks on dedicated queues)
+#
+def redfish_init(config, data):
+    """
+    Initialize a Redfish-capable node
+    """
+    cspec = git.load_cspec_yaml(config)
+    cspec_cluster = cspec["bootstrap"][data["macaddr"]]["node"]["cluster"]
+    try:
+        redfish.redfish_init(config, cspec, data)
+    finally:
+        # Free any deployment slots still held if the initialization aborted
+        scheduler.release_all_slots(config, cspec_cluster, data["macaddr"])
+
+
+def run_bootstrap(config, cluster_name):
+    """
+    Run the Ansible bootstrap of a cluster once all nodes have booted
+    """
+    cspec = git.load_cspec_yaml(config)
+    cluster = db.get_cluster(config, name=cluster_name)
+    nodes = db.get_nodes_in_cluster(config, cluster_name)
+
+    ansible.run_bootstrap(config, cspec, cluster, nodes)
+
+
+def run_hooks(config, cluster_name):
+    """
+    Run the post-bootstrap hooks of a cluster and complete its deployment
+    """
+    cspec = git.load_cspec_yaml(config)
+    cluster = db.get_cluster(config, name=cluster_name)
+    nodes = db.get_nodes_in_cluster(config, cluster_name)
 
-            hooks.run_hooks(config, cspec, cluster, ready_nodes)
+    hooks.run_hooks(config, cspec, cluster, nodes)
 
-            host.set_completed(config, cspec, cspec_cluster)
+    host.set_completed(config, cspec, cluster_name)
 
-            # Hosts will now power down ready for real activation in production
-            sleep(300)
-            cluster = db.update_cluster_state(config, cspec_cluster, "completed")
-            notifications.send_webhook(config, "completed", f"Cluster {cspec_cluster}: PVC bootstrap deployment completed")
+    # Hosts will now power down ready for real activation in production
+    sleep(300)
+    db.update_cluster_state(config, cluster_name, "completed")
+    notifications.send_webhook(config, "completed", f"Cluster {cluster_name}: PVC bootstrap deployment completed")
+
+
+#
+# Worker Functions - Fleet operations (Celery tasks on the Redfish queue)
+#
+def fleet_operation(config, fleet_id, concurrency):
+    """
+    Run a fleet-wide BMC operation created through the API
+    """
+    cspec = git.load_cspec_yaml(config)
+    fleet.run_fleet_operation(config, cspec, fleet_id, concurrency)
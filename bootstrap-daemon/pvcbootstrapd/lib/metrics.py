@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+# metrics.py - PVC Cluster Auto-bootstrap metrics libraries
+# Part of the Parallel Virtual Cluster (PVC) system
+#
+#    Copyright (C) 2018-2021 Joshua M. Boniface <joshua@boniface.me>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import threading
+
+import pvcbootstrapd.lib.events as events
+
+from time import monotonic
+from celery.utils.log import get_task_logger
+
+
+logger = get_task_logger(__name__)
+
+
+# Metrics are stored in Redis so that all worker processes share them. Each metric is a
+# hash keyed by its label set, holding a count and a sum of the observed values.
+METRICS_PREFIX = "pvcbootstrapd:metrics:"
+
+# Observations of frequent metrics (see observe_batched) are accumulated in each process
+# and written to Redis at most once every BATCH_INTERVAL seconds
+BATCH_INTERVAL = 10
+batch = dict()
+batch_lock = threading.Lock()
+batch_flushed = monotonic()
+
+
+def format_labels(labels):
+    """
+    Format a label dictionary into a stable hash field name
+    """
+    return ",".join(f"{key}={value}" for key, value in sorted(labels.items()))
+
+
+def parse_labels(field):
+    """
+    Parse a hash field name back into a label dictionary
+    """
+    if not field:
+        return dict()
+    return dict(label.split("=", 1) for label in field.split(","))
+
+
+def observe(config, metric, value, **labels):
+    """
+    Record one observation of a metric (e.g. a duration in seconds)
+    """
+    observe_many(config, {metric: value}, **labels)
+
+
+def observe_many(config, values, **labels):
+    """
+    Record one observation each of several metrics with the same labels, given as a
+    dictionary of metric names to values, in a single round trip to Redis
+    """
+    field = format_labels(labels)
+    try:
+        pipeline = events.get_redis(config).pipeline(transaction=False)
+        for metric, value in values.items():
+            pipeline.hincrby(f"{METRICS_PREFIX}{metric}", f"{field}|count", 1)
+            pipeline.hincrbyfloat(f"{METRICS_PREFIX}{metric}", f"{field}|sum", value)
+        pipeline.execute()
+    except Exception as e:
+        logger.debug(f"Failed to record metrics {', '.join(values)}: {e}")
+
+
+def observe_batched(config, metric, value, **labels):
+    """
+    Record one observation of a frequent metric (e.g. per database query) without a
+    round trip to Redis each time; see flush_batch
+    """
+    observe_many_batched(config, {metric: value}, **labels)
+
+
+def observe_many_batched(config, values, **labels):
+    """
+    Record one observation each of several frequent metrics with the same labels (e.g.
+    per Redfish request), given as a dictionary of metric names to values, without a
+    round trip to Redis each time; see flush_batch
+    """
+    field = format_labels(labels)
+    with batch_lock:
+        for metric, value in values.items():
+            count, total = batch.get((metric, field), (0, 0.0))
+            batch[(metric, field)] = (count + 1, total + value)
+        due = monotonic() - batch_flushed >= BATCH_INTERVAL
+    if due:
+        flush_batch(config)
+
+
+def flush_batch(config):
+    """
+    Write the batched observations of this process to Redis, in a single round trip
+    """
+    global batch, batch_flushed
+    with batch_lock:
+        pending = batch
+        batch = dict()
+        batch_flushed = monotonic()
+    if len(pending) < 1:
+        return
+
+    try:
+        pipeline = events.get_redis(config).pipeline(transaction=False)
+        for (metric, field), (count, total) in pending.items():
+            pipeline.hincrby(f"{METRICS_PREFIX}{metric}", f"{field}|count", count)
+            pipeline.hincrbyfloat(f"{METRICS_PREFIX}{metric}", f"{field}|sum", total)
+        pipeline.execute()
+    except Exception as e:
+        logger.debug(f"Failed to record {len(pending)} batched metrics: {e}")
+
+
+def increment(config, metric, amount=1, **labels):
+    """
+    Increment a counter metric
+    """
+    observe(config, metric, amount, **labels)
+
+
+def get_metrics(config):
+    """
+    Get all recorded metrics as a dictionary of metric names to lists of label sets
+    """
+    redis_client = events.get_redis(config)
+
+    all_metrics = dict()
+    for key in redis_client.scan_iter(match=f"{METRICS_PREFIX}*"):
+        metric = key.decode().replace(METRICS_PREFIX, "", 1)
+        series = dict()
+        for field, value in redis_client.hgetall(key).items():
+            labels, stat = field.decode().rsplit("|", 1)
+            series.setdefault(labels, dict())[stat] = float(value)
+        all_metrics[metric] = [
+            {
+                "labels": parse_labels(labels),
+                "count": int(stats.get("count", 0)),
+                "sum": stats.get("sum", 0.0),
+            }
+            for labels, stats in sorted(series.items())
+        ]
+
+    return all_metrics
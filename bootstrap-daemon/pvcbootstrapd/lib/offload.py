@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# offload.py - PVC Cluster Auto-bootstrap blocking call offload libraries
+# Part of the Parallel Virtual Cluster (PVC) system
+#
+#    Copyright (C) 2018-2021 Joshua M. Boniface <joshua@boniface.me>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import threading
+
+import pvcbootstrapd.lib.metrics as metrics
+
+from functools import wraps
+from time import monotonic
+from gevent import get_hub, monkey
+from celery.utils.log import get_task_logger
+
+
+logger = get_task_logger(__name__)
+
+
+# Set while running inside an offloaded call, so that nested blocking calls (e.g. a
+# database function calling another) run directly in the same native thread
+offload_state = threading.local()
+
+
+def is_offloading():
+    """
+    Determine if blocking calls must be offloaded from the gevent hub
+    """
+    if getattr(offload_state, "active", False):
+        return False
+    return monkey.is_module_patched("socket")
+
+
+def run(config, site, func, *args, **kwargs):
+    """
+    Run a blocking call, offloading it to the gevent hub threadpool when running in a
+    gevent worker so that other greenlets keep running meanwhile
+
+    The time spent in offloaded calls is recorded as the "blocking_call_seconds" metric
+    per call site, batched so that frequent calls (e.g. database queries) do not each
+    make a round trip to Redis. Calls run directly (in prefork workers, or nested in
+    another offloaded call) are not recorded.
+    """
+    if not is_offloading():
+        return func(*args, **kwargs)
+
+    def offloaded():
+        offload_state.active = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            offload_state.active = False
+
+    start = monotonic()
+    try:
+        return get_hub().threadpool.apply(offloaded)
+    finally:
+        elapsed = monotonic() - start
+        logger.debug(f"Offloaded blocking call {site} completed in {elapsed:.3f}s")
+        metrics.observe_batched(config, "blocking_call_seconds", elapsed, site=site)
+
+
+def blocking(site):
+    """
+    Decorator to offload a blocking function taking 'config' as its first argument
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(config, *args, **kwargs):
+            return run(config, site, func, config, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -23,17 +23,29 @@
 # https://downloads.dell.com/manuals/all-products/esuprt_software/esuprt_it_ops_datcentr_mgmt/dell-management-solution-resources_white-papers11_en-us.pdf
 # https://downloads.dell.com/solutions/dell-management-solution-resources/RESTfulSerConfig-using-iDRAC-REST%20API%28DTC%20copy%29.pdf
 
+import contextlib
+import hashlib
 import requests
 import urllib3
 import json
 import re
 import math
-from time import sleep
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlsplit
+from time import sleep, monotonic, time
 from celery.utils.log import get_task_logger
 
 import pvcbootstrapd.lib.notifications as notifications
 import pvcbootstrapd.lib.installer as installer
 import pvcbootstrapd.lib.db as db
+import pvcbootstrapd.lib.events as events
+import pvcbootstrapd.lib.metrics as metrics
+import pvcbootstrapd.lib.scheduler as scheduler
+import pvcbootstrapd.lib.retry as retry
+
+from pvcbootstrapd.lib.dataclasses import NodeDiscovery, HardwareProfile
 
 
 logger = get_task_logger(__name__)
@@ -43,251 +55,775 @@ logger = get_task_logger(__name__)
 # Helper Classes
 #
 class RedfishSession:
-    def __init__(self, host, username, password):
+    # Default (connect, read) timeouts for requests to the BMC; some BMCs take tens of
+    # seconds to answer Storage and Bios requests
+    default_timeout = (10, 60)
+
+    # Default maximum number of concurrent requests to a single BMC
+    default_max_fanout = 4
+
+    def __init__(
+        self, host, username, password, timeout=None, max_fanout=None, config=None
+    ):
         # Disable urllib3 warnings
         urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+        # Create a persistent HTTP session, so that all requests reuse kept-alive
+        # connections instead of doing a fresh TCP and TLS handshake with the BMC each.
+        # Failed requests are retried by send() under our retry policies, not urllib3.
+        self.timeout = timeout if timeout is not None else self.default_timeout
+        self.max_fanout = (
+            max_fanout if max_fanout is not None else self.default_max_fanout
+        )
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max(self.max_fanout, 1),
+            max_retries=0,
+        )
+        self.http = requests.Session()
+        self.http.verify = False
+        # Do not let a REQUESTS_CA_BUNDLE (or proxy) environment override the above for
+        # BMCs, which nearly always have self-signed certificates
+        self.http.trust_env = False
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+
+        # Retry policies for requests and logins, and the circuit breaker of this BMC
+        # (shared by all sessions to it in this worker process)
+        self.config = config
+        if config is not None:
+            self.request_policy = retry.get_policy(config, "request")
+            self.login_policy = retry.get_policy(config, "login")
+        else:
+            self.request_policy = retry.RetryPolicy()
+            self.login_policy = retry.RetryPolicy(
+                max_attempts=60, base_delay=1, max_delay=16, deadline=600
+            )
+        self.breaker = retry.get_circuit_breaker(config, host)
+
+        self.host = host
+        self.username = username
+        self.password = password
+        self.token = None
+        self.headers = None
+        self.logout_uri = None
+        self.protocol_features = None
+
+        # The BMC vendor (once known, e.g. set by redfish_init) and the trace file, if
+        # any (see start_trace), for the instrumentation of requests (record_request)
+        self.vendor = None
+        self.trace = None
+        self.trace_lock = threading.Lock()
+
         # Perform login
-        login_payload = {"UserName": username, "Password": password}
-        login_uri = f"{host}/redfish/v1/Sessions"
+        if not self.login():
+            self.host = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Log out of the BMC and close the HTTP connections
+        """
+        self.logout()
+        self.http.close()
+        self.stop_trace()
+
+    def start_trace(self, path):
+        """
+        Append a JSON record of each following request to the trace file at 'path'
+        """
+        self.stop_trace()
+        with self.trace_lock:
+            self.trace = open(path, "a", buffering=1)
+
+    def stop_trace(self):
+        """
+        Stop tracing requests, if tracing
+        """
+        with self.trace_lock:
+            if self.trace is not None:
+                self.trace.close()
+                self.trace = None
+
+    def record_request(self, method, url, response, seconds, retries):
+        """
+        Record a request (after any retries) by its method, URI template, status code,
+        latency, response size and retries, tagged with the vendor and BMC
+
+        Requests are recorded as the "redfish_request_seconds", "redfish_response_bytes"
+        and "redfish_request_retries" metrics (unless disabled), which are batched (see
+        metrics.observe_many_batched), and in the trace file. Requests which got no
+        response have the status "error".
+        """
+        labels = {
+            "method": method,
+            "uri": get_uri_template(url),
+            "status": response.status_code if response is not None else "error",
+            "vendor": self.vendor if self.vendor is not None else "unknown",
+            "bmc": urlsplit(self.host).netloc,
+        }
+        size = len(response.content) if response is not None else 0
+
+        if self.config is not None and self.config["redfish_instrumentation_metrics"]:
+            metrics.observe_many_batched(
+                self.config,
+                {
+                    "redfish_request_seconds": seconds,
+                    "redfish_response_bytes": size,
+                    "redfish_request_retries": retries,
+                },
+                **labels,
+            )
+
+        with self.trace_lock:
+            if self.trace is not None:
+                record = dict(
+                    labels,
+                    time=round(time(), 3),
+                    path=urlsplit(url).path,
+                    seconds=round(seconds, 4),
+                    bytes=size,
+                    retries=retries,
+                )
+                self.trace.write(json.dumps(record) + "\n")
+
+    def login(self, policy=None):
+        """
+        Log in to the BMC, retrying failed connections and transient errors under the
+        login policy (the BMC may still be starting up); returns whether it succeeded
+        """
+        if policy is None:
+            policy = self.login_policy
+        if not self.breaker.allow():
+            logger.error(f"Not logging in to Redfish at {self.host}: circuit open")
+            return False
+
+        login_payload = {"UserName": self.username, "Password": self.password}
+        login_uri = f"{self.host}/redfish/v1/Sessions"
         login_headers = {"content-type": "application/json"}
 
-        self.host = None
         login_response = None
-
-        tries = 1
-        max_tries = 61
-        while tries < max_tries:
-            logger.info(f"Trying to log in to Redfish ({tries}/{max_tries - 1})...")
+        reason = None
+        start = monotonic()
+        for tries in policy.attempts():
+            if reason is not None:
+                retry.record_retry(self.config, "login", reason)
+            logger.info(f"Trying to log in to Redfish at {self.host} ({tries})...")
             try:
-                login_response = requests.post(
+                login_response = self.http.post(
                     login_uri,
                     data=json.dumps(login_payload),
                     headers=login_headers,
-                    verify=False,
                     timeout=5,
                 )
+            except requests.exceptions.RequestException as e:
+                logger.debug(f"Failed to connect to Redfish at {self.host}: {e}")
+                reason = type(e).__name__
+                continue
+            if not retry.is_retryable("POST", response=login_response):
                 break
-            except Exception:
-                sleep(2)
-                tries += 1
+            reason = str(login_response.status_code)
+        self.record_request(
+            "POST", login_uri, login_response, monotonic() - start, tries - 1
+        )
 
-        if login_response is None or login_response.status_code not in [200, 201]:
-            try:
-                rinfo = response.json()["error"]["@Message.ExtendedInfo"][0]
-            except Exception:
-                rinfo = {}
-            if rinfo.get("Message") is not None:
-                full_message = rinfo["Message"]
-                res_message = rinfo["Resolution"]
-                severity = rinfo["Severity"]
-                message_id = rinfo["MessageId"]
-            else:
-                full_message = ""
-                res_message = ""
-                severity = "Fatal"
-                message_id = rinfo.get("MessageId", "No message ID")
-            status_code = login_response.status_code
-            failure_message = f"Redfish failure: {full_message} {res_message} (HTTP Code: {status_code}, Severity: {severity}, ID: {message_id})"
-            logger.error(f"Failed to log in to Redfish at {host}")
-            logger.error(failure_message)
-            return
+        if login_response is None:
+            logger.error(f"Failed to log in to Redfish at {self.host}: no response")
+            self.breaker.record_failure(self.config)
+            return False
+        if login_response.status_code not in [200, 201]:
+            logger.error(f"Failed to log in to Redfish at {self.host}")
+            self.log_failure("Login", login_uri, login_response)
+            if login_response.status_code in retry.RETRYABLE_STATUSES:
+                self.breaker.record_failure(self.config)
+            return False
 
-        logger.info(f"Logged in to Redfish at {host} successfully")
+        logger.info(f"Logged in to Redfish at {self.host} successfully")
+        self.breaker.record_success()
 
-        self.host = host
         self.token = login_response.headers.get("X-Auth-Token")
         self.headers = {"content-type": "application/json", "x-auth-token": self.token}
 
         logout_uri = login_response.headers.get("Location")
-        if re.match(r"^/", logout_uri):
-            self.logout_uri = f"{host}{logout_uri}"
+        if logout_uri is not None and re.match(r"^/", logout_uri):
+            self.logout_uri = f"{self.host}{logout_uri}"
         else:
             self.logout_uri = logout_uri
+        return True
 
-    def __del__(self):
-        if self.host is None:
+    def logout(self):
+        """
+        Log out of the BMC, if logged in
+        """
+        if self.token is None or self.logout_uri is None:
             return
 
-        logout_headers = {
-            "Content-Type": "application/json",
-            "X-Auth-Token": self.token,
-        }
-
-        logout_response = requests.delete(
-            self.logout_uri, headers=logout_headers, verify=False, timeout=15
-        )
+        start = monotonic()
+        logout_response = None
+        try:
+            logout_response = self.http.delete(
+                self.logout_uri, headers=self.headers, timeout=15
+            )
+        except Exception as e:
+            logger.error(f"Failed to log out of Redfish at {self.host}: {e}")
+            return
+        finally:
+            self.token = None
+            self.record_request(
+                "DELETE", self.logout_uri, logout_response, monotonic() - start, 0
+            )
 
-        if logout_response.status_code not in [200, 201]:
-            try:
-                rinfo = response.json()["error"]["@Message.ExtendedInfo"][0]
-            except Exception:
-                rinfo = {}
-            if rinfo.get("Message") is not None:
-                full_message = rinfo["Message"]
-                res_message = rinfo["Resolution"]
-                severity = rinfo["Severity"]
-                message_id = rinfo["MessageId"]
-            else:
-                full_message = ""
-                res_message = ""
-                severity = "Fatal"
-                message_id = rinfo.get("MessageId", "No message ID")
-            status_code = logout_response.status_code
-            failure_message = f"Redfish failure: {full_message} {res_message} (HTTP Code: {status_code}, Severity: {severity}, ID: {message_id})"
-            logger.error(f"Failed to log out of Redfish at {host}")
-            logger.error(failure_message)
+        if logout_response.status_code not in [200, 201, 204]:
+            logger.error(f"Failed to log out of Redfish at {self.host}")
+            self.log_failure("Logout", self.logout_uri, logout_response)
             return
         logger.info(f"Logged out of Redfish at {self.host} successfully")
 
-    def get(self, uri):
-        url = f"{self.host}{uri}"
-
-        response = requests.get(url, headers=self.headers, verify=False)
-
-        if response.status_code in [200, 201]:
-            return response.json()
-        else:
-            rinfo = response.json()["error"]["@Message.ExtendedInfo"][0]
-            if rinfo.get("Message") is not None:
-                message = f"{rinfo['Message']} {rinfo['Resolution']}"
-                severity = rinfo["Severity"]
-                message_id = rinfo["MessageId"]
-            else:
-                message = rinfo
-                severity = "Error"
-                message_id = "N/A"
-            logger.warn(f"! Error: GET request to {url} failed")
-            logger.warn(
-                f"! HTTP Code: {response.status_code}   Severity: {severity}   ID: {message_id}"
+    def check_login(self):
+        """
+        Check if our session (X-Auth-Token) is still valid on the BMC
+        """
+        if self.token is None or self.logout_uri is None:
+            return False
+        start = monotonic()
+        response = None
+        try:
+            response = self.http.get(
+                self.logout_uri, headers=self.headers, timeout=self.timeout
             )
-            logger.warn(f"! Details: {message}")
+        except Exception as e:
+            logger.debug(f"Failed to check Redfish session at {self.host}: {e}")
+            return False
+        finally:
+            self.record_request(
+                "GET", self.logout_uri, response, monotonic() - start, 0
+            )
+        return response.status_code == 200
+
+    def send(self, method, url, data=None, policy=None):
+        """
+        Send a request with our session, retrying transient failures (see
+        retry.is_retryable) under the request policy, and logging in again once if
+        the BMC expired the session.
+
+        Returns the last response; raises the last exception if no response was
+        received, or CircuitOpenError without sending anything if the BMC's circuit
+        breaker is open. Failures that persist after retries count towards opening it.
+        The request is recorded (see record_request) once it succeeded or failed.
+        """
+        if policy is None:
+            policy = self.request_policy
+        self.breaker.check()
+
+        start = monotonic()
+        retries = 0
+        response = None
+        exception = None
+        reason = None
+        relogin = True
+        try:
+            for attempt in policy.attempts():
+                # After logging in again, the request is sent again at once, as part of
+                # the same attempt
+                resend = True
+                while resend:
+                    resend = False
+                    if reason is not None:
+                        retry.record_retry(self.config, method, reason)
+                        retries += 1
+                    try:
+                        response = self.http.request(
+                            method,
+                            url,
+                            data=data,
+                            headers=self.headers,
+                            timeout=self.timeout,
+                        )
+                        exception = None
+                    except requests.exceptions.RequestException as e:
+                        logger.debug(
+                            f"{method} request to {url} failed ({attempt}): {e}"
+                        )
+                        response = None
+                        if not retry.is_retryable(method, exception=e):
+                            self.breaker.record_failure(self.config)
+                            raise
+                        exception = e
+                        reason = type(e).__name__
+                        break
+
+                    if (
+                        response.status_code == 401
+                        and self.token is not None
+                        and relogin
+                    ):
+                        logger.info(
+                            f"Redfish session at {self.host} expired; logging in again"
+                        )
+                        relogin = False
+                        if self.login(policy=retry.RetryPolicy(max_attempts=3)):
+                            reason = str(response.status_code)
+                            resend = True
+                            continue
+
+                    if not retry.is_retryable(method, response=response):
+                        self.breaker.record_success()
+                        return response
+                    logger.debug(
+                        f"{method} request to {url} got {response.status_code}"
+                    )
+                    reason = str(response.status_code)
+
+            self.breaker.record_failure(self.config)
+            if exception is not None:
+                raise exception
+            return response
+        finally:
+            self.record_request(method, url, response, monotonic() - start, retries)
+
+    def get_protocol_features(self):
+        """
+        Get (once) the ProtocolFeaturesSupported of the service root
+        """
+        if self.protocol_features is None:
+            service_root = self.get("/redfish/v1")
+            if service_root is None:
+                return dict()
+            self.protocol_features = service_root.get("ProtocolFeaturesSupported", {})
+        return self.protocol_features
+
+    def get_expand_query(self, levels=1):
+        """
+        Get the $expand query for subordinate resources up to 'levels' deep, or None if
+        unsupported; without $levels support, only the first level is expanded
+        """
+        expand_features = self.get_protocol_features().get("ExpandQuery", {})
+        # Prefer "." (subordinate resources only), as "*" also expands every Link
+        if expand_features.get("NoLinks", False):
+            expand_type = "."
+        elif expand_features.get("ExpandAll", False):
+            expand_type = "*"
+        else:
             return None
 
-    def delete(self, uri):
+        if levels > 1 and expand_features.get("Levels", False):
+            levels = min(levels, expand_features.get("MaxLevels", levels))
+            return f"$expand={expand_type}($levels={levels})"
+        return f"$expand={expand_type}"
+
+    def get_collection(self, uri, select=None, levels=1, filter_by=None):
+        """
+        Get a collection, with its members (and their subordinate resources, up to
+        'levels' deep) expanded in a single request when the BMC supports $expand, and
+        trimmed to the 'select' properties when it supports $select.
+
+        Deeper levels than the BMC can expand (e.g. all but the first without $levels
+        support) are left as links, to be fetched with get_members().
+
+        When the BMC supports $filter, only the members matching the 'filter_by'
+        expression are listed; BMCs may still ignore it, so check each member anyway.
+
+        If none are supported or the BMC returns an unusable result, the plain
+        collection is returned instead; use get_member() to get each member's details.
+        """
+        protocol_features = self.get_protocol_features()
+        queries = list()
+        expand_query = self.get_expand_query(levels)
+        if expand_query is not None:
+            if select is not None and protocol_features.get("SelectQuery", False):
+                queries.append(f"{expand_query}&$select={','.join(select)}")
+            queries.append(expand_query)
+        if filter_by is not None and protocol_features.get("FilterQuery", False):
+            filter_query = f"$filter={quote(filter_by)}"
+            queries = [f"{query}&{filter_query}" for query in queries] + [
+                filter_query,
+                *queries,
+            ]
+
+        for query in queries:
+            collection_detail = self.get(f"{uri}?{query}")
+            if collection_detail is not None and isinstance(
+                collection_detail.get("Members"), list
+            ):
+                return collection_detail
+            logger.debug(f"Unusable collection query at {uri}?{query}")
+
+        return self.get(uri)
+
+    def get_member(self, member):
+        """
+        Get the details of a collection member or link, unless already expanded
+        """
+        if len(set(member.keys()) - {"@odata.id"}) > 0:
+            return member
+        return self.get(member["@odata.id"])
+
+    def get_members(self, members):
+        """
+        Get the details of several collection members or links concurrently, with at
+        most 'max_fanout' requests in flight to this BMC; results keep the given order
+        """
+        if self.max_fanout <= 1 or len(members) <= 1:
+            return [self.get_member(member) for member in members]
+
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_fanout, len(members))
+        ) as executor:
+            return list(executor.map(self.get_member, members))
+
+    def request(self, method, uri, data=None):
+        """
+        Perform a request; returns the response body, or {"response": "ok"} if it has
+        none, if the request succeeded, or None if it failed
+        """
         url = f"{self.host}{uri}"
+        payload = json.dumps(data) if data is not None else None
 
-        response = requests.delete(url, headers=self.headers, verify=False)
+        if payload is not None:
+            logger.debug(f"{method} payload: {payload}")
 
-        if response.status_code in [200, 201]:
-            return response.json()
-        else:
-            rinfo = response.json()["error"]["@Message.ExtendedInfo"][0]
-            if rinfo.get("Message") is not None:
-                message = f"{rinfo['Message']} {rinfo['Resolution']}"
-                severity = rinfo["Severity"]
-                message_id = rinfo["MessageId"]
-            else:
-                message = rinfo
-                severity = "Error"
-                message_id = "N/A"
+        response = self.send(method, url, payload)
+        logger.debug(f"Response: {response.status_code}")
 
-            logger.warn(f"! Error: DELETE request to {url} failed")
-            logger.warn(
-                f"! HTTP Code: {response.status_code}   Severity: {severity}   ID: {message_id}"
-            )
-            logger.warn(f"! Details: {message}")
+        if response.status_code not in [200, 201, 202, 204]:
+            self.log_failure(method, url, response)
             return None
+        try:
+            return response.json()
+        except ValueError:
+            return {"response": "ok"}
+
+    def get(self, uri):
+        return self.request("GET", uri)
+
+    def delete(self, uri):
+        return self.request("DELETE", uri)
 
     def post(self, uri, data):
+        return self.request("POST", uri, data)
+
+    def put(self, uri, data):
+        return self.request("PUT", uri, data)
+
+    def patch(self, uri, data):
+        return self.request("PATCH", uri, data)
+
+    def log_failure(self, method, url, response):
+        """
+        Log the details of a failed request from its Redfish error body, if any
+        """
+        try:
+            rinfo = response.json()["error"]["@Message.ExtendedInfo"][0]
+        except Exception:
+            rinfo = dict()
+        if rinfo.get("Message") is not None:
+            message = f"{rinfo['Message']} {rinfo.get('Resolution', '')}"
+            severity = rinfo.get("Severity", "Error")
+            message_id = rinfo.get("MessageId", "N/A")
+        else:
+            message = response.text
+            severity = "Error"
+            message_id = "N/A"
+        logger.warn(f"! Error: {method} request to {url} failed")
+        logger.warn(
+            f"! HTTP Code: {response.status_code}   Severity: {severity}   ID: {message_id}"
+        )
+        logger.warn(f"! Details: {message}")
+
+    def request_async(self, method, uri, data, timeout=600, progress=None):
+        """
+        Perform a POST or PATCH which may start an asynchronous operation on the BMC,
+        and wait for it to complete by following its task monitor (the Location of a
+        202 Accepted response) with exponential backoff, for at most 'timeout' seconds.
+
+        Progress (task state and percentage) is logged, and passed to 'progress' if set.
+        Returns the final response body (or an empty dict if there is none) once the
+        operation completed successfully, or None if it failed or timed out. Transient
+        failures to get the task monitor (see retry.is_retryable), including an open
+        circuit breaker, do not end the wait; it is polled again until the timeout.
+        """
         url = f"{self.host}{uri}"
         payload = json.dumps(data)
 
-        logger.debug(f"POST payload: {payload}")
+        logger.debug(f"{method} payload: {payload}")
 
-        response = requests.post(url, data=payload, headers=self.headers, verify=False)
+        try:
+            response = self.send(method, url, payload)
+        except (requests.exceptions.RequestException, retry.CircuitOpenError) as e:
+            logger.warn(f"{method} request to {url} failed: {e}")
+            return None
         logger.debug(f"Response: {response.status_code}")
 
-        if response.status_code in [201, 204]:
-            return {"response": "ok"}
-        elif response.status_code in [200]:
+        if response.status_code not in [200, 201, 202, 204]:
+            self.log_failure(method, url, response)
+            return None
+
+        task_monitor = response.headers.get("Location")
+        if response.status_code != 202 or task_monitor is None:
+            # The operation completed synchronously
             try:
                 return response.json()
             except Exception:
-                return {"json_err": e}
-        else:
+                return dict()
+
+        if re.match(r"^/", task_monitor):
+            task_monitor = f"{self.host}{task_monitor}"
+        logger.info(f"Following {method} task monitor {task_monitor}")
+
+        start = monotonic()
+        delay = 1
+        last_status = None
+        while monotonic() - start < timeout:
+            sleep(delay)
+            delay = min(delay * 2, 30)
+
+            try:
+                response = self.send("GET", task_monitor)
+            except retry.CircuitOpenError as e:
+                logger.debug(f"Task monitor {task_monitor} unavailable: {e}")
+                continue
+            except requests.exceptions.RequestException as e:
+                if not retry.is_retryable("GET", exception=e):
+                    logger.warn(f"Failed to get task monitor {task_monitor}: {e}")
+                    return None
+                logger.debug(f"Task monitor {task_monitor} unavailable: {e}")
+                continue
+
+            if response.status_code == 404:
+                # Some BMCs remove the task monitor as soon as the task completes
+                logger.debug(f"Task monitor {task_monitor} is gone; assuming completed")
+                return dict()
+            if retry.is_retryable("GET", response=response):
+                logger.debug(f"Task monitor {task_monitor} got {response.status_code}")
+                continue
+            if response.status_code not in [200, 201, 202, 204]:
+                self.log_failure("GET", task_monitor, response)
+                return None
+
             try:
-                rinfo = response.json()["error"]["@Message.ExtendedInfo"][0]
+                task_detail = response.json()
             except Exception:
-                logger.debug(response)
-                raise
+                task_detail = dict()
+
+            # Tasks report a TaskState, Dell jobs a JobState; final responses neither
+            task_state = task_detail.get("TaskState", task_detail.get("JobState"))
+            task_percent = task_detail.get("PercentComplete", 0)
+            if (task_state, task_percent) != last_status:
+                logger.info(f"Task {task_monitor}: {task_state} ({task_percent}%)")
+                if progress is not None:
+                    progress(task_state, task_percent)
+                last_status = (task_state, task_percent)
+
+            if response.status_code == 202 or task_state in active_task_states:
+                continue
+            if task_state in active_job_states + ["New", "Scheduling"]:
+                continue
+            if task_state in ["Exception", "Killed", "Cancelled", "Failed"]:
+                messages = task_detail.get("Messages")
+                logger.warn(f"Task {task_monitor} failed: {messages}")
+                return None
+            if task_state in ["CompletedWithErrors"]:
+                messages = task_detail.get("Messages")
+                logger.warn(f"Task {task_monitor} had errors: {messages}")
+            return task_detail
 
-            if rinfo.get("Message") is not None:
-                message = f"{rinfo['Message']} {rinfo['Resolution']}"
-                severity = rinfo["Severity"]
-                message_id = rinfo["MessageId"]
-            else:
-                message = rinfo
-                severity = "Error"
-                message_id = "N/A"
+        logger.warn(f"Timed out after {timeout}s waiting for task {task_monitor}")
+        return None
 
-            logger.warn(f"! Error: POST request to {url} failed")
-            logger.warn(
-                f"! HTTP Code: {response.status_code}   Severity: {severity}   ID: {message_id}"
-            )
-            logger.warn(f"! Details: {message}")
-            return None
+    def post_async(self, uri, data, timeout=600, progress=None):
+        return self.request_async("POST", uri, data, timeout=timeout, progress=progress)
 
-    def put(self, uri, data):
-        url = f"{self.host}{uri}"
-        payload = json.dumps(data)
+    def patch_async(self, uri, data, timeout=600, progress=None):
+        return self.request_async(
+            "PATCH", uri, data, timeout=timeout, progress=progress
+        )
 
-        logger.debug(f"PUT payload: {payload}")
 
-        response = requests.put(url, data=payload, headers=self.headers, verify=False)
+class RedfishSessionPool:
+    """
+    A pool of logged-in Redfish sessions, keyed by BMC host and username
 
-        if response.status_code in [200, 201]:
-            return response.json()
-        else:
-            rinfo = response.json()["error"]["@Message.ExtendedInfo"][0]
-            if rinfo.get("Message") is not None:
-                message = f"{rinfo['Message']} {rinfo['Resolution']}"
-                severity = rinfo["Severity"]
-                message_id = rinfo["MessageId"]
-            else:
-                message = rinfo
-                severity = "Error"
-                message_id = "N/A"
+    Tasks lease a session for as long as they need it, and return it to the pool
+    afterwards instead of logging out, so that later tasks (e.g. retries and fleet
+    operations) on the same BMC reuse its X-Auth-Token instead of logging in again:
 
-            logger.warn(f"! Error: PUT request to {url} failed")
-            logger.warn(
-                f"! HTTP Code: {response.status_code}   Severity: {severity}   ID: {message_id}"
-            )
-            logger.warn(f"! Details: {message}")
+        with session_pool.session(host, username, password) as session:
+            if session is not None:
+                system_detail = session.get(system_root)
+
+    Pooled sessions are checked before reuse, and logged in again if the BMC expired
+    them. Sessions unused for 'idle_timeout' seconds are logged out by a timer, even if
+    the pool is not used again, so that they do not hold the BMC's session slots; all
+    idle sessions are logged out on close().
+    """
+
+    def __init__(self, idle_timeout=300, config=None):
+        self.idle_timeout = idle_timeout
+        self.config = config
+        self.idle = dict()
+        self.lock = threading.Lock()
+        self.reaper = None
+
+    @contextlib.contextmanager
+    def session(self, host, username, password, timeout=None, max_fanout=None):
+        session = self.acquire(host, username, password, timeout, max_fanout)
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    def acquire(self, host, username, password, timeout=None, max_fanout=None):
+        """
+        Lease a logged-in session to the BMC; returns None if logging in failed
+        """
+        self.reap()
+
+        session = None
+        with self.lock:
+            idle_sessions = self.idle.get((host, username), [])
+            if len(idle_sessions) > 0:
+                session, _ = idle_sessions.pop()
+
+        if session is not None:
+            if session.password == password and session.check_login():
+                logger.info(f"Reusing Redfish session at {host}")
+                session.timeout = timeout if timeout is not None else session.timeout
+                return session
+            session.close()
+
+        session = RedfishSession(
+            host,
+            username,
+            password,
+            timeout=timeout,
+            max_fanout=max_fanout,
+            config=self.config,
+        )
+        if session.host is None:
+            session.http.close()
             return None
+        return session
 
-    def patch(self, uri, data):
-        url = f"{self.host}{uri}"
-        payload = json.dumps(data)
+    def release(self, session):
+        """
+        Return a leased session to the pool, or log out of it if pooling is disabled
+        """
+        if session is None:
+            return
+        session.stop_trace()
+        if session.token is None or self.idle_timeout <= 0:
+            session.close()
+            return
+        with self.lock:
+            self.idle.setdefault((session.host, session.username), []).append(
+                (session, monotonic())
+            )
+        self.reap()
+        self.schedule_reap()
+
+    def schedule_reap(self):
+        """
+        Schedule a reap for when the longest idle session expires, unless one is
+        already scheduled
+        """
+        with self.lock:
+            if self.reaper is not None:
+                return
+            released = [entry[1] for entries in self.idle.values() for entry in entries]
+            if len(released) < 1:
+                return
+            delay = max(min(released) + self.idle_timeout - monotonic(), 0) + 0.1
+            self.reaper = threading.Timer(delay, self.run_reaper)
+            self.reaper.daemon = True
+            self.reaper.start()
+
+    def run_reaper(self):
+        with self.lock:
+            self.reaper = None
+        self.reap()
+        self.schedule_reap()
+
+    def reap(self):
+        """
+        Log out of any sessions idle for longer than 'idle_timeout'
+        """
+        expired = list()
+        with self.lock:
+            for key, idle_sessions in self.idle.items():
+                for entry in list(idle_sessions):
+                    if monotonic() - entry[1] > self.idle_timeout:
+                        idle_sessions.remove(entry)
+                        expired.append(entry[0])
+        for session in expired:
+            session.close()
+
+    def close(self):
+        """
+        Log out of all idle sessions
+        """
+        with self.lock:
+            idle_sessions = [
+                entry[0] for entries in self.idle.values() for entry in entries
+            ]
+            self.idle = dict()
+            if self.reaper is not None:
+                self.reaper.cancel()
+                self.reaper = None
+        for session in idle_sessions:
+            session.close()
 
-        logger.debug(f"PATCH payload: {payload}")
 
-        response = requests.patch(url, data=payload, headers=self.headers, verify=False)
+#
+# Session pool functions
+#
+# The session pool of this worker process (see get_session_pool)
+session_pool = None
 
-        if response.status_code in [200, 201]:
-            return response.json()
-        else:
-            rinfo = response.json()["error"]["@Message.ExtendedInfo"][0]
-            if rinfo.get("Message") is not None:
-                message = f"{rinfo['Message']} {rinfo['Resolution']}"
-                severity = rinfo["Severity"]
-                message_id = rinfo["MessageId"]
-            else:
-                message = rinfo
-                severity = "Error"
-                message_id = "N/A"
 
-            logger.warn(f"! Error: PATCH request to {url} failed")
-            logger.warn(
-                f"! HTTP Code: {response.status_code}   Severity: {severity}   ID: {message_id}"
-            )
-            logger.warn(f"! Details: {message}")
-            return None
+def get_session_pool(config):
+    """
+    Get the Redfish session pool of this worker process
+    """
+    global session_pool
+    if session_pool is None:
+        session_pool = RedfishSessionPool(
+            config["redfish_session_idle_timeout"], config=config
+        )
+    return session_pool
+
+
+def close_session_pool():
+    """
+    Log out of all pooled Redfish sessions, e.g. when the worker process stops
+    """
+    if session_pool is not None:
+        session_pool.close()
 
 
 #
 # Helper functions
 #
+def get_uri_template(url):
+    """
+    Normalize a request URL into a URI template, for instrumentation, by dropping any
+    query and replacing collection member identifiers (path segments containing a
+    digit, e.g. "1", "System.Embedded.1" or "JID_123") with "{id}"; the segments
+    after "Actions" are action names, and kept as-is
+    """
+    segments = urlsplit(url).path.rstrip("/").split("/")
+    for index, segment in enumerate(segments):
+        if segment == "Actions":
+            break
+        if segment != "v1" and re.search(r"\d", segment):
+            segments[index] = "{id}"
+    return "/".join(segments)
+
+
 def format_bytes_tohuman(databytes):
     """
     Format a string of bytes into a human-readable value (using base-1000)
@@ -322,6 +858,8 @@ def format_bytes_tohuman(databytes):
                 new_bytes = cieled_bytes
             else:
                 new_bytes = rounded_bytes
+        else:
+            new_bytes = round(databytes / byte_unit_matrix[unit])
 
         # Round up if 5 or more digits
         if new_bytes > 999:
@@ -334,10 +872,89 @@ def format_bytes_tohuman(databytes):
     return datahuman
 
 
-def get_system_drive_target(session, cspec_node, storage_root):
+def get_system_drives(session, cspec_drives, storage_root, drive_layout):
+    """
+    Find the drives matching the chassis IDs of the system disks
+
+    Returns the matching drives and the list of all drives, walked from the storage
+    root. If 'drive_layout' holds the system drives of an identical node, those are
+    returned instead, without a drive list.
+    """
+    if len(drive_layout.get("system_drives", [])) == 2:
+        logger.info("Using the system drives from the hardware profile")
+        return drive_layout["system_drives"], None
+
+    # Get the storage members and their drives, in one request if supported
+    storage_detail = session.get_collection(storage_root, levels=2)
+
+    # Grab a full list of drives, fetching any unexpanded entries concurrently
+    storage_member_details = session.get_members(storage_detail["Members"])
+    drive_list = session.get_members(
+        [
+            drive
+            for storage_member_detail in storage_member_details
+            for drive in storage_member_detail["Drives"]
+        ]
+    )
+
+    system_drives = list()
+
+    # Iterate through each drive and include those that match
+    for cspec_drive in cspec_drives:
+        # Match any chassis-ID spec drives
+        for drive in drive_list:
+            # Like "Disk.Bay.2:Enclosure.Internal.0-1:RAID.Integrated.1-1"
+            drive_name = drive["Id"].split(":")[0]
+            # Craft up the cspec version of this (iDRAC uses "Disk.Bay")
+            cspec_drive_names = [
+                f"Drive.Bay.{cspec_drive}",
+                f"Disk.Bay.{cspec_drive}",
+            ]
+            if drive_name in cspec_drive_names:
+                system_drives.append(drive)
+
+    drive_layout["system_drives"] = [
+        {"@odata.id": drive.get("@odata.id"), "Id": drive.get("Id")}
+        for drive in system_drives
+    ]
+    return system_drives, drive_list
+
+
+def get_drives_volume(session, drives):
+    """
+    Get the (RAID) volume all of the drives belong to, or None if there is none
+    """
+    volume_roots = set()
+    for drive in drives:
+        # Drives from a hardware profile drive layout only hold their ID and URI
+        if "Links" in drive:
+            drive_detail = drive
+        else:
+            drive_detail = session.get(drive["@odata.id"])
+        volumes = drive_detail.get("Links", {}).get("Volumes", [])
+        if len(volumes) < 1:
+            return None
+        volume_root = volumes[0].get("@odata.id", "")
+        # Non-RAID drives are presented as a volume with the drive's own ID
+        if volume_root.split("/")[-1] == drive.get("Id"):
+            return None
+        volume_roots.add(volume_root)
+    if len(volume_roots) != 1:
+        return None
+    return volume_roots.pop()
+
+
+def get_system_drive_target(session, cspec_node, storage_root, drive_layout=None):
     """
     Determine the system drive target for the installer
+
+    If given, 'drive_layout' is a (hardware profile) dictionary of the system drives
+    and single drive target found on an identical node; it is used instead of walking
+    the drives, or filled in by the walk if empty.
     """
+    if drive_layout is None:
+        drive_layout = dict()
+
     # Handle an invalid >2 number of system disks, use only first 2
     if len(cspec_node["config"]["system_disks"]) > 2:
         cspec_drives = cspec_node["config"]["system_disks"][0:2]
@@ -349,123 +966,117 @@ def get_system_drive_target(session, cspec_node, storage_root):
     # format here.
     if storage_root is None:
         return cspec_drives[0]
-    # We proceed with Redfish configuration to determine the disks
-    else:
-        storage_detail = session.get(storage_root)
-
-        # Grab a full list of drives
-        drive_list = list()
-        for storage_member in storage_detail["Members"]:
-            storage_member_root = storage_member["@odata.id"]
-            storage_member_detail = session.get(storage_member_root)
-            for drive in storage_member_detail["Drives"]:
-                drive_root = drive["@odata.id"]
-                drive_detail = session.get(drive_root)
-                drive_list.append(drive_detail)
-
-        system_drives = list()
-
-        # Iterate through each drive and include those that match
-        for cspec_drive in cspec_drives:
-            if re.match(r"^\/dev", cspec_drive) or re.match(r"^detect:", cspec_drive):
-                # We only match the first drive that has these conditions for use in the preseed config
-                logger.info(
-                    "Found a drive with a 'detect:' string or Linux '/dev' path, using it for bootstrap."
-                )
-                return cspec_drive
-
-            # Match any chassis-ID spec drives
-            for drive in drive_list:
-                # Like "Disk.Bay.2:Enclosure.Internal.0-1:RAID.Integrated.1-1"
-                drive_name = drive["Id"].split(":")[0]
-                # Craft up the cspec version of this
-                cspec_drive_name = f"Drive.Bay.{cspec_drive}"
-                if drive_name == cspec_drive_name:
-                    system_drives.append(drive)
-
-        # We found a single drive, so determine its actual detect string
-        if len(system_drives) == 1:
+
+    # We only match the first drive that has these conditions for use in the preseed
+    # config
+    for cspec_drive in cspec_drives:
+        if re.match(r"^\/dev", cspec_drive) or re.match(r"^detect:", cspec_drive):
             logger.info(
-                "Found a single drive matching the requested chassis ID, using it as the system disk."
+                "Found a drive with a 'detect:' string or Linux '/dev' path, using it for bootstrap."
             )
+            return cspec_drive
 
-            # Get the model's first word
-            drive_model = system_drives[0].get("Model", "INVALID").split()[0]
-            # Get and convert the size in bytes value to human
-            drive_size_bytes = system_drives[0].get("CapacityBytes", 0)
-            drive_size_human = format_bytes_tohuman(drive_size_bytes)
-            # Get the drive ID out of all the valid entries
-            # How this works is that, for each non-array disk, we must find what position our exact disk is
-            # So for example, say we want disk 3 out of 4, and all 4 are the same size and model and not in
-            # another (RAID) volume. This will give us an index of 2. Then in the installer this will match
-            # the 3rd list entry from "lsscsi". This is probably an unneccessary hack, since people will
-            # probably just give the first disk if they want one, or 2 disks if they want a RAID-1, but this
-            # is here just in case
-            idx = 0
-            for drive in drive_list:
-                list_drive_model = drive.get("Model", "INVALID").split()[0]
-                list_drive_size_bytes = drive.get("CapacityBytes", 0)
-                list_drive_in_array = (
-                    False
-                    if drive.get("Links", {})
-                    .get("Volumes", [""])[0]
-                    .get("@odata.id")
-                    .split("/")[-1]
-                    == drive.get("Id")
-                    else True
-                )
-                if (
-                    drive_model == list_drive_model
-                    and drive_size_bytes == list_drive_size_bytes
-                    and not list_drive_in_array
-                ):
-                    index = idx
-                    idx += 1
-            drive_id = index
+    # Use the drive layout of an identical node
+    if drive_layout.get("target") is not None:
+        logger.info("Using the system drive target from the hardware profile")
+        return drive_layout["target"]
 
-            # Create the target string
-            system_drive_target = f"detect:{drive_model}:{drive_size_human}:{drive_id}"
+    system_drives, drive_list = get_system_drives(
+        session, cspec_drives, storage_root, drive_layout
+    )
 
-        # We found two drives, so create a RAID-1 array then determine the volume's detect string
-        elif len(system_drives) == 2:
-            logger.info(
-                "Found two drives matching the requested chassis IDs, creating a RAID-1 and using it as the system disk."
-            )
+    # We found a single drive, so determine its actual detect string
+    if len(system_drives) == 1:
+        logger.info(
+            "Found a single drive matching the requested chassis ID, using it as the system disk."
+        )
 
-            drive_one = system_drives[0]
-            drive_one_id = drive_one.get("Id", "INVALID")
-            drive_one_path = drive_one.get("@odata.id", "INVALID")
-            drive_one_controller = drive_one_id.split(":")[-1]
-            drive_two = system_drives[1]
-            drive_two_id = drive_two.get("Id", "INVALID")
-            drive_two_path = drive_two.get("@odata.id", "INVALID")
-            drive_two_controller = drive_two_id.split(":")[-1]
-
-            # Determine that the drives are on the same controller
-            if drive_one_controller != drive_two_controller:
-                logger.error(
-                    "Two drives are not on the same controller; this should not happen"
-                )
-                return None
+        # Get the model's first word
+        drive_model = system_drives[0].get("Model", "INVALID").split()[0]
+        # Get and convert the size in bytes value to human
+        drive_size_bytes = system_drives[0].get("CapacityBytes", 0)
+        drive_size_human = format_bytes_tohuman(drive_size_bytes)
+        # Get the drive ID out of all the valid entries
+        # How this works is that, for each non-array disk, we must find what position our exact disk is
+        # So for example, say we want disk 3 out of 4, and all 4 are the same size and model and not in
+        # another (RAID) volume. This will give us an index of 2. Then in the installer this will match
+        # the 3rd list entry from "lsscsi". This is probably an unneccessary hack, since people will
+        # probably just give the first disk if they want one, or 2 disks if they want a RAID-1, but this
+        # is here just in case
+        idx = 0
+        for drive in drive_list:
+            list_drive_model = drive.get("Model", "INVALID").split()[0]
+            list_drive_size_bytes = drive.get("CapacityBytes", 0)
+            list_drive_in_array = (
+                False
+                if drive.get("Links", {})
+                .get("Volumes", [""])[0]
+                .get("@odata.id")
+                .split("/")[-1]
+                == drive.get("Id")
+                else True
+            )
+            if (
+                drive_model == list_drive_model
+                and drive_size_bytes == list_drive_size_bytes
+                and not list_drive_in_array
+            ):
+                if drive.get("@odata.id") == system_drives[0].get("@odata.id"):
+                    index = idx
+                idx += 1
+        drive_id = index
 
-            # Get the controller details
-            controller_root = f"{storage_root}/{drive_one_controller}"
-            controller_detail = session.get(controller_root)
+        # Create the target string
+        system_drive_target = f"detect:{drive_model}:{drive_size_human}:{drive_id}"
+        drive_layout["target"] = system_drive_target
 
-            # Get the name of the controller (for crafting the detect string)
-            controller_name = controller_detail.get("Name", "INVALID").split()[0]
+    # We found two drives, so create a RAID-1 array then determine the volume's detect string
+    elif len(system_drives) == 2:
+        logger.info(
+            "Found two drives matching the requested chassis IDs, creating a RAID-1 and using it as the system disk."
+        )
 
-            # Get the volume root for the controller
-            controller_volume_root = controller_detail.get("Volumes", {}).get(
-                "@odata.id"
+        drive_one = system_drives[0]
+        drive_one_id = drive_one.get("Id", "INVALID")
+        drive_one_path = drive_one.get("@odata.id", "INVALID")
+        drive_one_controller = drive_one_id.split(":")[-1]
+        drive_two = system_drives[1]
+        drive_two_id = drive_two.get("Id", "INVALID")
+        drive_two_path = drive_two.get("@odata.id", "INVALID")
+        drive_two_controller = drive_two_id.split(":")[-1]
+
+        # Determine that the drives are on the same controller
+        if drive_one_controller != drive_two_controller:
+            logger.error(
+                "Two drives are not on the same controller; this should not happen"
             )
+            return None
 
-            # Get the pre-creation list of volumes on the controller
-            controller_volumes_pre = [
-                volume["@odata.id"]
-                for volume in session.get(controller_volume_root).get("Members", [])
-            ]
+        # Get the controller details
+        controller_root = f"{storage_root}/{drive_one_controller}"
+        controller_detail = session.get(controller_root)
+
+        # Get the name of the controller (for crafting the detect string)
+        controller_name = controller_detail.get("Name", "INVALID").split()[0]
+
+        # Get the volume root for the controller
+        controller_volume_root = controller_detail.get("Volumes", {}).get(
+            "@odata.id"
+        )
+
+        # Get the pre-creation list of volumes on the controller
+        controller_volumes_pre = [
+            volume["@odata.id"]
+            for volume in session.get(controller_volume_root).get("Members", [])
+        ]
 
+        # Use an existing volume of both drives, e.g. created by a Server Configuration
+        # Profile import or an earlier attempt, instead of creating another
+        new_volume_root = get_drives_volume(session, system_drives)
+        if new_volume_root is not None:
+            logger.info(f"Using existing RAID-1 volume {new_volume_root}")
+            controller_volumes_post = controller_volumes_pre
+        else:
             # Create the RAID-1 volume
             payload = {
                 "VolumeType": "Mirrored",
@@ -474,12 +1085,16 @@ def get_system_drive_target(session, cspec_node, storage_root):
                     {"@odata.id": drive_two_path},
                 ],
             }
-            session.post(controller_volume_root, payload)
+            if session.post_async(controller_volume_root, payload) is None:
+                logger.error("Failed to create RAID-1 volume on controller")
+                return None
 
-            # Wait for the volume to be created
+            # Wait for the volume to appear (some controllers complete the task before
+            # the volume is listed)
             new_volume_list = []
-            while len(new_volume_list) < 1:
-                sleep(5)
+            start = monotonic()
+            delay = 1
+            while True:
                 controller_volumes_post = [
                     volume["@odata.id"]
                     for volume in session.get(controller_volume_root).get("Members", [])
@@ -487,28 +1102,35 @@ def get_system_drive_target(session, cspec_node, storage_root):
                 new_volume_list = list(
                     set(controller_volumes_post).difference(controller_volumes_pre)
                 )
+                if len(new_volume_list) > 0:
+                    break
+                if monotonic() - start > 600:
+                    logger.error("Timed out waiting for RAID-1 volume to appear")
+                    return None
+                sleep(delay)
+                delay = min(delay * 2, 30)
             new_volume_root = new_volume_list[0]
 
-            # Get the IDX of the volume out of any others
-            volume_id = 0
-            for idx, volume in enumerate(controller_volumes_post):
-                if volume == new_volume_root:
-                    volume_id = idx
-                    break
+        # Get the IDX of the volume out of any others
+        volume_id = 0
+        for idx, volume in enumerate(controller_volumes_post):
+            if volume == new_volume_root:
+                volume_id = idx
+                break
 
-            # Get and convert the size in bytes value to human
-            volume_detail = session.get(new_volume_root)
-            volume_size_bytes = volume_detail.get("CapacityBytes", 0)
-            volume_size_human = format_bytes_tohuman(volume_size_bytes)
+        # Get and convert the size in bytes value to human
+        volume_detail = session.get(new_volume_root)
+        volume_size_bytes = volume_detail.get("CapacityBytes", 0)
+        volume_size_human = format_bytes_tohuman(volume_size_bytes)
 
-            # Create the target string
-            system_drive_target = (
-                f"detect:{controller_name}:{volume_size_human}:{volume_id}"
-            )
+        # Create the target string
+        system_drive_target = (
+            f"detect:{controller_name}:{volume_size_human}:{volume_id}"
+        )
 
-        # We found too few or too many drives, error
-        else:
-            system_drive_target = None
+    # We found too few or too many drives, error
+    else:
+        system_drive_target = None
 
     return system_drive_target
 
@@ -519,6 +1141,9 @@ def get_system_drive_target(session, cspec_node, storage_root):
 def set_indicator_state(session, system_root, redfish_vendor, state):
     """
     Set the system indicator LED to the desired state (on/off)
+
+    Returns True if the state was set, None if the LED is already in the state (so no
+    change was needed), or False if it failed or the system has no indicator LED.
     """
     state_values_write = {
         "Dell": {
@@ -553,7 +1178,8 @@ def set_indicator_state(session, system_root, redfish_vendor, state):
         # Get current state
         system_detail = session.get(system_root)
         current_state = system_detail["IndicatorLED"]
-    except KeyError:
+    except (KeyError, TypeError):
+        logger.warn("Failed to set indicator LED, the system has none")
         return False
 
     try:
@@ -566,20 +1192,27 @@ def set_indicator_state(session, system_root, redfish_vendor, state):
             state_read = state_values_read[redfish_vendor][state]
 
         if state_read == current_state:
-            return False
+            return None
     except KeyError:
         return False
 
-    session.patch(system_root, {"IndicatorLED": state})
+    return session.patch(system_root, {"IndicatorLED": state}) is not None
 
-    return True
 
+# The PowerState a system converges to after each ResetType (restarts are left out, as
+# they are never no-ops)
+reset_power_states = {
+    "On": "On",
+    "ForceOn": "On",
+    "ForceOff": "Off",
+    "GracefulShutdown": "Off",
+}
 
-def set_power_state(session, system_root, redfish_vendor, state):
+
+def get_reset_type(redfish_vendor, state):
     """
-    Set the system power state to the desired state
+    Get the ResetType for a desired state, allowing nice names ("on"/"off")
     """
-    logger.debug(f"Calling set_power_state with {session}, {system_root}, {redfish_vendor}, {state}")
     state_values = {
         "default": {
             "on": "On",
@@ -587,75 +1220,152 @@ def set_power_state(session, system_root, redfish_vendor, state):
         },
     }
 
-    try:
-        # Allow vendor-specific overrides
-        if redfish_vendor not in state_values:
-            redfish_vendor = "default"
-        # Allow nice names ("on"/"off")
-        if state in state_values[redfish_vendor]:
-            state = state_values[redfish_vendor][state]
+    # Allow vendor-specific overrides
+    if redfish_vendor not in state_values:
+        redfish_vendor = "default"
+    return state_values[redfish_vendor].get(state, state)
+
+
+def set_power_state(session, system_root, redfish_vendor, state):
+    """
+    Set the system power state to the desired state
+
+    Returns True if the reset was sent, None if the system is already in the state
+    (so none was needed), or False if it failed or the BMC does not support it.
+    """
+    logger.debug(f"Calling set_power_state with {session}, {system_root}, {redfish_vendor}, {state}")
+    state = get_reset_type(redfish_vendor, state)
 
+    try:
         # Get current state, target URI, and allowable values
         system_detail = session.get(system_root)
         current_state = system_detail["PowerState"]
         power_root = system_detail["Actions"]["#ComputerSystem.Reset"]["target"]
-        power_choices = system_detail["Actions"]["#ComputerSystem.Reset"][
+        power_choices = system_detail["Actions"]["#ComputerSystem.Reset"].get(
             "ResetType@Redfish.AllowableValues"
-        ]
-    except KeyError:
+        )
+    except (KeyError, TypeError):
         return False
 
-    # Remap some namings so we can check the current state against the target state
-    if state in ["ForceOff"]:
-        target_state = "Off"
-    else:
-        target_state = state
-
-#    if target_state == current_state:
-#        return False
+    # Skip transitions to the current state; restarts are never skipped
+    if reset_power_states.get(state) == current_state:
+        logger.info(f"System is already {current_state}; skipping {state}")
+        return None
 
-#    if state not in power_choices:
-#        return False
+    # Not all BMCs list their allowable values
+    if power_choices is not None and state not in power_choices:
+        logger.warn(f"Reset type {state} not in supported {power_choices}")
+        return False
 
-    session.post(power_root, {"ResetType": state})
+    if session.post_async(power_root, {"ResetType": state}, timeout=300) is None:
+        return False
 
     return True
 
 
-def set_boot_override(session, system_root, redfish_vendor, target):
+def converge_power_state(
+    config,
+    session,
+    system_root,
+    redfish_vendor,
+    state,
+    ceiling,
+    interval=2,
+    bmc_events=None,
+    check=None,
+):
     """
-    Set the system boot override to the desired target
+    Set the system power state to the desired state, and verify that it converges
+    within 'ceiling' seconds (see wait_ready; 'check' names the readiness check)
+
+    A GracefulShutdown which is not supported, or which the operating system does not
+    complete in time, is escalated to a ForceOff, waiting for up to the "power"
+    readiness ceiling. The time taken is recorded as the
+    "redfish_power_transition_seconds" metric. Returns whether the state was reached.
     """
-    print(redfish_vendor)
-    system_detail = session.get(system_root)
+    state = get_reset_type(redfish_vendor, state)
+    target_state = reset_power_states.get(state, "On")
 
-    def set_boot_override_dell():
-        try:
-            boot_targets = system_detail["Boot"]["BootSourceOverrideTarget@Redfish.AllowableValues"]
-        except KeyError:
-            logger.warn(f"Failed to set boot override, no BootSourceOverrideSupported key at {system_detail}")
+    start = monotonic()
+    result = set_power_state(session, system_root, redfish_vendor, state)
+    if result is None:
+        metrics.increment(
+            config,
+            "redfish_power_transitions_total",
+            reset_type=state,
+            result="skipped",
+        )
+        return True
+
+    reached = result and wait_ready(
+        config,
+        check if check is not None else f"power_{target_state.lower()}",
+        lambda: probe_power_state(session, system_root, target_state),
+        ceiling,
+        interval=interval,
+        bmc_events=bmc_events,
+    )
+    if not reached and state == "GracefulShutdown":
+        logger.warn("Graceful shutdown did not complete; forcing power off")
+        metrics.increment(
+            config,
+            "redfish_power_transitions_total",
+            reset_type=state,
+            result="escalated",
+        )
+        result = set_power_state(session, system_root, redfish_vendor, "ForceOff")
+        reached = result is not False and wait_ready(
+            config,
+            "power_off",
+            lambda: probe_power_state(session, system_root, "Off"),
+            config["redfish_ready_timeout_power"],
+            interval=interval,
+            bmc_events=bmc_events,
+        )
+
+    elapsed = monotonic() - start
+    logger.info(f"Power transition {state} took {elapsed:.1f}s; reached: {reached}")
+    metrics.observe(
+        config, "redfish_power_transition_seconds", elapsed, reset_type=state
+    )
+    metrics.increment(
+        config,
+        "redfish_power_transitions_total",
+        reset_type=state,
+        result="converged" if reached else "failed",
+    )
+    return reached
+
+
+def set_boot_override(session, system_root, redfish_vendor, target, boot_targets=None):
+    """
+    Set the system boot override to the desired target
+
+    The supported targets are read from the system, unless given as 'boot_targets'.
+    Returns whether the override was set.
+    """
+    if boot_targets is None:
+        system_detail = session.get(system_root)
+        boot_targets = get_boot_targets(system_detail, redfish_vendor)
+        if boot_targets is None:
+            logger.warn(f"Failed to set boot override, no supported targets at {system_detail}")
             return False
 
+    def set_boot_override_dell():
         if target not in boot_targets:
             logger.warn(f"Failed to set boot override, key {target} not in {boot_targets}")
             return False
 
-        session.patch(system_root, {"Boot": {"BootSourceOverrideMode": "UEFI", "BootSourceOverrideTarget": target}})
-        return True
+        result = session.patch(system_root, {"Boot": {"BootSourceOverrideMode": "UEFI", "BootSourceOverrideTarget": target}})
+        return result is not None
 
     def set_boot_override_generic():
-        try:
-            boot_targets = system_detail["Boot"]["BootSourceOverrideSupported"]
-        except KeyError:
-            logger.warn(f"Failed to set boot override, no BootSourceOverrideSupported key at {system_detail}")
-            return False
-
         if target not in boot_targets:
             logger.warn(f"Failed to set boot override, key {target} not in {boot_targets}")
             return False
 
-        session.patch(system_root, {"Boot": {"BootSourceOverrideTarget": target}})
-        return True
+        result = session.patch(system_root, {"Boot": {"BootSourceOverrideTarget": target}})
+        return result is not None
 
     if redfish_vendor == "Dell":
         return set_boot_override_dell()
@@ -663,36 +1373,688 @@ def set_boot_override(session, system_root, redfish_vendor, target):
         return set_boot_override_generic()
 
 
-def check_redfish(config, data):
+#
+# Settings functions
+#
+def get_settings_changes(current, desired):
     """
-    Validate that a BMC is Redfish-capable
+    Get the desired settings which differ from the current ones; settings the
+    resource does not have are skipped
     """
-    headers = {"Content-Type": "application/json"}
-    logger.info("Checking for Redfish response...")
-    count = 0
-    while True:
+    changes = dict()
+    for setting, value in desired.items():
+        if setting not in current:
+            logger.warn(f"Skipping unsupported setting {setting}")
+            continue
+        if current[setting] != value:
+            changes[setting] = value
+    return changes
+
+
+def apply_bios_settings(session, bios_root, settings):
+    """
+    Apply the BIOS settings which differ from the current (or already pending) ones,
+    with a single PATCH of the BIOS settings resource, and so a single configuration
+    job, applied at the next reset where the BMC supports it
+
+    Returns the changed settings (empty if none differed), or None if applying failed.
+    """
+    bios_detail = session.get(bios_root)
+    changes = get_settings_changes(bios_detail["Attributes"], settings)
+    if len(changes) < 1:
+        return changes
+
+    settings_info = bios_detail.get("@Redfish.Settings", {})
+    settings_root = settings_info.get("SettingsObject", {}).get(
+        "@odata.id", f"{bios_root}/Settings"
+    )
+
+    # Leave out any changes still pending (e.g. from an earlier attempt), since some
+    # BMCs (e.g. iDRAC) reject new changes while a configuration job is scheduled
+    settings_detail = session.get(settings_root)
+    if settings_detail is not None:
+        pending = settings_detail.get("Attributes", {})
+        changes = {
+            setting: value
+            for setting, value in changes.items()
+            if pending.get(setting) != value
+        }
+        if len(changes) < 1:
+            logger.info("BIOS settings already pending")
+            return changes
+
+    logger.info(f"Changing BIOS settings: {changes}")
+    payload = {"Attributes": changes}
+    if "OnReset" in settings_info.get("SupportedApplyTimes", []):
+        payload["@Redfish.SettingsApplyTime"] = {"ApplyTime": "OnReset"}
+    if session.patch_async(settings_root, payload) is None:
+        return None
+    return changes
+
+
+def apply_manager_settings(session, manager_root, settings):
+    """
+    Apply the Manager settings which differ from the current ones with a single PATCH
+
+    Returns the changed settings (empty if none differed), or None if applying failed.
+    """
+    attributes_root = f"{manager_root}/Attributes"
+    attributes_detail = session.get(attributes_root)
+    changes = get_settings_changes(attributes_detail["Attributes"], settings)
+    if len(changes) < 1:
+        return changes
+
+    logger.info(f"Changing Manager settings: {changes}")
+    if session.patch(attributes_root, {"Attributes": changes}) is None:
+        return None
+    return changes
+
+
+#
+# Dell Server Configuration Profile functions
+#
+def get_scp_attributes(settings, separator=None):
+    """
+    Convert settings to Server Configuration Profile attributes; iDRAC attributes
+    (like "IPMILan.1.Enable") use a '#' 'separator' between group and name instead
+    """
+    attributes = list()
+    for setting, value in settings.items():
+        if separator is not None and "." in setting:
+            setting = separator.join(setting.rsplit(".", 1))
+        attributes.append({"Name": setting, "Value": value})
+    return attributes
+
+
+def get_scp_volume(session, storage_root, system_drives):
+    """
+    Get the Server Configuration Profile component creating a RAID-1 volume of the
+    two system drives, or None if there are not two drives or they already have one
+    """
+    if len(system_drives) != 2:
+        return None
+    if get_drives_volume(session, system_drives) is not None:
+        return None
+
+    drive_ids = [drive.get("Id", "INVALID") for drive in system_drives]
+    controller_id = drive_ids[0].split(":")[-1]
+    if drive_ids[1].split(":")[-1] != controller_id:
+        return None
+
+    # New virtual disks are numbered after any existing ones on the controller
+    controller_detail = session.get(f"{storage_root}/{controller_id}")
+    controller_volume_root = controller_detail.get("Volumes", {}).get("@odata.id")
+    virtual_disks = [
+        volume
+        for volume in session.get(controller_volume_root).get("Members", [])
+        if volume["@odata.id"].split("/")[-1].startswith("Disk.Virtual.")
+    ]
+
+    attributes = [
+        {"Name": "RAIDaction", "Value": "Create"},
+        {"Name": "Name", "Value": "System"},
+        {"Name": "RAIDTypes", "Value": "RAID 1"},
+        {"Name": "SpanDepth", "Value": "1"},
+        {"Name": "SpanLength", "Value": "2"},
+    ]
+    for drive_id in drive_ids:
+        attributes.append({"Name": "IncludedPhysicalDiskID", "Value": drive_id})
+    return {
+        "FQDD": controller_id,
+        "Components": [
+            {
+                "FQDD": f"Disk.Virtual.{len(virtual_disks)}:{controller_id}",
+                "Attributes": attributes,
+            }
+        ],
+    }
+
+
+def render_scp(bios_settings, manager_settings, volume=None):
+    """
+    Render a Server Configuration Profile of the BIOS and iDRAC settings, and the
+    RAID 'volume' component if any
+    """
+    components = list()
+    if len(bios_settings) > 0:
+        components.append(
+            {"FQDD": "BIOS.Setup.1-1", "Attributes": get_scp_attributes(bios_settings)}
+        )
+    if len(manager_settings) > 0:
+        components.append(
+            {
+                "FQDD": "iDRAC.Embedded.1",
+                "Attributes": get_scp_attributes(manager_settings, separator="#"),
+            }
+        )
+    if volume is not None:
+        components.append(volume)
+    return {"SystemConfiguration": {"Components": components}}
+
+
+def import_scp(session, manager_root, scp, timeout=1800):
+    """
+    Import a Server Configuration Profile, applying all of its components with a
+    single job, and leave the system powered off; returns whether it succeeded
+
+    The iDRAC skips any attributes already set, and does not reset the system at all
+    if none differ.
+    """
+    payload = {
+        "ImportBuffer": json.dumps(scp),
+        "ShareParameters": {"Target": "ALL"},
+        "ShutdownType": "Graceful",
+        "HostPowerState": "Off",
+    }
+    result = session.post_async(
+        f"{manager_root}/Actions/Oem/EID_674_Manager.ImportSystemConfiguration",
+        payload,
+        timeout=timeout,
+    )
+    return result is not None
+
+
+def apply_scp(session, cspec_node, manager_root, storage_root, drive_layout, timeout):
+    """
+    Apply the BIOS and iDRAC settings of a node, and create its system RAID-1 volume
+    if it has two system drives, with a single Server Configuration Profile import;
+    returns whether it succeeded
+
+    As for get_system_drive_target, 'drive_layout' is used or filled in by the walk.
+    """
+    cspec_drives = cspec_node["config"]["system_disks"][0:2]
+    volume = None
+    if (
+        storage_root is not None
+        and drive_layout.get("target") is None
+        and not any(re.match(r"^(\/dev|detect:)", drive) for drive in cspec_drives)
+    ):
+        system_drives, _ = get_system_drives(
+            session, cspec_drives, storage_root, drive_layout
+        )
+        volume = get_scp_volume(session, storage_root, system_drives)
+
+    scp = render_scp(
+        cspec_node["bmc"].get("bios_settings", {}),
+        cspec_node["bmc"].get("manager_settings", {}),
+        volume,
+    )
+    if len(scp["SystemConfiguration"]["Components"]) < 1:
+        return True
+    return import_scp(session, manager_root, scp, timeout=timeout)
+
+
+#
+# Redfish capability detection
+#
+def redfish_signature(data):
+    """
+    Return the vendor signature of a BMC from its DNSMasq checkin: the DHCP vendor
+    class if it sent one, or the OUI of its MAC address otherwise
+    """
+    if data.get("vendor_class"):
+        return f"vendor-class:{data['vendor_class']}"
+    return f"oui:{data['macaddr'].lower()[:8]}"
+
+
+def get_redfish_verdict(config, key):
+    """
+    Get a cached Redfish capability verdict; returns None if there is none
+    """
+    try:
+        verdict = events.get_redis(config).get(f"pvcbootstrapd:redfish-capable:{key}")
+    except Exception as e:
+        logger.warn(f"Failed to get cached Redfish verdict for {key}: {e}")
+        return None
+    if verdict is None:
+        return None
+    return verdict in [b"1", "1"]
+
+
+def set_redfish_verdict(config, key, verdict):
+    """
+    Cache a Redfish capability verdict for the configured time
+    """
+    try:
+        events.get_redis(config).set(
+            f"pvcbootstrapd:redfish-capable:{key}",
+            "1" if verdict else "0",
+            ex=config["redfish_detect_cache_ttl"],
+        )
+    except Exception as e:
+        logger.warn(f"Failed to cache Redfish verdict for {key}: {e}")
+
+
+def probe_redfish(ipaddr, policy):
+    """
+    Probe if a BMC answers as a Redfish service, under a retry policy
+
+    A cheap TCP connection to the HTTPS port is tried first, with the policy's backoff
+    while the BMC is booting, before the service root is requested. Returns True or
+    False for a definitive answer, or None if the BMC did not answer in time.
+    """
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    url = urlsplit(f"https://{ipaddr}")
+    for attempt in policy.attempts():
         try:
-            count += 1
-            if count > 30:
-                retcode = 500
-                logger.warn("Aborted after 300s; device too slow or not booting.")
-                break
-            resp = requests.get(
-                f"https://{data['ipaddr']}/redfish/v1",
-                headers=headers,
+            with socket.create_connection((url.hostname, url.port or 443), timeout=2):
+                pass
+            response = requests.get(
+                f"https://{ipaddr}/redfish/v1",
+                headers={"Content-Type": "application/json"},
                 verify=False,
                 timeout=10,
             )
-            retcode = resp.retcode
+            if response.status_code == 200:
+                return True
+            if response.status_code < 500:
+                logger.info(f"Redfish service root answered {response.status_code}")
+                return False
+        except Exception as e:
+            logger.debug(f"Redfish probe of {ipaddr} failed ({attempt}): {e}")
+    return None
+
+
+def check_redfish(config, data):
+    """
+    Validate that a BMC is Redfish-capable
+
+    Verdicts are cached per BMC MAC address and per vendor signature (see
+    redfish_signature()). The BMC is probed until it answers, for at most the
+    configured detection timeout, unless it has a cached verdict of its own. A vendor
+    signature only identifies the NIC vendor, not the BMC model, so its verdict only
+    sets how often a BMC is probed: one of a vendor known to be Redfish-capable is
+    probed more often, to catch its service as soon as it answers.
+    """
+    macaddr = data["macaddr"].lower()
+    signature = redfish_signature(data)
+
+    verdict = get_redfish_verdict(config, f"mac:{macaddr}")
+    if verdict is not None:
+        logger.info(f"Using cached Redfish verdict for {macaddr}: {verdict}")
+        return verdict
+
+    vendor_verdict = get_redfish_verdict(config, signature)
+    if vendor_verdict is not None:
+        logger.info(f"Found cached Redfish verdict for {signature}: {vendor_verdict}")
+
+    logger.info("Checking for Redfish response...")
+    policy = retry.RetryPolicy(
+        max_attempts=None,
+        base_delay=1,
+        max_delay=4 if vendor_verdict else 16,
+        deadline=config["redfish_detect_timeout"],
+        jitter=False,
+    )
+    start = monotonic()
+    verdict = probe_redfish(data["ipaddr"], policy)
+    metrics.observe(config, "redfish_detect_seconds", monotonic() - start)
+
+    if verdict is None:
+        # The BMC never answered, which says nothing about its vendor; don't cache it
+        logger.warn(
+            f"Aborted after {config['redfish_detect_timeout']}s; "
+            "device too slow or not booting."
+        )
+        return False
+
+    set_redfish_verdict(config, f"mac:{macaddr}", verdict)
+    set_redfish_verdict(config, signature, verdict)
+    return verdict
+
+
+#
+# EventService functions
+#
+def get_event_subscriptions(session, subscriptions_root, context):
+    """
+    Get the URIs of any event subscriptions on the BMC with the given Context
+    """
+    subscriptions_detail = session.get_collection(
+        subscriptions_root, select=["Context"]
+    )
+    if subscriptions_detail is None:
+        return []
+    return [
+        member["@odata.id"]
+        for member in session.get_members(subscriptions_detail.get("Members", []))
+        if member is not None and member.get("Context") == context
+    ]
+
+
+def create_event_subscription(session, destination, context):
+    """
+    Subscribe the event receiver at 'destination' to events from the BMC, tagged with
+    'context' (the BMC MAC address) to identify the node
+
+    Any previous subscriptions with the same context (e.g. from an earlier, aborted
+    run) are removed first. Returns the URI of the new subscription, or None if the
+    BMC does not support event subscriptions.
+    """
+    try:
+        event_service = session.get("/redfish/v1/EventService")
+    except Exception as e:
+        logger.debug(f"Failed to get EventService: {e}")
+        return None
+    if event_service is None or not event_service.get("ServiceEnabled", True):
+        return None
+    subscriptions_root = event_service.get("Subscriptions", {}).get("@odata.id")
+    if subscriptions_root is None:
+        return None
+
+    for subscription in get_event_subscriptions(session, subscriptions_root, context):
+        logger.debug(f"Removing stale event subscription {subscription}")
+        session.delete(subscription)
+
+    payload = {
+        "Destination": destination,
+        "Context": context,
+        "Protocol": "Redfish",
+    }
+    # Older services (e.g. iDRAC) require the (since deprecated) EventTypes
+    event_types = event_service.get("EventTypesForSubscription", [])
+    if len(event_types) > 0:
+        payload["EventTypes"] = [
+            event_type
+            for event_type in ["StatusChange", "ResourceUpdated", "Alert"]
+            if event_type in event_types
+        ] or event_types
+
+    if session.post(subscriptions_root, payload) is None:
+        return None
+
+    subscriptions = get_event_subscriptions(session, subscriptions_root, context)
+    if len(subscriptions) < 1:
+        return None
+    return subscriptions[0]
+
+
+def delete_event_subscription(session, subscription):
+    """
+    Remove an event subscription from the BMC
+    """
+    if subscription is None:
+        return
+    try:
+        session.delete(subscription)
+    except Exception as e:
+        logger.warn(f"Failed to remove event subscription {subscription}: {e}")
+
+
+def wait_event(bmc_events, timeout):
+    """
+    Wait up to 'timeout' seconds for a Redfish event on a BMC event subscription;
+    returns whether an event was received
+    """
+    try:
+        message = bmc_events.get_message(timeout=timeout)
+    except Exception as e:
+        logger.debug(f"Failed to receive Redfish events: {e}")
+        sleep(timeout)
+        return False
+    if message is None:
+        return False
+
+    try:
+        event = json.loads(message["data"])
+        message_ids = [e.get("MessageId") for e in event.get("Events", [])]
+    except Exception:
+        message_ids = []
+    logger.debug(f"Received Redfish event: {message_ids}")
+    return True
+
+
+#
+# Readiness functions
+#
+# Resource Status states during which a Manager or System is not ready for configuration
+transitional_states = ["Starting", "InTest", "Updating", "Deferring", "Quiesced"]
+
+# Task and (Dell) job states of operations still in progress on the BMC
+active_task_states = ["New", "Starting", "Running", "Pending", "Stopping", "Cancelling"]
+active_job_states = ["Starting", "Running", "Downloading"]
+
+# Task and (Dell) job states of operations that have ended, and will not change again
+finished_task_states = ["Completed", "Killed", "Exception", "Cancelled"]
+finished_job_states = ["Completed", "CompletedWithErrors", "Failed"]
+
+
+def wait_ready(config, check, probe, ceiling, interval=2, bmc_events=None):
+    """
+    Wait until probe() returns True, for at most 'ceiling' seconds
+
+    If 'bmc_events' (a BMC event subscription) is given, the probe is retried as soon
+    as an event arrives, and otherwise every 'interval' seconds as a fallback.
+
+    Returns whether the probe succeeded; the time waited is recorded as the
+    "redfish_ready_wait_seconds" metric for the check.
+    """
+    start = monotonic()
+    while True:
+        try:
+            ready = probe()
+        except Exception as e:
+            logger.debug(f"Readiness probe {check} failed: {e}")
+            ready = False
+        if ready or monotonic() - start >= ceiling:
             break
-        except Exception:
-            logger.info(f"Attempt {count}...")
-            continue
+        # Don't overshoot the ceiling by more than one probe
+        delay = max(min(interval, ceiling - (monotonic() - start)), 0.1)
+        if bmc_events is not None:
+            wait_event(bmc_events, delay)
+        else:
+            sleep(delay)
 
-    if retcode == 200:
-        return True
+    waited = monotonic() - start
+    if ready:
+        logger.info(f"Readiness check {check} passed after {waited:.1f}s")
     else:
+        logger.warn(f"Readiness check {check} failing after {ceiling}s; continuing")
+    metrics.observe(config, "redfish_ready_wait_seconds", waited, check=check)
+    return ready
+
+
+def probe_service_root(bmc_host):
+    """
+    Probe if the (unauthenticated) Redfish service root answers
+    """
+    response = requests.get(f"{bmc_host}/redfish/v1", verify=False, timeout=5)
+    return response.status_code == 200
+
+
+def probe_resource_status(session, resource_root):
+    """
+    Probe if a resource (Manager or System) has left any transitional Status state
+    """
+    resource_detail = session.get(resource_root)
+    if resource_detail is None:
+        return False
+    return resource_detail.get("Status", {}).get("State") not in transitional_states
+
+
+def probe_operations_idle(
+    session, collection_root, state_key, active_states, finished_states, finished
+):
+    """
+    Probe if no member of a task or job collection is in one of the 'active_states'
+
+    Members seen in one of the 'finished_states' are added to the 'finished' set and
+    skipped on later probes, as BMCs keep hundreds of them.
+    """
+    collection_detail = session.get_collection(
+        collection_root,
+        select=[state_key],
+        filter_by=" or ".join(f"{state_key} eq '{state}'" for state in active_states),
+    )
+    if collection_detail is None:
+        return True
+
+    members = [
+        member
+        for member in collection_detail.get("Members", [])
+        if member["@odata.id"] not in finished
+    ]
+    for member, member_detail in zip(members, session.get_members(members)):
+        if member_detail is None:
+            continue
+        if member_detail.get(state_key) in active_states:
+            return False
+        if member_detail.get(state_key) in finished_states:
+            finished.add(member["@odata.id"])
+    return True
+
+
+def probe_tasks_idle(session, redfish_vendor, manager_root, finished=None):
+    """
+    Probe if the BMC has no tasks (or Dell jobs) in progress
+
+    Only active tasks are listed when the BMC supports $filter; otherwise, pass the
+    same 'finished' set to each probe so that finished tasks are only fetched once.
+    """
+    if finished is None:
+        finished = set()
+
+    task_service_detail = session.get("/redfish/v1/TaskService")
+    if task_service_detail is not None and "Tasks" in task_service_detail:
+        if not probe_operations_idle(
+            session,
+            task_service_detail["Tasks"]["@odata.id"],
+            "TaskState",
+            active_task_states,
+            finished_task_states,
+            finished,
+        ):
+            return False
+
+    if redfish_vendor == "Dell":
+        if not probe_operations_idle(
+            session,
+            f"{manager_root}/Jobs",
+            "JobState",
+            active_job_states,
+            finished_job_states,
+            finished,
+        ):
+            return False
+
+    return True
+
+
+def probe_power_state(session, system_root, power_state):
+    """
+    Probe if the system PowerState has converged to the given state
+    """
+    system_detail = session.get(system_root)
+    if system_detail is None:
         return False
+    return system_detail.get("PowerState") == power_state
+
+
+#
+# Discovery cache functions
+#
+# Phases of redfish_init, in order, which are skipped on a later attempt once completed
+discovery_phases = ["characterized", "system_disk", "bios_settings", "manager_settings"]
+
+
+def get_cspec_fingerprint(cspec_node):
+    """
+    Return a fingerprint of a node specification, to detect changes between attempts
+    """
+    cspec_json = json.dumps(cspec_node, sort_keys=True, default=str)
+    return hashlib.sha256(cspec_json.encode()).hexdigest()
+
+
+def check_node_discovery(session, discovery):
+    """
+    Check that a cached discovery still matches the BMC, with a single request to its
+    System; returns whether it does
+    """
+    try:
+        system_detail = session.get(discovery.system_root)
+    except Exception as e:
+        logger.debug(f"Failed to get cached System {discovery.system_root}: {e}")
+        return False
+    if system_detail is None:
+        return False
+    return system_detail.get("SerialNumber", "").strip() == discovery.serial
+
+
+def phase_completed(discovery, phase):
+    """
+    Return whether a phase of redfish_init was completed by an earlier attempt
+    """
+    if discovery is None or discovery.phase not in discovery_phases:
+        return False
+    return discovery_phases.index(discovery.phase) >= discovery_phases.index(phase)
+
+
+def complete_phase(config, cluster_name, name, discovery, phase):
+    """
+    Record that a phase of redfish_init completed, unless an earlier attempt had
+    """
+    if not phase_completed(discovery, phase):
+        discovery.phase = phase
+        db.set_node_discovery(config, cluster_name, name, discovery)
+
+
+#
+# Hardware profile functions
+#
+def get_storage_topology(session, storage_root):
+    """
+    Return a signature of the storage topology of a system: each storage controller
+    and the drive bays attached to it
+    """
+    if storage_root is None:
+        return "none"
+
+    storage_detail = session.get_collection(storage_root, select=["Id", "Drives"])
+    storage_member_details = session.get_members(storage_detail["Members"])
+    topology = sorted(
+        [
+            storage_member_detail.get("Id"),
+            sorted(drive["@odata.id"] for drive in storage_member_detail["Drives"]),
+        ]
+        for storage_member_detail in storage_member_details
+    )
+    return hashlib.sha256(json.dumps(topology).encode()).hexdigest()
+
+
+def get_system_model(system_detail, redfish_vendor):
+    """
+    Get the model identity of a system: its SKU (product number), except on Dell where
+    the SKU is the per-system service tag, so the Model name is used instead
+    """
+    if redfish_vendor == "Dell" or not system_detail.get("SKU", "").strip():
+        return system_detail.get("Model", "").strip()
+    return system_detail["SKU"].strip()
+
+
+def get_hardware_profile(config, session, redfish_vendor, system_model, storage_root):
+    """
+    Get the hardware profile of the system's model (vendor, model and storage
+    topology), or a new, empty profile if no identical node was initialized before
+    """
+    topology = get_storage_topology(session, storage_root)
+    profile = db.get_hardware_profile(config, redfish_vendor, system_model, topology)
+    if profile is not None:
+        logger.info(f"Using the hardware profile for {redfish_vendor} {system_model}")
+        return profile
+
+    logger.info(f"No hardware profile for {redfish_vendor} {system_model} yet")
+    return HardwareProfile(None, redfish_vendor, system_model, topology, {}, None)
+
+
+def get_boot_targets(system_detail, redfish_vendor):
+    """
+    Get the boot override targets a system supports, or None if it lists none
+    """
+    if redfish_vendor == "Dell":
+        key = "BootSourceOverrideTarget@Redfish.AllowableValues"
+    else:
+        key = "BootSourceOverrideSupported"
+    return system_detail.get("Boot", {}).get(key)
 
 
 #
@@ -719,8 +2081,13 @@ def redfish_init(config, cspec, data):
     cspec_hostname = cspec_node["node"]["hostname"]
     cspec_fqdn = cspec_node["node"]["fqdn"]
 
-    logger.info("Waiting 30 seconds for system normalization")
-    sleep(30)
+    logger.info("Waiting for the Redfish service to answer")
+    wait_ready(
+        config,
+        "service_root",
+        lambda: probe_service_root(bmc_host),
+        config["redfish_ready_timeout_service"],
+    )
 
     notifications.send_webhook(config, "begin", f"Cluster {cspec_cluster}: Beginning Redfish initialization of host {cspec_fqdn}")
 
@@ -743,239 +2110,466 @@ def redfish_init(config, cspec, data):
     node = db.get_node(config, cspec_cluster, name=cspec_hostname)
     logger.debug(node)
 
-    # Create the session and log in
-    session = RedfishSession(bmc_host, bmc_username, bmc_password)
-    if session.host is None:
-        notifications.send_webhook(config, "failure", f"Cluster {cspec_cluster}: Failed to log in to Redfish for host {cspec_fqdn} at {bmc_host}. Check pvcbootstrapd logs and reset this host's BMC to retry.")
-        logger.error("Aborting Redfish configuration; reset BMC to retry.")
-        del session
-        return
-    notifications.send_webhook(config, "success", f"Cluster {cspec_cluster}: Logged in to Redfish for host {cspec_fqdn} at {bmc_host}")
-
-    logger.info("Waiting 30 seconds for system normalization")
-    sleep(30)
-
-    logger.info("Characterizing node...")
-    notifications.send_webhook(config, "begin", f"Cluster {cspec_cluster}: Beginning Redfish characterization of host {cspec_fqdn} at {bmc_host}")
-    try:
+    # Any discovery cached by an earlier attempt, and the phase it got through
+    discovery = db.get_node_discovery(config, cspec_cluster, cspec_hostname)
+    fingerprint = get_cspec_fingerprint(cspec_node)
 
-        # Get Refish bases
-        logger.debug("Getting redfish bases")
-        redfish_base_root = "/redfish/v1"
-        redfish_base_detail = session.get(redfish_base_root)
+    # Wait for a free Redfish session slot; released once the node is powered on
+    scheduler.acquire_slot(config, "redfish_sessions", cspec_cluster, bmc_macaddr)
 
-        redfish_vendor = list(redfish_base_detail["Oem"].keys())[0]
-        redfish_name = redfish_base_detail["Name"]
-        redfish_version = redfish_base_detail["RedfishVersion"]
-
-        managers_base_root = redfish_base_detail["Managers"]["@odata.id"].rstrip("/")
-        managers_base_detail = session.get(managers_base_root)
-        manager_root = managers_base_detail["Members"][0]["@odata.id"].rstrip("/")
-
-        systems_base_root = redfish_base_detail["Systems"]["@odata.id"].rstrip("/")
-        systems_base_detail = session.get(systems_base_root)
-        system_root = systems_base_detail["Members"][0]["@odata.id"].rstrip("/")
-
-        # Force off the system and turn on the indicator
-        logger.debug("Force off the system and turn on the indicator")
-        set_power_state(session, system_root, redfish_vendor, "off")
-        set_indicator_state(session, system_root, redfish_vendor, "on")
+    # Lease a (pooled) session, logged in to the BMC; it is returned to the pool once
+    # this block ends, however it does
+    with get_session_pool(config).session(
+        bmc_host, bmc_username, bmc_password, max_fanout=config["redfish_max_fanout"]
+    ) as session:
+        if session is None:
+            notifications.send_webhook(config, "failure", f"Cluster {cspec_cluster}: Failed to log in to Redfish for host {cspec_fqdn} at {bmc_host}. Check pvcbootstrapd logs and reset this host's BMC to retry.")
+            logger.error("Aborting Redfish configuration; reset BMC to retry.")
+            return
+        notifications.send_webhook(config, "success", f"Cluster {cspec_cluster}: Logged in to Redfish for host {cspec_fqdn} at {bmc_host}")
 
-        # Get the system details
-        logger.debug("Get the system details")
-        system_detail = session.get(system_root)
+        # Trace the requests of this node, until the session is returned to the pool
+        if config["redfish_trace_path"]:
+            session.start_trace(f"{config['redfish_trace_path']}/{cspec_cluster}-{cspec_hostname}.jsonl")
 
-        system_sku = system_detail["SKU"].strip()
-        system_serial = system_detail["SerialNumber"].strip()
-        system_power_state = system_detail["PowerState"].strip()
-        system_indicator_state = system_detail["IndicatorLED"].strip()
-        system_health_state = system_detail["Status"]["Health"].strip()
+        # The BMC event subscription, if any (see create_event_subscription)
+        event_subscription = None
+        bmc_events = None
 
-        # Walk down the EthernetInterfaces construct to get the bootstrap interface MAC address
-        logger.debug("Walk down the EthernetInterfaces construct to get the bootstrap interface MAC address")
         try:
-            ethernet_root = system_detail["EthernetInterfaces"]["@odata.id"].rstrip("/")
-            ethernet_detail = session.get(ethernet_root)
-            logger.debug(f"Found Ethernet detail: {ethernet_detail}")
-            embedded_ethernet_detail_members = [e for e in ethernet_detail["Members"] if "Embedded" in e["@odata.id"]]
-            embedded_ethernet_detail_members.sort(key = lambda k: k["@odata.id"])
-            logger.debug(f"Found Ethernet members: {embedded_ethernet_detail_members}")
-            first_interface_root = embedded_ethernet_detail_members[0]["@odata.id"].rstrip("/")
-            first_interface_detail = session.get(first_interface_root)
-        # Something went wrong, so fall back
-        except Exception:
-            first_interface_detail = dict()
-
-        logger.debug(f"First interface detail: {first_interface_detail}")
-        logger.debug(f"HostCorrelation detail: {system_detail.get('HostCorrelation', {})}")
-        # Try to get the MAC address directly from the interface detail (Redfish standard)
-        if first_interface_detail.get("MACAddress") is not None:
-            logger.debug("Try to get the MAC address directly from the interface detail (Redfish standard)")
-            bootstrap_mac_address = first_interface_detail["MACAddress"].strip().lower()
-        # Try to get the MAC address from the HostCorrelation->HostMACAddress (HP DL360x G8)
-        elif len(system_detail.get("HostCorrelation", {}).get("HostMACAddress", [])) > 0:
-            logger.debug("Try to get the MAC address from the HostCorrelation (HP iLO)")
-            bootstrap_mac_address = (
-                system_detail["HostCorrelation"]["HostMACAddress"][0].strip().lower()
-            )
-        # We can't find it, so abort
-        else:
-            logger.error("Could not find a valid MAC address for the bootstrap interface.")
-            return
-
-        # Display the system details
-        logger.info("Found details from node characterization:")
-        logger.info(f"> System Manufacturer: {redfish_vendor}")
-        logger.info(f"> System Redfish Version: {redfish_version}")
-        logger.info(f"> System Redfish Name: {redfish_name}")
-        logger.info(f"> System SKU: {system_sku}")
-        logger.info(f"> System Serial: {system_serial}")
-        logger.info(f"> Power State: {system_power_state}")
-        logger.info(f"> Indicator LED: {system_indicator_state}")
-        logger.info(f"> Health State: {system_health_state}")
-        logger.info(f"> Bootstrap NIC MAC: {bootstrap_mac_address}")
-
-        # Update node host MAC address
-        host_macaddr = bootstrap_mac_address
-        node = db.update_node_addresses(
-            config,
-            cspec_cluster,
-            cspec_hostname,
-            bmc_macaddr,
-            bmc_ipaddr,
-            host_macaddr,
-            host_ipaddr,
-        )
-        logger.debug(node)
-    except Exception as e:
-        notifications.send_webhook(config, "failure", f"Cluster {cspec_cluster}: Failed to characterize Redfish for host {cspec_fqdn} at {bmc_host}. Check pvcbootstrapd logs and reset this host's BMC to retry.")
-        logger.error(f"Cluster {cspec_cluster}: Failed to characterize Redfish for host {cspec_fqdn} at {bmc_host}: {e}")
-        logger.error("Aborting Redfish configuration; reset BMC to retry.")
-        del session
-        return
+            logger.info("Characterizing node...")
+            notifications.send_webhook(config, "begin", f"Cluster {cspec_cluster}: Beginning Redfish characterization of host {cspec_fqdn} at {bmc_host}")
+            try:
 
-    logger.info("Waiting 60 seconds for system normalization")
-    sleep(60)
+                redfish_base_root = "/redfish/v1"
+
+                # Check any cached discovery with a single request, and discard it on mismatch
+                if discovery is not None and not check_node_discovery(session, discovery):
+                    logger.info("Cached discovery does not match the BMC; discarding it")
+                    db.delete_node_discovery(config, cspec_cluster, cspec_hostname)
+                    discovery = None
+
+                if discovery is not None:
+                    logger.info(f"Using cached discovery (completed phase {discovery.phase})")
+                    if discovery.fingerprint != fingerprint:
+                        logger.info("Node specification changed; redoing all configuration")
+                        discovery.phase = "characterized"
+                        discovery.fingerprint = fingerprint
+                        discovery.system_drive_target = None
+                    redfish_vendor = discovery.vendor
+                    session.vendor = redfish_vendor
+                    manager_root = discovery.manager_root
+                    system_root = discovery.system_root
+                else:
+                    # Get Refish bases
+                    logger.debug("Getting redfish bases")
+                    redfish_base_detail = session.get(redfish_base_root)
+
+                    redfish_vendor = list(redfish_base_detail["Oem"].keys())[0]
+                    session.vendor = redfish_vendor
+                    redfish_name = redfish_base_detail["Name"]
+                    redfish_version = redfish_base_detail["RedfishVersion"]
+                    logger.info(f"> System Redfish Version: {redfish_version}")
+                    logger.info(f"> System Redfish Name: {redfish_name}")
+
+                    managers_base_root = redfish_base_detail["Managers"]["@odata.id"].rstrip("/")
+                    managers_base_detail = session.get(managers_base_root)
+                    manager_root = managers_base_detail["Members"][0]["@odata.id"].rstrip("/")
+
+                    systems_base_root = redfish_base_detail["Systems"]["@odata.id"].rstrip("/")
+                    systems_base_detail = session.get(systems_base_root)
+                    system_root = systems_base_detail["Members"][0]["@odata.id"].rstrip("/")
+
+                # Wait for the Manager and System to finish any startup or update
+                logger.info("Waiting for the Manager and System to be ready")
+                wait_ready(
+                    config,
+                    "manager_status",
+                    lambda: probe_resource_status(session, manager_root),
+                    config["redfish_ready_timeout_status"],
+                )
+                wait_ready(
+                    config,
+                    "system_status",
+                    lambda: probe_resource_status(session, system_root),
+                    config["redfish_ready_timeout_status"],
+                )
 
-    logger.info("Determining system disk...")
-    try:
-        storage_root = system_detail.get("Storage", {}).get("@odata.id")
-        system_drive_target = get_system_drive_target(session, cspec_node, storage_root)
-        if system_drive_target is None:
-            logger.error(
-                "No valid drives found; configure a single system drive as a 'detect:' string or Linux '/dev' path instead and retry."
+                # Subscribe to BMC events, to learn about changes (e.g. power state) without
+                # polling; if unsupported, fall back to polling the BMC
+                if config["redfish_events_enabled"]:
+                    bmc_events = events.subscribe_bmc_events(config, bmc_macaddr)
+                    if bmc_events is not None:
+                        event_subscription = create_event_subscription(
+                            session, config["redfish_events_destination"], bmc_macaddr
+                        )
+                        if event_subscription is None:
+                            logger.info("Event subscriptions unsupported; polling the BMC")
+                            bmc_events.close()
+                            bmc_events = None
+                        else:
+                            logger.info(f"Subscribed to BMC events at {event_subscription}")
+
+                # With events, poll the BMC only as a fallback in case an event is lost
+                if bmc_events is not None:
+                    poll_interval = 30
+                else:
+                    poll_interval = 2
+
+                # Force off the system and turn on the indicator
+                logger.debug("Force off the system and turn on the indicator")
+                set_power_state(session, system_root, redfish_vendor, "off")
+                set_indicator_state(session, system_root, redfish_vendor, "on")
+
+                # Get the system details
+                logger.debug("Get the system details")
+                system_detail = session.get(system_root)
+
+                system_sku = system_detail["SKU"].strip()
+                system_serial = system_detail["SerialNumber"].strip()
+                system_power_state = system_detail["PowerState"].strip()
+                system_indicator_state = system_detail["IndicatorLED"].strip()
+                system_health_state = system_detail["Status"]["Health"].strip()
+
+                # Walk down the EthernetInterfaces construct to get the bootstrap interface MAC address
+                logger.debug("Walk down the EthernetInterfaces construct to get the bootstrap interface MAC address")
+                ethernet_root = None
+                first_interface_detail = dict()
+                # Skip the walk if the MAC address is known from the cached discovery
+                if discovery is None:
+                    try:
+                        ethernet_root = system_detail["EthernetInterfaces"]["@odata.id"].rstrip("/")
+                        ethernet_detail = session.get_collection(ethernet_root, select=["MACAddress"])
+                        logger.debug(f"Found Ethernet detail: {ethernet_detail}")
+                        embedded_ethernet_detail_members = [e for e in ethernet_detail["Members"] if "Embedded" in e["@odata.id"]]
+                        embedded_ethernet_detail_members.sort(key = lambda k: k["@odata.id"])
+                        logger.debug(f"Found Ethernet members: {embedded_ethernet_detail_members}")
+                        first_interface_detail = session.get_member(embedded_ethernet_detail_members[0])
+                    # Something went wrong, so fall back
+                    except Exception:
+                        first_interface_detail = dict()
+
+                logger.debug(f"First interface detail: {first_interface_detail}")
+                logger.debug(f"HostCorrelation detail: {system_detail.get('HostCorrelation', {})}")
+                # Use the known MAC address from the cached discovery
+                if discovery is not None:
+                    bootstrap_mac_address = discovery.host_macaddr
+                # Try to get the MAC address directly from the interface detail (Redfish standard)
+                elif first_interface_detail.get("MACAddress") is not None:
+                    logger.debug("Try to get the MAC address directly from the interface detail (Redfish standard)")
+                    bootstrap_mac_address = first_interface_detail["MACAddress"].strip().lower()
+                # Try to get the MAC address from the HostCorrelation->HostMACAddress (HP DL360x G8)
+                elif len(system_detail.get("HostCorrelation", {}).get("HostMACAddress", [])) > 0:
+                    logger.debug("Try to get the MAC address from the HostCorrelation (HP iLO)")
+                    bootstrap_mac_address = (
+                        system_detail["HostCorrelation"]["HostMACAddress"][0].strip().lower()
+                    )
+                # We can't find it, so abort
+                else:
+                    logger.error("Could not find a valid MAC address for the bootstrap interface.")
+                    return
+
+                # Display the system details
+                logger.info("Found details from node characterization:")
+                logger.info(f"> System Manufacturer: {redfish_vendor}")
+                logger.info(f"> System SKU: {system_sku}")
+                logger.info(f"> System Serial: {system_serial}")
+                logger.info(f"> Power State: {system_power_state}")
+                logger.info(f"> Indicator LED: {system_indicator_state}")
+                logger.info(f"> Health State: {system_health_state}")
+                logger.info(f"> Bootstrap NIC MAC: {bootstrap_mac_address}")
+
+                # Update node host MAC address
+                host_macaddr = bootstrap_mac_address
+                node = db.update_node_addresses(
+                    config,
+                    cspec_cluster,
+                    cspec_hostname,
+                    bmc_macaddr,
+                    bmc_ipaddr,
+                    host_macaddr,
+                    host_ipaddr,
+                )
+                logger.debug(node)
+
+                if discovery is None:
+                    discovery = NodeDiscovery(
+                        None,
+                        cspec_hostname,
+                        "characterized",
+                        fingerprint,
+                        redfish_vendor,
+                        system_serial,
+                        manager_root,
+                        system_root,
+                        ethernet_root,
+                        system_detail.get("Bios", {}).get("@odata.id"),
+                        system_detail.get("Storage", {}).get("@odata.id"),
+                        host_macaddr,
+                        None,
+                    )
+                discovery = db.set_node_discovery(
+                    config, cspec_cluster, cspec_hostname, discovery
+                )
+            except Exception as e:
+                notifications.send_webhook(config, "failure", f"Cluster {cspec_cluster}: Failed to characterize Redfish for host {cspec_fqdn} at {bmc_host}. Check pvcbootstrapd logs and reset this host's BMC to retry.")
+                logger.error(f"Cluster {cspec_cluster}: Failed to characterize Redfish for host {cspec_fqdn} at {bmc_host}: {e}")
+                logger.error("Aborting Redfish configuration; reset BMC to retry.")
+                return
+
+            logger.info("Waiting for the system to power off and any BMC tasks to complete")
+            wait_ready(
+                config,
+                "power_off",
+                lambda: probe_power_state(session, system_root, "Off"),
+                config["redfish_ready_timeout_power"],
+                interval=poll_interval,
+                bmc_events=bmc_events,
+            )
+            # Finished tasks are only fetched by the first probe
+            finished_tasks = set()
+            wait_ready(
+                config,
+                "tasks_idle",
+                lambda: probe_tasks_idle(
+                    session, redfish_vendor, manager_root, finished_tasks
+                ),
+                config["redfish_ready_timeout_tasks"],
+                interval=5,
             )
-            return
-        logger.info(f"Found system disk {system_drive_target}")
-    except Exception as e:
-        notifications.send_webhook(config, "failure", f"Cluster {cspec_cluster}: Failed to configure system disk for host {cspec_fqdn} at {bmc_host}. Check pvcbootstrapd logs and reset this host's BMC to retry.")
-        logger.error(f"Cluster {cspec_cluster}: Failed to configure system disk for host {cspec_fqdn} at {bmc_host}: {e}")
-        logger.error("Aborting Redfish configuration; reset BMC to retry.")
-        del session
-        return
 
-    # Create our preseed configuration
-    logger.info("Creating node boot configurations...")
-    try:
-        installer.add_pxe(config, cspec_node, host_macaddr)
-        installer.add_preseed(config, cspec_node, host_macaddr, system_drive_target)
-    except Exception as e:
-        notifications.send_webhook(config, "failure", f"Cluster {cspec_cluster}: Failed to generate PXE configurations for host {cspec_fqdn} at {bmc_host}. Check pvcbootstrapd logs and reset this host's BMC to retry.")
-        logger.error(f"Cluster {cspec_cluster}: Failed to generate PXE configurations for host {cspec_fqdn} at {bmc_host}: {e}")
-        logger.error("Aborting Redfish configuration; reset BMC to retry.")
-        del session
-        return
+            logger.info("Determining system disk...")
+            scp_applied = False
+            try:
+                # The profile of identical nodes, to use instead of discovering it all again
+                profile = get_hardware_profile(
+                    config,
+                    session,
+                    redfish_vendor,
+                    get_system_model(system_detail, redfish_vendor),
+                    discovery.storage_root,
+                )
+                layout_key = ",".join(cspec_node["config"]["system_disks"])
+                drive_layout = dict(profile.drive_layouts.get(layout_key, {}))
+
+                if phase_completed(discovery, "system_disk"):
+                    system_drive_target = discovery.system_drive_target
+                    logger.info(f"Using cached system disk {system_drive_target}")
+                else:
+                    # On Dell, create the RAID-1 volume (if any) and apply the BIOS and iDRAC
+                    # settings with one Server Configuration Profile import job instead
+                    if redfish_vendor == "Dell" and config["redfish_dell_scp_enabled"]:
+                        logger.info("Importing Server Configuration Profile...")
+                        scp_applied = apply_scp(
+                            session,
+                            cspec_node,
+                            manager_root,
+                            discovery.storage_root,
+                            drive_layout,
+                            config["redfish_dell_scp_timeout"],
+                        )
+                        if not scp_applied:
+                            logger.warn("Server Configuration Profile import failed")
+                    system_drive_target = get_system_drive_target(
+                        session, cspec_node, discovery.storage_root, drive_layout
+                    )
+                    if system_drive_target is None and layout_key in profile.drive_layouts:
+                        logger.warn("Hardware profile drive layout failed; discovering drives")
+                        drive_layout = dict()
+                        system_drive_target = get_system_drive_target(
+                            session, cspec_node, discovery.storage_root, drive_layout
+                        )
+                    if system_drive_target is None:
+                        logger.error(
+                            "No valid drives found; configure a single system drive as a 'detect:' string or Linux '/dev' path instead and retry."
+                        )
+                        return
+                    logger.info(f"Found system disk {system_drive_target}")
+                    if len(drive_layout) > 0:
+                        profile.drive_layouts[layout_key] = drive_layout
+                    discovery.system_drive_target = system_drive_target
+                    complete_phase(
+                        config, cspec_cluster, cspec_hostname, discovery, "system_disk"
+                    )
+            except Exception as e:
+                notifications.send_webhook(config, "failure", f"Cluster {cspec_cluster}: Failed to configure system disk for host {cspec_fqdn} at {bmc_host}. Check pvcbootstrapd logs and reset this host's BMC to retry.")
+                logger.error(f"Cluster {cspec_cluster}: Failed to configure system disk for host {cspec_fqdn} at {bmc_host}: {e}")
+                logger.error("Aborting Redfish configuration; reset BMC to retry.")
+                return
+
+            # Create our preseed configuration
+            logger.info("Creating node boot configurations...")
+            try:
+                installer.add_pxe(config, cspec_node, host_macaddr)
+                installer.add_preseed(config, cspec_node, host_macaddr, system_drive_target)
+            except Exception as e:
+                notifications.send_webhook(config, "failure", f"Cluster {cspec_cluster}: Failed to generate PXE configurations for host {cspec_fqdn} at {bmc_host}. Check pvcbootstrapd logs and reset this host's BMC to retry.")
+                logger.error(f"Cluster {cspec_cluster}: Failed to generate PXE configurations for host {cspec_fqdn} at {bmc_host}: {e}")
+                logger.error("Aborting Redfish configuration; reset BMC to retry.")
+                return
+
+            # Adjust any BIOS settings, in one change (and so one configuration job)
+            bios_settings = cspec_node["bmc"].get("bios_settings", {})
+            if phase_completed(discovery, "bios_settings"):
+                logger.info("BIOS settings already adjusted")
+            elif scp_applied:
+                logger.info("BIOS settings applied by Server Configuration Profile")
+                complete_phase(
+                    config, cspec_cluster, cspec_hostname, discovery, "bios_settings"
+                )
+            elif len(bios_settings) > 0 and discovery.bios_root is not None:
+                logger.info("Adjusting BIOS settings...")
+                try:
+                    changes = apply_bios_settings(session, discovery.bios_root, bios_settings)
+                except Exception as e:
+                    notifications.send_webhook(config, "failure", f"Cluster {cspec_cluster}: Failed to set BIOS settings for host {cspec_fqdn} at {bmc_host}. Check pvcbootstrapd logs and reset this host's BMC to retry.")
+                    logger.error(f"Cluster {cspec_cluster}: Failed to set BIOS settings for host {cspec_fqdn} at {bmc_host}: {e}")
+                    logger.error("Aborting Redfish configuration; reset BMC to retry.")
+                    return
+                if changes is None:
+                    logger.warn("Failed to change BIOS settings; continuing anyway")
+                else:
+                    if len(changes) < 1:
+                        logger.info("BIOS settings already as specified")
+                    complete_phase(
+                        config, cspec_cluster, cspec_hostname, discovery, "bios_settings"
+                    )
+            else:
+                complete_phase(
+                    config, cspec_cluster, cspec_hostname, discovery, "bios_settings"
+                )
 
-    # Adjust any BIOS settings
-    if len(cspec_node["bmc"].get("bios_settings", {}).items()) > 0:
-        logger.info("Adjusting BIOS settings...")
-        try:
-            bios_root = system_detail.get("Bios", {}).get("@odata.id")
-            if bios_root is not None:
-                bios_detail = session.get(bios_root)
-                bios_attributes = list(bios_detail["Attributes"].keys())
-                for setting, value in cspec_node["bmc"].get("bios_settings", {}).items():
-                    if setting not in bios_attributes:
-                        continue
-                    payload = {"Attributes": {setting: value}}
-                    session.patch(f"{bios_root}/Settings", payload)
-        except Exception as e:
-            notifications.send_webhook(config, "failure", f"Cluster {cspec_cluster}: Failed to set BIOS settings for host {cspec_fqdn} at {bmc_host}. Check pvcbootstrapd logs and reset this host's BMC to retry.")
-            logger.error(f"Cluster {cspec_cluster}: Failed to set BIOS settings for host {cspec_fqdn} at {bmc_host}: {e}")
-            logger.error("Aborting Redfish configuration; reset BMC to retry.")
-            del session
-            return
+            # Adjust any Manager settings, in one change
+            manager_settings = cspec_node["bmc"].get("manager_settings", {})
+            if phase_completed(discovery, "manager_settings"):
+                logger.info("Manager settings already adjusted")
+            elif scp_applied:
+                logger.info("Manager settings applied by Server Configuration Profile")
+                complete_phase(
+                    config, cspec_cluster, cspec_hostname, discovery, "manager_settings"
+                )
+            elif len(manager_settings) > 0:
+                logger.info("Adjusting Manager settings...")
+                try:
+                    changes = apply_manager_settings(session, manager_root, manager_settings)
+                except Exception as e:
+                    notifications.send_webhook(config, "failure", f"Cluster {cspec_cluster}: Failed to set BMC settings for host {cspec_fqdn} at {bmc_host}. Check pvcbootstrapd logs and reset this host's BMC to retry.")
+                    logger.error(f"Cluster {cspec_cluster}: Failed to set BMC settings for host {cspec_fqdn} at {bmc_host}: {e}")
+                    logger.error("Aborting Redfish configuration; reset BMC to retry.")
+                    return
+                if changes is None:
+                    logger.warn("Failed to change Manager settings; continuing anyway")
+                else:
+                    if len(changes) < 1:
+                        logger.info("Manager settings already as specified")
+                    complete_phase(
+                        config, cspec_cluster, cspec_hostname, discovery, "manager_settings"
+                    )
+            else:
+                complete_phase(
+                    config, cspec_cluster, cspec_hostname, discovery, "manager_settings"
+                )
 
-    # Adjust any Manager settings
-    if len(cspec_node["bmc"].get("manager_settings", {}).items()) > 0:
-        logger.info("Adjusting Manager settings...")
-        try:
-            mgrattribute_root = f"{manager_root}/Attributes"
-            mgrattribute_detail = session.get(mgrattribute_root)
-            mgrattribute_attributes = list(mgrattribute_detail["Attributes"].keys())
-            for setting, value in cspec_node["bmc"].get("manager_settings", {}).items():
-                if setting not in mgrattribute_attributes:
-                    continue
-                payload = {"Attributes": {setting: value}}
-                session.patch(mgrattribute_root, payload)
-        except Exception as e:
-            notifications.send_webhook(config, "failure", f"Cluster {cspec_cluster}: Failed to set BMC settings for host {cspec_fqdn} at {bmc_host}. Check pvcbootstrapd logs and reset this host's BMC to retry.")
-            logger.error(f"Cluster {cspec_cluster}: Failed to set BMC settings for host {cspec_fqdn} at {bmc_host}: {e}")
-            logger.error("Aborting Redfish configuration; reset BMC to retry.")
-            del session
-            return
+            # Set boot override to Pxe for the installer boot
+            logger.info("Setting temporary PXE boot...")
+            try:
+                if profile.boot_targets is None:
+                    profile.boot_targets = get_boot_targets(system_detail, redfish_vendor)
+                set_boot_override(
+                    session, system_root, redfish_vendor, "Pxe", profile.boot_targets
+                )
+            except Exception as e:
+                notifications.send_webhook(config, "failure", f"Cluster {cspec_cluster}: Failed to set PXE boot override for host {cspec_fqdn} at {bmc_host}. Check pvcbootstrapd logs and reset this host's BMC to retry.")
+                logger.error(f"Cluster {cspec_cluster}: Failed to set PXE boot override for host {cspec_fqdn} at {bmc_host}: {e}")
+                logger.error("Aborting Redfish configuration; reset BMC to retry.")
+                return
 
-    # Set boot override to Pxe for the installer boot
-    logger.info("Setting temporary PXE boot...")
-    try:
-        set_boot_override(session, system_root, redfish_vendor, "Pxe")
-    except Exception as e:
-        notifications.send_webhook(config, "failure", f"Cluster {cspec_cluster}: Failed to set PXE boot override for host {cspec_fqdn} at {bmc_host}. Check pvcbootstrapd logs and reset this host's BMC to retry.")
-        logger.error(f"Cluster {cspec_cluster}: Failed to set PXE boot override for host {cspec_fqdn} at {bmc_host}: {e}")
-        logger.error("Aborting Redfish configuration; reset BMC to retry.")
-        del session
-        return
+            # Store the hardware profile, now known to work, for further identical nodes
+            db.set_hardware_profile(config, profile)
 
-    notifications.send_webhook(config, "success", f"Cluster {cspec_cluster}: Completed Redfish initialization of host {cspec_fqdn}")
+            notifications.send_webhook(config, "success", f"Cluster {cspec_cluster}: Completed Redfish initialization of host {cspec_fqdn}")
 
-    # Turn on the system
-    logger.info("Powering on node...")
-    try:
-        set_power_state(session, system_root, redfish_vendor, "on")
-        notifications.send_webhook(config, "info", f"Cluster {cspec_cluster}: Powering on host {cspec_fqdn}")
-    except Exception as e:
-        notifications.send_webhook(config, "failure", f"Cluster {cspec_cluster}: Failed to power on host {cspec_fqdn} at {bmc_host}. Check pvcbootstrapd logs and reset this host's BMC to retry.")
-        logger.error(f"Cluster {cspec_cluster}: Failed to power on host {cspec_fqdn} at {bmc_host}: {e}")
-        logger.error("Aborting Redfish configuration; reset BMC to retry.")
-        del session
-        return
+            # Wait for free installer and PXE boot slots, and our turn to power on
+            scheduler.acquire_slot(config, "installers", cspec_cluster, bmc_macaddr)
+            scheduler.acquire_slot(config, "pxe_boots", cspec_cluster, bmc_macaddr)
+            scheduler.wait_power_on(config)
 
-    node = db.update_node_state(config, cspec_cluster, cspec_hostname, "pxe-booting")
-
-    logger.info("Waiting for completion of node and cluster installation...")
-    # Wait for the system to install and be configured
-    while node.state != "completed":
-        sleep(60)
-        # Keep the Redfish session alive
-        session.get(redfish_base_root)
-        # Refresh our node state
-        node = db.get_node(config, cspec_cluster, name=cspec_hostname)
-
-    # Graceful shutdown of the machine
-    notifications.send_webhook(config, "info", f"Cluster {cspec_cluster}: Shutting down host {cspec_fqdn}")
-    set_power_state(session, system_root, redfish_vendor, "GracefulShutdown")
-    system_power_state = "On"
-    while system_power_state != "Off":
-        sleep(5)
-        # Refresh our power state from the system details
-        system_detail = session.get(system_root)
-        system_power_state = system_detail["PowerState"].strip()
+            # Turn on the system
+            logger.info("Powering on node...")
+            try:
+                powered_on = converge_power_state(
+                    config,
+                    session,
+                    system_root,
+                    redfish_vendor,
+                    "on",
+                    config["redfish_ready_timeout_power"],
+                    interval=poll_interval,
+                    bmc_events=bmc_events,
+                )
+            except Exception as e:
+                notifications.send_webhook(config, "failure", f"Cluster {cspec_cluster}: Failed to power on host {cspec_fqdn} at {bmc_host}. Check pvcbootstrapd logs and reset this host's BMC to retry.")
+                logger.error(f"Cluster {cspec_cluster}: Failed to power on host {cspec_fqdn} at {bmc_host}: {e}")
+                logger.error("Aborting Redfish configuration; reset BMC to retry.")
+                return
+            # The installer and PXE boot slots are freed by the caller on abort
+            if not powered_on:
+                notifications.send_webhook(config, "failure", f"Cluster {cspec_cluster}: Failed to power on host {cspec_fqdn} at {bmc_host}. Check pvcbootstrapd logs and reset this host's BMC to retry.")
+                logger.error(f"Cluster {cspec_cluster}: Failed to power on host {cspec_fqdn} at {bmc_host}: the reset failed or the system did not reach On within {config['redfish_ready_timeout_power']}s")
+                logger.error("Aborting Redfish configuration; reset BMC to retry.")
+                return
+            notifications.send_webhook(config, "info", f"Cluster {cspec_cluster}: Powering on host {cspec_fqdn}")
+
+            node = db.update_node_state(config, cspec_cluster, cspec_hostname, "pxe-booting")
+            scheduler.release_slot(config, "redfish_sessions", cspec_cluster, bmc_macaddr)
+
+            # BMC events are not needed while the node installs, which may take hours, so
+            # stop receiving them until it is shut down afterwards
+            if bmc_events is not None:
+                bmc_events.close()
+                bmc_events = None
+
+            logger.info("Waiting for completion of node and cluster installation...")
+            # Wait for the system to install and be configured, keeping the Redfish session alive
+            node = db.wait_node_state(
+                config,
+                cspec_cluster,
+                cspec_hostname,
+                "completed",
+                keepalive=lambda: session.get(redfish_base_root),
+            )
+
+            # Receive BMC events again for the shutdown, or poll the BMC if that fails
+            if event_subscription is not None:
+                bmc_events = events.subscribe_bmc_events(config, bmc_macaddr)
+                if bmc_events is None:
+                    poll_interval = 2
+
+            # Graceful shutdown of the machine
+            notifications.send_webhook(config, "info", f"Cluster {cspec_cluster}: Shutting down host {cspec_fqdn}")
+            converge_power_state(
+                config,
+                session,
+                system_root,
+                redfish_vendor,
+                "GracefulShutdown",
+                config["redfish_ready_timeout_shutdown"],
+                interval=max(poll_interval, 5),
+                bmc_events=bmc_events,
+                check="shutdown",
+            )
 
-    # Turn off the indicator to indicate bootstrap has completed
-    set_indicator_state(session, system_root, redfish_vendor, "off")
+            # Turn off the indicator to indicate bootstrap has completed
+            set_indicator_state(session, system_root, redfish_vendor, "off")
 
-    notifications.send_webhook(config, "success", f"Cluster {cspec_cluster}: Powered off host {cspec_fqdn}")
+            # Keep the discovery, but redo all configuration for any later bootstrap
+            discovery.phase = "characterized"
+            db.set_node_discovery(config, cspec_cluster, cspec_hostname, discovery)
 
-    # We must delete the session
-    del session
-    return
+            notifications.send_webhook(config, "success", f"Cluster {cspec_cluster}: Powered off host {cspec_fqdn}")
+        finally:
+            # Remove the BMC event subscription however the initialization ended, so that
+            # the BMC does not keep sending events for this node
+            if bmc_events is not None:
+                bmc_events.close()
+            delete_event_subscription(session, event_subscription)
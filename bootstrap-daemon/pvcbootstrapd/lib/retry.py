@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+# retry.py - PVC Cluster Auto-bootstrap retry policies and circuit breakers
+# Part of the Parallel Virtual Cluster (PVC) system
+#
+#    Copyright (C) 2018-2021 Joshua M. Boniface <joshua@boniface.me>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import random
+import requests
+import threading
+import urllib3
+
+import pvcbootstrapd.lib.metrics as metrics
+
+from time import sleep, monotonic
+from celery.utils.log import get_task_logger
+
+
+logger = get_task_logger(__name__)
+
+
+# HTTP status codes which indicate a transient condition on the BMC
+RETRYABLE_STATUSES = [429, 502, 503, 504]
+
+# HTTP methods which are safe to send again after an error once they reached the BMC
+IDEMPOTENT_METHODS = ["GET", "HEAD", "PUT", "DELETE", "OPTIONS"]
+
+
+class CircuitOpenError(ConnectionError):
+    """
+    Raised instead of sending a request to a BMC whose circuit breaker is open
+    """
+
+    pass
+
+
+#
+# Retry policies
+#
+class RetryPolicy:
+    """
+    Exponential backoff with jitter, bounded by a number of attempts and a total time
+    budget (either may be None for no bound)
+
+        for attempt in policy.attempts():
+            ...
+    """
+
+    def __init__(
+        self, max_attempts=4, base_delay=0.5, max_delay=30, deadline=60, jitter=True
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        """
+        Get the delay before the attempt after 'attempt' (counting from 1)
+        """
+        delay = min(self.base_delay * 2 ** (attempt - 1), self.max_delay)
+        if self.jitter:
+            delay = random.uniform(delay / 2, delay)
+        return delay
+
+    def attempts(self):
+        """
+        Yield attempt numbers (from 1), sleeping between them, until the attempts or
+        the time budget run out; no attempt is started if its delay would exceed the
+        budget
+        """
+        start = monotonic()
+        attempt = 1
+        while True:
+            yield attempt
+            if self.max_attempts is not None and attempt >= self.max_attempts:
+                return
+            delay = self.delay(attempt)
+            if (
+                self.deadline is not None
+                and monotonic() - start + delay > self.deadline
+            ):
+                return
+            sleep(delay)
+            attempt += 1
+
+
+def get_policy(config, name):
+    """
+    Get the configured retry policy for a class of operations ("request" or "login";
+    see Daemon.read_config)
+    """
+    return RetryPolicy(
+        max_attempts=config[f"redfish_retry_{name}_attempts"],
+        base_delay=config[f"redfish_retry_{name}_base_delay"],
+        max_delay=config[f"redfish_retry_{name}_max_delay"],
+        deadline=config[f"redfish_retry_{name}_deadline"],
+    )
+
+
+def is_retryable(method, response=None, exception=None):
+    """
+    Classify the result of a request as retryable (transient) or fatal
+
+    Failures to connect are always retryable, since nothing reached the BMC. Other
+    connection errors and timeouts are only retryable for idempotent methods, as are
+    transient HTTP statuses, except 503 and 429, where the BMC refused the request.
+    """
+    if exception is not None:
+        if isinstance(exception, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(exception.args[0], "reason", None) if exception.args else None
+        if isinstance(reason, urllib3.exceptions.NewConnectionError):
+            return True
+        if isinstance(
+            exception,
+            (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+            ),
+        ):
+            return method in IDEMPOTENT_METHODS
+        return False
+
+    if response is not None and response.status_code in RETRYABLE_STATUSES:
+        return method in IDEMPOTENT_METHODS or response.status_code in [429, 503]
+    return False
+
+
+def record_retry(config, operation, reason):
+    """
+    Record a retry in the "redfish_retries_total" metric
+    """
+    if config is not None:
+        metrics.increment(
+            config, "redfish_retries_total", operation=operation, reason=reason
+        )
+
+
+#
+# Circuit breakers
+#
+class CircuitBreaker:
+    """
+    A circuit breaker for one BMC
+
+    After 'threshold' consecutive failed operations (i.e. after their retries), the
+    circuit opens and operations fail immediately for 'reset_timeout' seconds. Then
+    one trial operation is let through (half-open): its success closes the circuit,
+    and its failure opens it again.
+    """
+
+    def __init__(self, host, threshold=5, reset_timeout=60):
+        self.host = host
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Return whether an operation may be attempted now
+        """
+        with self.lock:
+            if self.opened is None:
+                return True
+            if monotonic() - self.opened >= self.reset_timeout:
+                # Half-open: let this one through, and hold off any others meanwhile
+                self.opened = monotonic()
+                return True
+            return False
+
+    def check(self):
+        """
+        Raise CircuitOpenError if no operation may be attempted now
+        """
+        if not self.allow():
+            raise CircuitOpenError(
+                f"Circuit breaker for {self.host} is open after {self.failures} failures"
+            )
+
+    def record_success(self):
+        with self.lock:
+            if self.opened is not None:
+                logger.info(f"Circuit breaker for {self.host} closed")
+            self.failures = 0
+            self.opened = None
+
+    def record_failure(self, config=None):
+        with self.lock:
+            self.failures += 1
+            if self.threshold <= 0 or self.failures < self.threshold:
+                return
+            opening = self.opened is None
+            self.opened = monotonic()
+
+        if opening:
+            logger.warn(
+                f"Circuit breaker for {self.host} opened after {self.failures} "
+                f"failures; failing fast for {self.reset_timeout}s"
+            )
+            if config is not None:
+                metrics.increment(config, "redfish_circuit_opened_total")
+
+
+# The circuit breakers of this worker process, one per BMC host
+circuit_breakers = dict()
+circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(config, host):
+    """
+    Get the circuit breaker for a BMC host, with the configured settings if any
+    """
+    with circuit_breakers_lock:
+        if host not in circuit_breakers:
+            if config is not None:
+                circuit_breakers[host] = CircuitBreaker(
+                    host,
+                    threshold=config["redfish_circuit_breaker_threshold"],
+                    reset_timeout=config["redfish_circuit_breaker_reset_timeout"],
+                )
+            else:
+                circuit_breakers[host] = CircuitBreaker(host)
+        return circuit_breakers[host]
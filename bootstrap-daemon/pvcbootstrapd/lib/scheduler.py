@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+# scheduler.py - PVC Cluster Auto-bootstrap deployment scheduler libraries
+# Part of the Parallel Virtual Cluster (PVC) system
+#
+#    Copyright (C) 2018-2021 Joshua M. Boniface <joshua@boniface.me>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import redis
+
+import pvcbootstrapd.lib.events as events
+import pvcbootstrapd.lib.metrics as metrics
+
+from time import sleep, time, monotonic
+from celery.utils.log import get_task_logger
+
+
+logger = get_task_logger(__name__)
+
+
+# Deployment slot types; each is limited per cluster and overall by the "scheduler"
+# configuration, and is held by a node (identified by its BMC MAC address):
+#   redfish_sessions: from Redfish login until the node is powered on
+#   pxe_boots: from power on until the installer checks in ("installing")
+#   installers: from power on until the installer completes ("installed")
+SLOT_TYPES = ["redfish_sessions", "pxe_boots", "installers"]
+
+SLOTS_PREFIX = "pvcbootstrapd:slots:"
+POWER_ON_KEY = "pvcbootstrapd:power-on"
+
+
+def slot_keys(config, slot, cluster_name):
+    """
+    Return the (key, limit) pairs for a slot type, for the cluster and overall scopes
+    """
+    return [
+        (
+            f"{SLOTS_PREFIX}{slot}:cluster:{cluster_name}",
+            config[f"scheduler_{slot}_cluster"],
+        ),
+        (f"{SLOTS_PREFIX}{slot}:total", config[f"scheduler_{slot}_total"]),
+    ]
+
+
+def try_acquire_slot(config, slot, cluster_name, holder):
+    """
+    Try once to acquire a slot in both scopes atomically; returns True on success
+
+    Slots are leases in a sorted set scored by expiry time, so a slot held by a node
+    whose task died is reclaimed after 'slot_timeout' seconds.
+    """
+    keys = slot_keys(config, slot, cluster_name)
+    now = time()
+    expiry = now + config["scheduler_slot_timeout"]
+
+    with events.get_redis(config).pipeline() as pipeline:
+        while True:
+            try:
+                pipeline.watch(*[key for key, _ in keys])
+                for key, limit in keys:
+                    holders = pipeline.zrangebyscore(key, now, "+inf")
+                    if (
+                        limit > 0
+                        and holder.encode() not in holders
+                        and len(holders) >= limit
+                    ):
+                        pipeline.unwatch()
+                        return False
+                pipeline.multi()
+                for key, _ in keys:
+                    pipeline.zremrangebyscore(key, "-inf", now)
+                    pipeline.zadd(key, {holder: expiry})
+                pipeline.execute()
+                return True
+            except redis.WatchError:
+                # Another node changed the slots meanwhile; try again
+                continue
+
+
+def acquire_slot(config, slot, cluster_name, holder, interval=5):
+    """
+    Wait for and acquire a deployment slot for a node
+    """
+    start = monotonic()
+    waiting = False
+    while True:
+        try:
+            if try_acquire_slot(config, slot, cluster_name, holder):
+                break
+        except Exception as e:
+            # Never block deployment on a scheduler failure
+            logger.warn(f"Failed to acquire {slot} slot for {holder}; continuing: {e}")
+            break
+        if not waiting:
+            logger.info(f"Waiting for a free {slot} slot for {holder}")
+            waiting = True
+        sleep(interval)
+
+    waited = monotonic() - start
+    if waiting:
+        logger.info(f"Acquired {slot} slot for {holder} after {waited:.0f}s")
+    metrics.observe(config, "scheduler_slot_wait_seconds", waited, slot=slot)
+
+
+def release_slot(config, slot, cluster_name, holder):
+    """
+    Release a deployment slot held by a node; releasing a slot not held does nothing
+    """
+    try:
+        pipeline = events.get_redis(config).pipeline()
+        for key, _ in slot_keys(config, slot, cluster_name):
+            pipeline.zrem(key, holder)
+        pipeline.execute()
+    except Exception as e:
+        logger.warn(f"Failed to release {slot} slot for {holder}: {e}")
+
+
+def release_all_slots(config, cluster_name, holder):
+    """
+    Release all deployment slots held by a node
+    """
+    for slot in SLOT_TYPES:
+        release_slot(config, slot, cluster_name, holder)
+
+
+def wait_power_on(config, interval=1):
+    """
+    Wait for our turn to power on a node, staggering power-ons overall by at least
+    'power_on_interval' seconds to spread inrush current and PXE load
+    """
+    power_on_interval = config["scheduler_power_on_interval"]
+    if power_on_interval <= 0:
+        return
+
+    start = monotonic()
+    while True:
+        try:
+            if events.get_redis(config).set(
+                POWER_ON_KEY, 1, nx=True, px=int(power_on_interval * 1000)
+            ):
+                break
+        except Exception as e:
+            logger.warn(f"Failed to schedule power on; continuing: {e}")
+            break
+        sleep(interval)
+
+    metrics.observe(config, "scheduler_power_on_wait_seconds", monotonic() - start)